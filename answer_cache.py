@@ -0,0 +1,163 @@
+"""Per-guild semantic cache of /rag answers.
+
+A question is answered from the cache when an earlier question of the same
+guild embeds within ``threshold`` cosine similarity of it. Entries expire
+after ``ttl`` seconds and are dropped as soon as new content is indexed in
+one of the channels their answer was retrieved from (or, for answers
+without sources, in the channels the question was limited to).
+
+Answers are computed over several awaits, so ``put`` takes the ``epoch``
+read before retrieval and refuses the answer if one of the channels it
+depends on changed since.
+"""
+import time
+from dataclasses import dataclass
+
+import numpy as np
+
+import settings
+
+
+logger = settings.logging.getLogger("bot")
+
+
+@dataclass
+class CachedAnswer:
+    query: str
+    answer: str
+    channels: frozenset[int]  # channels the answer's sources came from
+    created: float
+    scope: frozenset[int] = frozenset()  # channels the question was limited to
+
+
+class AnswerCache:
+    def __init__(self, threshold=None, ttl=None, max_entries=None):
+        self.threshold = settings.ANSWER_CACHE_THRESHOLD if threshold is None else threshold
+        self.ttl = settings.ANSWER_CACHE_TTL if ttl is None else ttl
+        self.max_entries = max_entries or settings.ANSWER_CACHE_MAX_ENTRIES
+        # guild_id -> entries, oldest first, and their unit-length embeddings
+        self._entries: dict[int, list[CachedAnswer]] = {}
+        self._vectors: dict[int, np.ndarray] = {}
+        # bumped on every invalidation; guild_id -> channel_id -> epoch of
+        # its last change, and guild_id -> epoch it was last forgotten
+        self._epoch = 0
+        self._changed: dict[int, dict[int, int]] = {}
+        self._forgotten: dict[int, int] = {}
+        self._cleared = 0
+        self.hits = 0
+        self.misses = 0
+        self.hit_seconds = 0.0
+        self.miss_seconds = 0.0
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self):
+        return {
+            "entries": sum(len(entries) for entries in self._entries.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate,
+            "avg_hit_ms": 1000 * self.hit_seconds / self.hits if self.hits else 0.0,
+            "avg_miss_ms": 1000 * self.miss_seconds / self.misses if self.misses else 0.0,
+        }
+
+    def epoch(self):
+        return self._epoch
+
+    def changed_since(self, guild_id, channels, epoch):
+        """Whether any of ``channels`` (empty for any channel) of the guild
+        was invalidated after ``epoch``."""
+        if max(self._cleared, self._forgotten.get(guild_id, 0)) > epoch:
+            return True
+        changed = self._changed.get(guild_id, {})
+        if not channels:
+            return any(last > epoch for last in changed.values())
+        return any(changed.get(channel_id, 0) > epoch for channel_id in channels)
+
+    def get(self, guild_id, embedding, scope=frozenset()):
+        """The cached answer for the closest earlier question over the same
+        channels (``scope``, empty for the whole guild), if close enough."""
+        self._expire(guild_id)
+        vectors = self._vectors.get(guild_id)
+        if vectors is None or not len(vectors):
+            return None
+        scores = vectors @ _unit(embedding)
+        for best in np.argsort(scores)[::-1]:
+            if scores[best] < self.threshold:
+                break
+            entry = self._entries[guild_id][best]
+            if entry.scope == scope:
+                return entry
+        return None
+
+    def put(self, guild_id, query, embedding, answer, channels, epoch, scope=frozenset()):
+        # no epoch: the answer was not meant to be cached
+        if epoch is None or not answer.strip() or self.changed_since(guild_id, frozenset(channels) or scope, epoch):
+            return
+        entries = self._entries.setdefault(guild_id, [])
+        vector = _unit(embedding)[np.newaxis, :]
+        vectors = self._vectors.get(guild_id)
+        entries.append(CachedAnswer(query, answer, frozenset(channels), time.time(), scope))
+        vectors = vector if vectors is None else np.vstack([vectors, vector])
+        if len(entries) > self.max_entries:
+            del entries[0]
+            vectors = vectors[1:]
+        self._vectors[guild_id] = vectors
+
+    def record(self, hit, seconds):
+        if hit:
+            self.hits += 1
+            self.hit_seconds += seconds
+        else:
+            self.misses += 1
+            self.miss_seconds += seconds
+        if (self.hits + self.misses) % 100 == 0:
+            logger.info(f"Answer cache: {self.stats()}")
+
+    def invalidate_channel(self, guild_id, channel_id):
+        self._epoch += 1
+        self._changed.setdefault(guild_id, {})[channel_id] = self._epoch
+        entries = self._entries.get(guild_id)
+        if entries:
+            self._keep(guild_id, [not _depends_on(entry, channel_id) for entry in entries])
+
+    def forget(self, guild_id):
+        self._epoch += 1
+        self._forgotten[guild_id] = self._epoch
+        self._changed.pop(guild_id, None)
+        self._entries.pop(guild_id, None)
+        self._vectors.pop(guild_id, None)
+
+    def clear(self):
+        """Drop every answer, e.g. when query embeddings change model."""
+        self._epoch += 1
+        self._cleared = self._epoch
+        self._entries.clear()
+        self._vectors.clear()
+
+    def _expire(self, guild_id):
+        entries = self._entries.get(guild_id)
+        # entries are in insertion order, so only the head can be stale
+        if entries and time.time() - entries[0].created > self.ttl:
+            deadline = time.time() - self.ttl
+            self._keep(guild_id, [entry.created >= deadline for entry in entries])
+
+    def _keep(self, guild_id, mask):
+        if all(mask):
+            return
+        self._entries[guild_id] = [entry for entry, keep in zip(self._entries[guild_id], mask) if keep]
+        self._vectors[guild_id] = self._vectors[guild_id][np.array(mask, dtype=bool)]
+
+
+def _depends_on(entry, channel_id):
+    channels = entry.channels or entry.scope
+    return not channels or channel_id in channels
+
+
+def _unit(embedding):
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
@@ -0,0 +1,167 @@
+"""Bulk ingestion of the history channels had before RAgent was listening.
+
+Channels are paged oldest first through ``channel.history()`` (discord.py
+sleeps through Discord's rate limits), several channels at a time. Each page
+is remembered in one batch and handed to the ingest pipeline, which embeds
+and upserts in bulk. The last ingested message of every channel is
+checkpointed after each page, so an interrupted backfill resumes where it
+stopped instead of starting over.
+"""
+import asyncio
+import json
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+
+import discord
+
+import settings
+from rag import index_message, flush_windows
+from windows import WindowBuilder
+
+
+logger = settings.logging.getLogger("bot")
+
+PAGE_SIZE = 100  # the most Discord returns per history request
+
+# channels with a backfill in progress, so two runs never page the same one
+_running: set[int] = set()
+
+
+class Checkpoints:
+    """``channel_id -> {"guild_id", "after": last message id, "before": iso time, "done"}``"""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._state = {}
+        if self.path.is_file():
+            with open(self.path, "r", encoding="utf-8") as file:
+                self._state = json.load(file)
+
+    def get(self, channel_id):
+        return self._state.get(str(channel_id), {})
+
+    def update(self, channel_id, **fields):
+        self._state.setdefault(str(channel_id), {}).update(fields)
+        self._save()
+
+    def forget(self, guild_id):
+        for channel_id in [key for key, state in self._state.items() if state.get("guild_id") == guild_id]:
+            del self._state[channel_id]
+        self._save()
+
+    def _save(self):
+        tmp_path = self.path.with_suffix(".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(self._state, file)
+        tmp_path.replace(self.path)
+
+
+@dataclass
+class ChannelProgress:
+    name: str
+    count: int = 0
+    done: bool = False
+    error: str = ""
+
+
+class Backfill:
+    def __init__(self, guild_id, channels, remember, checkpoints, before=None, process=None,
+                 concurrency=None):
+        """``remember(guild_id, channel, messages)`` persists a page of messages,
+        ``process(message)`` prepares one the way ``on_message`` does, and
+        ``before`` maps channel ids to the time history is already known from."""
+        self.guild_id = guild_id
+        self.channels = channels
+        self.remember = remember
+        self.process = process
+        self.checkpoints = checkpoints
+        self.before = before or {}
+        self._semaphore = asyncio.Semaphore(concurrency or settings.BACKFILL_CONCURRENCY)
+        self.progress = {channel.id: ChannelProgress(str(channel)) for channel in channels}
+        self.started = time.monotonic()
+
+    @property
+    def total(self):
+        return sum(progress.count for progress in self.progress.values())
+
+    def report(self):
+        elapsed = time.monotonic() - self.started
+        lines = [
+            f"#{progress.name}: {progress.count:,} messages"
+            + (" ✅" if progress.done else "")
+            + (f" ❌ {progress.error}" if progress.error else "")
+            for progress in self.progress.values()
+        ]
+        lines.append(f"{self.total:,} messages in {elapsed:.0f}s ({self.total / max(elapsed, 1e-9):,.0f}/s)")
+        return "\n".join(lines)
+
+    async def run(self):
+        await asyncio.gather(*(self._run_channel(channel) for channel in self.channels))
+
+    async def _run_channel(self, channel):
+        progress = self.progress[channel.id]
+        if channel.id in _running:
+            progress.error = "already being backfilled"
+            return
+        _running.add(channel.id)
+        try:
+            async with self._semaphore:
+                await self._page(channel, progress)
+        except discord.HTTPException as err:
+            progress.error = err.text or str(err.status)
+            logger.warning(f"Backfilling #{channel} failed: {err}")
+        finally:
+            _running.discard(channel.id)
+
+    async def _page(self, channel, progress):
+        state = self.checkpoints.get(channel.id)
+        if state.get("done"):
+            progress.done = True
+            return
+        if "before" not in state:
+            # only what came before the messages RAgent already has
+            before = self.before.get(channel.id)
+            state = {"guild_id": self.guild_id, "before": before.isoformat() if before else None}
+            self.checkpoints.update(channel.id, **state)
+        before = datetime.fromisoformat(state["before"]) if state["before"] else None
+        after = discord.Object(id=state["after"]) if state.get("after") else None
+
+        # a window builder of its own, so old history never mixes into the
+        # windows of live conversations
+        builder = WindowBuilder() if settings.INGEST_WINDOWS else None
+        page = []
+        try:
+            async for message in channel.history(limit=None, before=before, after=after, oldest_first=True):
+                page.append(message)
+                if len(page) == PAGE_SIZE:
+                    await self._ingest(channel, page, builder, progress)
+                    page = []
+            if page:
+                await self._ingest(channel, page, builder, progress)
+        finally:
+            # nothing was checkpointed past the open window, but its messages
+            # are indexed anyway rather than lost until a retry
+            await flush_windows(builder=builder)
+        self.checkpoints.update(channel.id, done=True)
+        progress.done = True
+
+    async def _ingest(self, channel, page, builder, progress):
+        messages = [
+            message for message in page
+            if message.content and message.type in (discord.MessageType.default, discord.MessageType.reply)
+        ]
+        if self.process is not None:
+            messages = [self.process(message) for message in messages]
+        if messages:
+            self.remember(self.guild_id, channel, messages)
+        for message in messages:
+            await index_message(
+                message.created_at, message.author, message.content, self.guild_id, channel, builder,
+                message_id=message.id)
+        # the checkpoint says everything up to it is indexed, so the page's
+        # last window cannot stay open across it (a crash would lose it)
+        await flush_windows(builder=builder)
+        self.checkpoints.update(channel.id, after=page[-1].id)
+        progress.count += len(messages)
@@ -0,0 +1,362 @@
+"""End-to-end throughput and latency of the bot, without Discord, Qdrant Cloud
+or a paid model.
+
+Synthetic guilds, channels and users drive the real ``on_message`` and
+``/rag`` handlers of ``discord_bot`` through stand-in Discord objects, on top
+of an in-process Qdrant (``:memory:`` or ``--qdrant-path``) and the
+deterministic models of ``mock_models`` with simulated latencies. History
+grows in steps up to each ``--scales`` size; after every step it reports:
+
+- ingest throughput: messages/s until they are embedded and upserted
+- ``/rag`` p50/p95/p99 over ``--queries`` questions
+- event-loop lag (how late a 10ms timer fires) while ingesting and answering
+- resident memory and its growth since the start
+
+    python benchmarks/end_to_end.py                              # 1k .. 1M
+    python benchmarks/end_to_end.py --scales 1000,10000 --json out.json
+    python benchmarks/end_to_end.py --llm-latency 2 --embed-latency 0.2
+
+Everything runs in a temporary working directory (message store, caches,
+keyword index), so the real ``.persist`` is never touched. Local-mode Qdrant
+searches by brute force on the event loop, so at large scales ``/rag``
+latency and loop lag include work a Qdrant server would do elsewhere;
+compare runs with each other rather than with production.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+
+import discord
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+# ---- stand-in Discord objects ------------------------------------------------
+
+_ids = iter(range(10 ** 15, 10 ** 16))
+
+
+class FakeUser:
+    def __init__(self, name, bot=False):
+        self.id = next(_ids)
+        self.name = name
+        self.bot = bot
+
+    def __str__(self):
+        return self.name
+
+    def mentioned_in(self, message):
+        return self in message.mentions
+
+
+class FakeMessage:
+    _state = None
+
+    def __init__(self, content, author, channel, created_at=None, mentions=()):
+        self.id = next(_ids)
+        self.content = content
+        self.author = author
+        self.channel = channel
+        self.guild = channel.guild
+        self.created_at = created_at or datetime.now(timezone.utc)
+        self.mentions = list(mentions)
+        self.attachments = []
+        self.type = discord.MessageType.default
+
+    async def edit(self, content=None):
+        self.content = content
+        return self
+
+    async def reply(self, content):
+        return await self.channel.send(content)
+
+
+class FakeChannel:
+    def __init__(self, guild, name):
+        self.id = next(_ids)
+        self.guild = guild
+        self.name = name
+        self.type = discord.ChannelType.text
+        self.sent = 0
+
+    def __str__(self):
+        return self.name
+
+    async def send(self, content):
+        self.sent += 1
+        return FakeMessage(content, None, self)
+
+    @asynccontextmanager
+    async def typing(self):
+        yield
+
+
+class FakeGuild:
+    def __init__(self, name, channels):
+        self.id = next(_ids)
+        self.name = name
+        self.channels = [FakeChannel(self, f"channel-{i}") for i in range(channels)]
+        self.text_channels = self.channels
+        self.threads = []
+
+    def get_channel_or_thread(self, channel_id):
+        return next((channel for channel in self.channels if channel.id == channel_id), None)
+
+
+class FakeResponse:
+    def __init__(self, interaction):
+        self._interaction = interaction
+        self._done = False
+
+    def is_done(self):
+        return self._done
+
+    async def defer(self, **kwargs):
+        self._done = True
+
+    async def send_message(self, content=None, **kwargs):
+        self._done = True
+        return await self._interaction.channel.send(content)
+
+
+class FakeFollowup:
+    def __init__(self, interaction):
+        self._interaction = interaction
+
+    async def send(self, content=None, wait=False, **kwargs):
+        return await self._interaction.channel.send(content)
+
+
+class FakeInteraction(discord.Interaction):
+    # shadow the properties discord.py computes from gateway state
+    guild = response = followup = None
+
+    def __init__(self, user, channel):
+        self.id = discord.utils.time_snowflake(datetime.now(timezone.utc))
+        self.user = user
+        self.channel = channel
+        self.guild = channel.guild
+        self.guild_id = channel.guild.id
+        self.response = FakeResponse(self)
+        self.followup = FakeFollowup(self)
+
+
+# ---- synthetic chat --------------------------------------------------------------
+
+
+class ChatGenerator:
+    """Reproducible messages: Zipf-distributed words, bursts of conversation
+    separated by silences long enough to close windows, and the odd error code."""
+
+    def __init__(self, guilds, seed=0, vocabulary=5000):
+        self.guilds = guilds
+        self.rng = random.Random(seed)
+        self.words = [f"w{i}" for i in range(vocabulary)]
+        weights = 1 / np.arange(1, vocabulary + 1)
+        self.weights = (weights / weights.sum()).tolist()
+        self.users = {guild.id: [FakeUser(f"user{i}") for i in range(20)] for guild in guilds}
+        self.clock = {channel.id: datetime(2024, 1, 1, tzinfo=timezone.utc)
+                      for guild in guilds for channel in guild.channels}
+
+    def text(self, low=4, high=24):
+        words = self.rng.choices(self.words, self.weights, k=self.rng.randint(low, high))
+        if self.rng.random() < 0.02:
+            words.append(f"ERR_{self.rng.randint(100, 999)}")
+        return " ".join(words)
+
+    def message(self):
+        guild = self.rng.choice(self.guilds)
+        channel = self.rng.choice(guild.channels)
+        gap = 3600 if self.rng.random() < 0.05 else self.rng.expovariate(1 / 30)
+        self.clock[channel.id] += timedelta(seconds=gap)
+        author = self.rng.choice(self.users[guild.id])
+        return FakeMessage(self.text(), author, channel, self.clock[channel.id])
+
+    def question(self):
+        guild = self.rng.choice(self.guilds)
+        channel = self.rng.choice(guild.channels)
+        return self.rng.choice(self.users[guild.id]), channel, "what did people say about " + self.text(2, 5)
+
+
+# ---- measurements -----------------------------------------------------------------
+
+
+class LoopLag:
+    """How late a periodic timer fires, i.e. how long the loop was blocked."""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.samples = []
+        self._task = None
+
+    async def _run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.samples.append(time.perf_counter() - started - self.interval)
+
+    def start(self):
+        self.samples = []
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        samples = np.array(self.samples or [0.0])
+        return {"p99_ms": float(np.quantile(samples, 0.99) * 1000), "max_ms": float(samples.max() * 1000)}
+
+
+def rss_mb():
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except OSError:
+        # peak, not current, where /proc is missing (macOS reports bytes)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 2 ** 20 if sys.platform == "darwin" else peak / 1024
+
+
+def percentiles(samples):
+    samples = np.array(samples)
+    return {f"p{int(q * 100)}_ms": float(np.quantile(samples, q) * 1000) for q in (0.5, 0.95, 0.99)}
+
+
+async def ingest(bot_module, generator, count, burst):
+    """Dispatch ``count`` messages like the gateway does (one task per event,
+    ``burst`` at a time) and wait until all of them are in Qdrant."""
+    started = time.perf_counter()
+    for offset in range(0, count, burst):
+        batch = [generator.message() for _ in range(min(burst, count - offset))]
+        await asyncio.gather(*(bot_module.on_message(message) for message in batch))
+    dispatched = time.perf_counter() - started
+    # close the open windows and drain the ingest queue
+    await bot_module.flush_windows()
+    await bot_module.ingestor.stop()
+    bot_module.ingestor.start()
+    return dispatched, time.perf_counter() - started
+
+
+async def ask(bot_module, generator, count, concurrency):
+    rag_command = bot_module.tree.get_command("rag")
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one():
+        user, channel, query = generator.question()
+        async with semaphore:
+            started = time.perf_counter()
+            await rag_command.callback(FakeInteraction(user, channel), query)
+            latencies.append(time.perf_counter() - started)
+
+    await asyncio.gather(*(one() for _ in range(count)))
+    return latencies
+
+
+async def run(args):
+    import discord_bot
+
+    # the stand-in for the logged-in bot user
+    discord_bot.bot._connection.user = FakeUser("RAgent", bot=True)
+    await discord_bot.bot.setup_hook()
+
+    guilds = [FakeGuild(f"guild-{i}", args.channels) for i in range(args.guilds)]
+    for guild in guilds:
+        discord_bot.listening[guild.id] = True
+    generator = ChatGenerator(guilds, seed=args.seed)
+    lag = LoopLag()
+
+    results = []
+    baseline = rss_mb()
+    ingested = 0
+    print(f"{'messages':>10} {'ingest/s':>10} {'rag p50':>9} {'p95':>9} {'p99':>9} "
+          f"{'lag p99':>9} {'lag max':>9} {'rss MB':>9} {'growth':>9}", flush=True)
+    for scale in args.scales:
+        lag.start()
+        dispatched, total = await ingest(discord_bot, generator, scale - ingested, args.burst)
+        ingest_lag = await lag.stop()
+        new = scale - ingested
+        ingested = scale
+
+        lag.start()
+        latencies = await ask(discord_bot, generator, args.queries, args.concurrency)
+        rag_lag = await lag.stop()
+
+        rss = rss_mb()
+        result = {
+            "messages": scale,
+            "ingest_per_second": new / total,
+            "dispatch_per_second": new / dispatched,
+            "rag": percentiles(latencies),
+            "ingest_loop_lag": ingest_lag,
+            "rag_loop_lag": rag_lag,
+            "rss_mb": rss,
+            "rss_growth_mb": rss - baseline,
+        }
+        results.append(result)
+        print(f"{scale:>10,} {result['ingest_per_second']:>10,.0f} "
+              f"{result['rag']['p50_ms']:>9,.0f} {result['rag']['p95_ms']:>9,.0f} {result['rag']['p99_ms']:>9,.0f} "
+              f"{max(ingest_lag['p99_ms'], rag_lag['p99_ms']):>9,.1f} "
+              f"{max(ingest_lag['max_ms'], rag_lag['max_ms']):>9,.1f} "
+              f"{rss:>9,.0f} {rss - baseline:>9,.0f}", flush=True)
+
+    await discord_bot.bot.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Hermetic end-to-end benchmark of RAgent.")
+    parser.add_argument("--scales", default="1000,10000,100000,1000000",
+                        help="comma separated history sizes to measure at")
+    parser.add_argument("--guilds", type=int, default=10)
+    parser.add_argument("--channels", type=int, default=5, help="channels per guild")
+    parser.add_argument("--burst", type=int, default=100, help="messages dispatched at once")
+    parser.add_argument("--queries", type=int, default=200, help="/rag questions per step")
+    parser.add_argument("--concurrency", type=int, default=8, help="/rag questions in flight")
+    parser.add_argument("--embed-latency", type=float, default=0.05, help="seconds per embedding call")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="seconds to the first token")
+    parser.add_argument("--token-latency", type=float, default=0.01, help="seconds between tokens")
+    parser.add_argument("--qdrant-path", default=":memory:", help="':memory:' or a directory")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+    args.scales = sorted(int(scale) for scale in args.scales.split(","))
+
+    if args.json:
+        args.json = os.path.abspath(args.json)
+    workdir = tempfile.mkdtemp(prefix="ragent-bench-")
+    # read by settings when discord_bot is imported
+    os.environ.update(
+        USE_MOCK="1",
+        QDRANT_PATH=args.qdrant_path,
+        QDRANT_COLLECTION="bench",
+        QDRANT_IMAGE_COLLECTION="bench_images",
+        MOCK_EMBED_LATENCY=str(args.embed_latency),
+        MOCK_LLM_LATENCY=str(args.llm_latency),
+        MOCK_LLM_TOKEN_LATENCY=str(args.token_latency),
+        METRICS_PORT="0",
+        STREAM_EDIT_INTERVAL="0",
+    )
+    os.chdir(workdir)
+    import settings
+    # a log line per remembered message would dominate the measurement
+    settings.logging.getLogger("bot").setLevel("WARNING")
+    print(f"Working directory: {workdir}", flush=True)
+
+    results = asyncio.run(run(args))
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
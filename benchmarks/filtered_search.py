@@ -0,0 +1,112 @@
+"""Filtered top-k latency as the number of guilds sharing a collection grows.
+
+Every guild gets the same number of points, so with the tenant-aware layout
+from ``qdrant_schema`` the latency of a ``guild_id``-filtered search should
+stay flat while the collection grows with the guild count.
+
+    python benchmarks/filtered_search.py                       # in-memory
+    python benchmarks/filtered_search.py --path /tmp/qdrant    # on-disk local
+    python benchmarks/filtered_search.py --url http://localhost:6333
+
+Local mode (in-memory or ``--path``) has no HNSW or payload indexes and scans
+every point, so it checks the harness and the layout calls; the flat curve
+shows up against a Qdrant server.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+import numpy as np
+from qdrant_client import AsyncQdrantClient
+from qdrant_client.http import models as rest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from qdrant_schema import CollectionLayout, ensure_collection  # noqa: E402
+
+
+COLLECTION = "bench_filtered_search"
+
+
+def make_client(args):
+    if args.url:
+        return AsyncQdrantClient(url=args.url, api_key=args.api_key)
+    if args.path:
+        return AsyncQdrantClient(path=args.path)
+    return AsyncQdrantClient(location=":memory:")
+
+
+async def fill(client, rng, guilds, per_guild, dim, batch=1000):
+    now = int(time.time())
+    total = guilds * per_guild
+    for start in range(0, total, batch):
+        ids = range(start, min(start + batch, total))
+        vectors = rng.standard_normal((len(ids), dim), dtype=np.float32)
+        await client.upsert(
+            collection_name=COLLECTION,
+            points=rest.Batch(
+                ids=list(ids),
+                vectors=vectors.tolist(),
+                payloads=[{
+                    "guild_id": i % guilds,
+                    "channel_id": (i % guilds) * 10 + i % 7,
+                    "author": f"user{i % 50}",
+                    "posted_ts": now - i,
+                } for i in ids]),
+            wait=True)
+
+
+async def wait_indexed(client):
+    while (await client.get_collection(COLLECTION)).status != rest.CollectionStatus.GREEN:
+        await asyncio.sleep(0.5)
+
+
+async def measure(client, rng, guilds, dim, queries, top_k):
+    latencies = []
+    for _ in range(queries):
+        guild_id = int(rng.integers(guilds))
+        vector = rng.standard_normal(dim, dtype=np.float32).tolist()
+        started = time.perf_counter()
+        await client.search(
+            collection_name=COLLECTION,
+            query_vector=vector,
+            query_filter=rest.Filter(must=[
+                rest.FieldCondition(key="guild_id", match=rest.MatchValue(value=guild_id))]),
+            limit=top_k)
+        latencies.append(time.perf_counter() - started)
+    return np.percentile(np.array(latencies) * 1000, [50, 95, 99])
+
+
+async def main(args):
+    rng = np.random.default_rng(args.seed)
+    client = make_client(args)
+    layout = CollectionLayout(on_disk=args.on_disk, quantization=args.quantization)
+    print(f"{'guilds':>8} {'points':>10} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for guilds in args.guilds:
+        if await client.collection_exists(COLLECTION):
+            await client.delete_collection(COLLECTION)
+        await ensure_collection(client, COLLECTION, args.dim, layout)
+        await fill(client, rng, guilds, args.per_guild, args.dim)
+        await wait_indexed(client)
+        p50, p95, p99 = await measure(client, rng, guilds, args.dim, args.queries, args.top_k)
+        print(f"{guilds:>8} {guilds * args.per_guild:>10} {p50:>8.2f} {p95:>8.2f} {p99:>8.2f}")
+    await client.delete_collection(COLLECTION)
+    await client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", help="Qdrant server, instead of a local instance")
+    parser.add_argument("--api-key")
+    parser.add_argument("--path", help="on-disk local Qdrant directory")
+    parser.add_argument("--guilds", type=int, nargs="+", default=[1, 10, 100])
+    parser.add_argument("--per-guild", type=int, default=1000, help="points per guild")
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=8)
+    parser.add_argument("--on-disk", action="store_true")
+    parser.add_argument("--quantization", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,66 @@
+"""Resolution of ``#channel`` references in questions to channel ids."""
+import re
+
+
+# what Discord sends for a channel picked from the # autocomplete
+CHANNEL_MENTION = re.compile(r"<#(\d+)>")
+# a channel typed out by name
+CHANNEL_NAME = re.compile(r"(?<![\w<&])#([\w-]+)")
+
+
+class ChannelDirectory:
+    """Per-guild channel name -> ids maps.
+
+    A map is built from discord.py's channel cache the first time a guild
+    asks, and dropped when one of its channels or threads changes. A
+    channel's threads resolve with it, since their messages are stored
+    under the thread's id.
+    """
+
+    def __init__(self):
+        # guild_id -> (name -> channel ids, channel id -> its thread ids)
+        self._guilds: dict[int, tuple[dict[str, list[int]], dict[int, list[int]]]] = {}
+
+    def _maps(self, guild):
+        maps = self._guilds.get(guild.id)
+        if maps is None:
+            names, threads = {}, {}
+            for channel in guild.channels:
+                names.setdefault(channel.name.lower(), []).append(channel.id)
+            for thread in guild.threads:
+                names.setdefault(thread.name.lower(), []).append(thread.id)
+                threads.setdefault(thread.parent_id, []).append(thread.id)
+            maps = self._guilds[guild.id] = (names, threads)
+        return maps
+
+    def invalidate(self, guild_id):
+        self._guilds.pop(guild_id, None)
+
+    def resolve(self, guild, query):
+        """Channel ids ``query`` refers to, and the query with mentions as ``#name``.
+
+        Unknown ``#words`` (issue numbers, hashtags) are left alone.
+        """
+        names, _ = self._maps(guild)
+        ids = []
+
+        def mention(match):
+            channel = guild.get_channel_or_thread(int(match.group(1)))
+            if channel is None:
+                return match.group(0)
+            ids.append(channel.id)
+            return f"#{channel.name}"
+
+        query = CHANNEL_MENTION.sub(mention, query)
+        for match in CHANNEL_NAME.finditer(query):
+            ids.extend(names.get(match.group(1).lower(), []))
+        return self.with_threads(guild, ids), query
+
+    def with_threads(self, guild, channel_ids):
+        """``channel_ids`` plus the threads under them, without duplicates."""
+        _, threads = self._maps(guild)
+        ids = []
+        for channel_id in channel_ids:
+            ids.append(channel_id)
+            ids.extend(threads.get(channel_id, []))
+        return list(dict.fromkeys(ids))
@@ -0,0 +1,41 @@
+"""Concurrency limits for answering questions."""
+import asyncio
+from contextlib import asynccontextmanager
+
+
+class QueryLimiter:
+    """Caps in-flight answers globally and per guild.
+
+    A guild waits for its own slot before taking a global one, so a busy
+    guild queues behind itself instead of holding global capacity while it
+    waits.
+    """
+
+    def __init__(self, global_limit, per_guild_limit):
+        self.per_guild_limit = per_guild_limit
+        self._global = asyncio.Semaphore(global_limit)
+        self._guilds: dict[int, asyncio.Semaphore] = {}
+        self.in_flight = 0
+        self.waiting = 0
+
+    @asynccontextmanager
+    async def slot(self, guild_id):
+        guild = self._guilds.get(guild_id)
+        if guild is None:
+            guild = self._guilds[guild_id] = asyncio.Semaphore(self.per_guild_limit)
+        self.waiting += 1
+        waiting = True
+        try:
+            async with guild:
+                async with self._global:
+                    self.waiting -= 1
+                    waiting = False
+                    self.in_flight += 1
+                    try:
+                        yield
+                    finally:
+                        self.in_flight -= 1
+        finally:
+            # cancelled before getting a slot
+            if waiting:
+                self.waiting -= 1
@@ -0,0 +1,118 @@
+"""Content-addressed storage for image attachments.
+
+Every image is stored once under its SHA-256, next to a downscaled JPEG
+variant that is what gets embedded and sent to the LLM. Messages and
+Qdrant payloads only carry a reference of the form ``image:<sha256>.<ext>``,
+so a meme reposted a hundred times costs one file on disk.
+"""
+import base64
+import os
+import threading
+from dataclasses import dataclass
+
+import settings
+
+
+logger = settings.logging.getLogger("bot")
+
+REF_PREFIX = "image:"
+
+
+@dataclass
+class StoredImage:
+    sha256: str
+    ext: str
+    path: str
+    thumb_path: str
+
+    @property
+    def ref(self):
+        return f"{REF_PREFIX}{self.sha256}.{self.ext}"
+
+
+def is_ref(value):
+    return value.startswith(REF_PREFIX)
+
+
+def parse_ref(ref):
+    sha256, _, ext = ref[len(REF_PREFIX):].partition(".")
+    return sha256, ext
+
+
+class ImageStore:
+    def __init__(self, root):
+        self.root = root
+        self.incoming = os.path.join(root, "incoming")
+        # add() and remove() run in different threads; checking for an image
+        # and moving one into or out of place must not interleave
+        self._lock = threading.Lock()
+        os.makedirs(self.incoming, exist_ok=True)
+
+    def path(self, sha256, ext):
+        return os.path.join(self.root, sha256[:2], f"{sha256}.{ext}")
+
+    def thumb_path(self, sha256):
+        return os.path.join(self.root, sha256[:2], f"{sha256}.thumb.jpg")
+
+    def has(self, sha256):
+        return os.path.exists(self.thumb_path(sha256))
+
+    def _stored_ext(self, sha256):
+        for name in os.listdir(os.path.dirname(self.thumb_path(sha256))):
+            if name.startswith(sha256) and not name.endswith(".thumb.jpg"):
+                return name.rpartition(".")[2]
+        return None
+
+    def add(self, downloaded, processed=None):
+        """Move a downloaded file into place, deduplicating by content.
+
+        ``processed`` (see ``image_proc.process_image``) is only needed the
+        first time a given image is seen. Without it, returns ``None`` when
+        the image is not stored (or was removed since ``has()`` said it
+        was), and the caller should process the file and try again.
+        """
+        sha256 = downloaded.sha256
+        with self._lock:
+            if self.has(sha256):
+                os.remove(downloaded.path)
+                ext = self._stored_ext(sha256) or downloaded.subtype
+                return StoredImage(sha256, ext, self.path(sha256, ext), self.thumb_path(sha256))
+            if processed is None:
+                return None
+            ext = processed.format
+            stored = StoredImage(sha256, ext, self.path(sha256, ext), self.thumb_path(sha256))
+            os.makedirs(os.path.dirname(stored.path), exist_ok=True)
+            os.replace(downloaded.path, stored.path)
+            # the thumbnail is written last, so has() implies both files exist
+            _write_atomic(stored.thumb_path, processed.thumb)
+            return stored
+
+    def discard(self, downloaded):
+        if os.path.exists(downloaded.path):
+            os.remove(downloaded.path)
+
+    def remove(self, ref):
+        """Delete the files of an image no message refers to any more."""
+        if not is_ref(ref):
+            return
+        sha256, ext = parse_ref(ref)
+        with self._lock:
+            for path in (self.thumb_path(sha256), self.path(sha256, ext)):
+                # the thumbnail goes first, so has() never sees half an image
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def data_url(self, ref):
+        """The downscaled variant of ``ref`` as a data URL for the LLM."""
+        if not is_ref(ref):
+            return ref  # messages remembered before the image store
+        sha256, _ = parse_ref(ref)
+        with open(self.thumb_path(sha256), "rb") as file:
+            return f"data:image/jpeg;base64,{base64.b64encode(file.read()).decode('utf-8')}"
+
+
+def _write_atomic(path, data):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as file:
+        file.write(data)
+    os.replace(tmp_path, path)
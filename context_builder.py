@@ -0,0 +1,149 @@
+"""Token-budgeted chat history for mention replies.
+
+The newest turns of a channel are packed into a fixed token budget. Turns
+that no longer fit are folded, in batches and in the background, into a
+rolling per-channel summary that is sent ahead of the turns, so every reply
+sends a bounded prompt no matter how old the channel is.
+"""
+import asyncio
+import json
+from functools import lru_cache
+from pathlib import Path
+
+from llama_index.core.base.llms.types import ChatMessage, MessageRole
+
+import settings
+from prompts import summary_prompt
+from scheduler import BACKGROUND, run_as
+
+
+logger = settings.logging.getLogger("bot")
+
+SYSTEM_PROMPT = "You are a helpful assistant. Your name is RAgent."
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("cl100k_base")
+except Exception:  # tiktoken missing or its BPE file cannot be fetched
+    _encoding = None
+
+
+@lru_cache(maxsize=100_000)
+def count_tokens(text: str) -> int:
+    if _encoding is None:
+        return len(text) // 4 + 1
+    return len(_encoding.encode(text, disallowed_special=()))
+
+
+def _render(msg):
+    return f"@{msg.author}: {msg.just_msg}" if not msg.is_image else f"@{msg.author} posted an image"
+
+
+class ContextBuilder:
+    def __init__(self, llm, image_url, summaries_path, budget=None):
+        self.llm = llm
+        self.image_url = image_url
+        self.budget = budget or settings.CHAT_CONTEXT_TOKENS
+        self.summaries_path = Path(summaries_path)
+        # (guild_id, channel_id) -> {"text": ..., "until": epoch of last folded message}
+        self._summaries: dict[tuple[int, int], dict] = {}
+        self._folding: set[tuple[int, int]] = set()
+        # the running folds, referenced so they are not garbage collected
+        self._tasks: set[asyncio.Task] = set()
+        if self.summaries_path.is_file():
+            with open(self.summaries_path, "r", encoding="utf-8") as file:
+                for key, summary in json.load(file).items():
+                    guild_id, channel_id = map(int, key.split(":"))
+                    self._summaries[(guild_id, channel_id)] = summary
+
+    def _turn(self, msg, bot_name, with_image):
+        role = MessageRole.ASSISTANT if msg.author == bot_name else MessageRole.USER
+        if not msg.is_image:
+            return ChatMessage(role=role, content=msg.just_msg)
+        if with_image:
+            return ChatMessage(role=role, content=[{"type": "image_url", "image_url": {"url": self.image_url(msg.just_msg)}}])
+        # older images only keep a reference to what was posted
+        return ChatMessage(role=role, content=f"[@{msg.author} posted an image: {msg.just_msg}]")
+
+    def _cost(self, msg, with_image):
+        if msg.is_image and with_image:
+            return settings.CHAT_IMAGE_TOKENS
+        return count_tokens(msg.just_msg) + 4  # role/message framing
+
+    def build(self, guild_id, channel_id, msgs, bot_name):
+        """Chat messages for the newest turns of ``msgs`` that fit the budget."""
+        key = (guild_id, channel_id)
+        summary = self._summaries.get(key)
+        budget = self.budget - count_tokens(SYSTEM_PROMPT)
+        if summary:
+            budget -= count_tokens(summary["text"])
+
+        turns = []
+        images_left = settings.CHAT_CONTEXT_IMAGES
+        msgs = list(msgs)
+        cut = 0
+        for i in range(len(msgs) - 1, -1, -1):
+            msg = msgs[i]
+            with_image = msg.is_image and images_left > 0
+            cost = self._cost(msg, with_image)
+            if cost > budget:
+                cut = i + 1
+                break
+            budget -= cost
+            images_left -= with_image
+            turns.append(self._turn(msg, bot_name, with_image))
+        turns.reverse()
+
+        history = [ChatMessage(role=MessageRole.SYSTEM, content=SYSTEM_PROMPT)]
+        if summary:
+            history.append(ChatMessage(
+                role=MessageRole.SYSTEM,
+                content=f"Summary of the earlier conversation in this channel:\n{summary['text']}"))
+        history.extend(turns)
+
+        until = summary["until"] if summary else 0
+        overflow = [msg for msg in msgs[:cut] if msg.posted_at.timestamp() > until]
+        if overflow and key not in self._folding and \
+                sum(count_tokens(_render(msg)) for msg in overflow) >= settings.CHAT_SUMMARY_BATCH_TOKENS:
+            self._folding.add(key)
+            # rendered now: the messages may be views, which go stale once
+            # the history changes
+            task = asyncio.create_task(self._fold(
+                key, [_render(msg) for msg in overflow], overflow[-1].posted_at.timestamp()))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        return history
+
+    async def _fold(self, key, lines, until):
+        """Fold rendered message ``lines`` (posted up to ``until``) into the
+        channel's rolling summary."""
+        # the reply that triggered this goes first
+        run_as(BACKGROUND, key[0])
+        try:
+            previous = self._summaries.get(key, {}).get("text", "")
+            response = await self.llm.acomplete(summary_prompt.format(
+                summary=previous or "(none yet)",
+                messages="\n".join(lines),
+                max_words=settings.CHAT_SUMMARY_WORDS))
+            self._summaries[key] = {
+                "text": response.text.strip(),
+                "until": until,
+            }
+            self._persist()
+        except Exception as err:
+            logger.warning(f"Summarizing channel {key[1]} failed: {err}")
+        finally:
+            self._folding.discard(key)
+
+    def _persist(self):
+        data = {f"{guild_id}:{channel_id}": summary
+                for (guild_id, channel_id), summary in self._summaries.items()}
+        tmp_path = self.summaries_path.with_suffix(".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(data, file)
+        tmp_path.replace(self.summaries_path)
+
+    def forget(self, guild_id):
+        for key in [key for key in self._summaries if key[0] == guild_id]:
+            del self._summaries[key]
+        self._persist()
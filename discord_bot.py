@@ -1,173 +1,106 @@
+import asyncio
 import discord
 import traceback
+from discord import app_commands
 from discord.ext import commands
-from datetime import datetime
+from datetime import datetime, timezone
 import pickle
 from pathlib import Path
-import re
-import base64
 
 import settings
 from models import Message
-from rag import index_message, answer_query, qd_collection, chat_repl, qd_client, download_and_create_images, index_images
+from message_store import MessageStore, migrate_pickle
+from history import MessageHistory, format_message_str
+from channels import ChannelDirectory
+from backfill import Backfill, Checkpoints
+from retention import Compactor, RetentionPolicies, RetentionPolicy
+from streaming import DiscordStreamer, split_message
+from metrics import metrics, serve as serve_metrics
+from rag import llm, index_message, answer_query, answer_query_stream, chat_repl, chat_repl_stream, download_and_create_images, index_images, ingestor, embed_cache, image_downloader, image_processor, flush_windows, bootstrap_collections, follow_text_collection, keyword_index, rewrite_messages, forget_guild, image_files
 
 
 logger = settings.logging.getLogger("bot")
 
+def replace_mentions(content, users):
+    """Replace the ``<@id>`` of ``(id, name)`` users with their handle."""
+    for user_id, name in users:
+        content = content.replace(f'<@{user_id}>', f'@{name}')
+    return content
+
+
 def process_incoming_message(message):
     """Replace user id with handle for mentions."""
-    content = message.content
-    for user in message.mentions:
-        mention_str = f'<@{user.id}>'
-        content = content.replace(mention_str, f'@{user.name}')
-    message.content = content
+    message.content = replace_mentions(message.content, [(user.id, user.name) for user in message.mentions])
     return message
 
 
-def remember_message(when, who, msg_content, guild_id, channel):
+def make_message(when, who, msg_content, channel, message_id=None):
+    msg_str = format_message_str(when, who, str(channel)[:15], msg_content)
+    return Message(is_in_thread=str(channel.type) == 'public_thread',
+                   posted_at=when,
+                   author=str(who),
+                   message_str=msg_str,
+                   channel_id=channel.id,
+                   just_msg=msg_content,
+                   message_id=message_id)
+
+def remember_message(when, who, msg_content, guild_id, channel, message_id=None):
     logger.info(
         f"Remembering new message \"{msg_content}\" from {who} on channel "
         f"{channel.name} at {datetime.now().strftime('%m-%d-%Y %H:%M:%S')}"
     )
-    msg_str = f"[{when.strftime('%m-%d-%Y %H:%M:%S')}] - @{who} on #[{str(channel)[:15]}]: `{msg_content}`"
-    global messages
-    if not messages.get(guild_id, None):
-        messages[guild_id] = []
-    messages[guild_id].append(
-        Message(is_in_thread=str(channel.type) == 'public_thread',
-                posted_at=when,
-                author=str(who),
-                message_str=msg_str,
-                channel_id=channel.id,
-                just_msg=msg_content))
-    persist_messages()
-
-def encode_image(image_path):
-  with open(image_path, "rb") as image_file:
-    return base64.b64encode(image_file.read()).decode('utf-8')
-      
-def remember_images(when, who, documents_url, guild_id, channel):
+    msg = make_message(when, who, msg_content, channel, message_id)
+    history.add(guild_id, msg)
+    message_store.append(guild_id, msg)
+
+def remember_history(guild_id, channel, messages):
+    """Remember a page of backfilled messages in one batch."""
+    msgs = [make_message(m.created_at, m.author, m.content, channel, m.id) for m in messages]
+    history.extend(guild_id, msgs)
+    message_store.extend(guild_id, msgs)
+
+def remember_images(when, who, images, guild_id, channel, message_id=None):
     logger.info(
         f"Remembering new images from {who} on channel "
         f"{channel.name} at {datetime.now().strftime('%m-%d-%Y %H:%M:%S')}"
     )
     #msg_str = f"[{when.strftime('%m-%d-%Y %H:%M:%S')}] - @{who} on #[{str(channel)[:15]}]: `{msg_content}`"
-    global messages
-    if not messages.get(guild_id, None):
-        messages[guild_id] = []
-    image_base64 = []
-    for url in documents_url:
-        base64_image = encode_image(url)
-        image_base64.append(base64_image)
-        postfix = url[url.rfind('.')+1:]
-        messages[guild_id].append(
+    new_messages = []
+    for attachment_id, image in images:
+        # only the content ref is remembered, the bytes live in the image store
+        new_messages.append(
             Message(is_in_thread=str(channel.type) == 'public_thread',
                     is_image=True,
                     posted_at=when,
                     author=str(who),
-                    message_str=url,
+                    message_str=image.ref,
                     channel_id=channel.id,
-                    just_msg=f"data:image/{postfix};base64,{base64_image}"))
-    persist_messages()
-    return image_base64
+                    just_msg=image.ref,
+                    message_id=message_id,
+                    attachment_id=attachment_id))
+    history.extend(guild_id, new_messages)
+    message_store.extend(guild_id, new_messages)
 
 persist_dir = "./.persist"
 
+# legacy whole-dict pickle, only read once to migrate into the message store
 messages_path = Path(persist_dir + "/messages.pkl")
 listening_path = Path(persist_dir + "/listening.pkl")
 
 messages_path.parent.mkdir(parents=True, exist_ok=True)
+message_store = MessageStore(persist_dir)
 
 
-async def chunk_reply(message, input, bot):
-    # Determine the channel based on input type
-    if isinstance(input, discord.ext.commands.Context):
-        channel = input.channel
-    elif isinstance(input, discord.Message):
-        channel = input.channel
-    elif isinstance(input, discord.Interaction):
-        channel = input.channel
-    else:
-        raise ValueError("Unsupported input type.")
-    message = message.replace("```", "\n```")
-    def split_content(content, max_length=2000):
-        parts = []
-        last_index = 0
-        in_code_block = False
-        code_block_id = ""
-
-        while last_index < len(content):
-            in_code_block_type = None
-            if last_index + max_length >= len(content):
-                if in_code_block:
-                    parts.append("\n```" + code_block_id + '\n' + content[last_index:next_split])
-                else:  
-                    parts.append(content[last_index:])
-                return parts
-            in_code_block_type = None
-            find_good_split = False
-            next_split = last_index + max_length
-            patterns = [
-                r'\n###'
-                r'\n\*\*',      # Titles
-                r'\n\d+\.\s'  # Numbered bullet points
-            ]
-            # 500-2000: title, point, code
-            for pattern in patterns:
-                matches = list(re.finditer(pattern, content[last_index + 500: last_index + 2000]))
-                if matches:
-                    next_split = last_index + 500 + matches[-1].start()
-                    find_good_split = True
-                    break
-            if not find_good_split:
-                split_s = ['\n', '. ', ' ']
-                for s in split_s:
-                    tmp_split = content.rfind(s, last_index + 1500, last_index + 2000)
-                    if tmp_split != -1:
-                        next_split = tmp_split
-                        find_good_split = True
-                        break
-
-            code_blocks = list(re.finditer(r'\n```', content[last_index: next_split]))
-            if not in_code_block:
-                if len(code_blocks) % 2 == 0:
-                    pass
-                else:
-                    if last_index + code_blocks[-1].start() == last_index:
-                        in_code_block = True
-                        in_code_block_type = 1
-                        tmp = content.find('\n', last_index + 4, next_split)
-                        code_block_id = content[last_index+4:tmp]
-                    else:
-                        next_split = last_index + code_blocks[-1].start()
+def _channel_of(input):
+    if isinstance(input, (discord.ext.commands.Context, discord.Message, discord.Interaction)):
+        return input.channel
+    raise ValueError("Unsupported input type.")
 
-            else:
-                if len(code_blocks) % 2 == 0:
-                    in_code_block_type = 2
-                else:
-                    in_code_block_type = 3
-                    in_code_block = False
-
-            if in_code_block_type is None:
-                parts.append(content[last_index:next_split])
-            elif in_code_block_type == 1:
-                parts.append(content[last_index:next_split] + "\n```")
-            elif in_code_block_type == 2:
-                parts.append("\n```" + code_block_id + '\n' + content[last_index:next_split] + "\n```")
-            elif in_code_block_type == 3:
-                parts.append("\n```" + code_block_id + '\n' + content[last_index:next_split])
-                code_block_id = ''
-            last_index = next_split
-        return parts
-    chunk_size = 2000  # Discord's max message size limit
-    if len(message) <= chunk_size:
-        if isinstance(input, discord.Interaction):
-            await input.followup.send(message)
-        else:
-            async with channel.typing():
-                await channel.send(message)
-    else:
-        parts = split_content(message)
+
+async def chunk_reply(message, input, bot):
+    channel = _channel_of(input)
+    parts = split_message(message)
+    with metrics.timer("send", channel.guild.id):
         if isinstance(input, discord.Interaction):
             for part in parts:
                 await input.followup.send(part)
@@ -177,28 +110,66 @@ async def chunk_reply(message, input, bot):
                     await channel.send(part)
 
 
+async def stream_reply(deltas, input, bot):
+    """Post ``deltas`` while they are generated and return the full text."""
+    channel = _channel_of(input)
+    if isinstance(input, discord.Interaction):
+        async def send(content):
+            return await input.followup.send(content, wait=True)
+    else:
+        send = channel.send
+    streamer = DiscordStreamer(send, guild_id=channel.guild.id)
+    async for delta in deltas:
+        await streamer.feed(delta)
+    return await streamer.finish()
 
-def persist_listening():
-    global listening
 
-    with open(listening_path, 'wb') as file:
-        pickle.dump(listening, file)
+async def release_images(refs):
+    """Delete the files of ``refs`` that no remembered message uses any more."""
+    unused = set(refs) - history.image_refs()
+    if unused:
+        await asyncio.to_thread(lambda: [image_files.remove(ref) for ref in unused])
 
 
-def persist_messages():
-    global messages
+async def edit_message(guild_id, channel_id, message_id, content):
+    """Update a remembered message and the points built from it."""
+    edited = history.edit(guild_id, message_id, content)
+    if not edited:
+        return
+    message_str = edited[0].message_str
+    message_store.edit(guild_id, channel_id, message_id, content, message_str)
+    await rewrite_messages(guild_id, channel_id, {message_id: message_str})
 
-    with open(messages_path, 'wb') as file:
-        pickle.dump(messages, file)
 
+async def delete_messages(guild_id, channel_id, message_ids):
+    """Forget remembered messages, their points and their image files."""
+    deleted = history.delete(guild_id, message_ids)
+    if not deleted:
+        return
+    message_ids = list(dict.fromkeys(msg.message_id for msg in deleted))
+    message_store.delete(guild_id, channel_id, message_ids)
+    await rewrite_messages(guild_id, channel_id, dict.fromkeys(message_ids))
+    await release_images(msg.just_msg for msg in deleted if msg.is_image)
 
 
-if messages_path.is_file():
-    with open(messages_path, 'rb') as file:
-        messages = pickle.load(file)
-else:
-    messages: dict[int, list[Message]] = {}
-    persist_messages()
+
+def persist_listening():
+    global listening
+
+    with open(listening_path, 'wb') as file:
+        pickle.dump(listening, file)
+
+
+migrate_pickle(messages_path, message_store)
+# the full history stays in memory as compact columns (see history.py), so
+# memory grows with it: only retention (see retention.py) drops old messages.
+# RECENT_MESSAGES_PER_CHANNEL only bounds how many of a channel's newest
+# messages recent-context lookups read
+history = MessageHistory(settings.RECENT_MESSAGES_PER_CHANNEL)
+for guild_id, msg in message_store.iter_messages():
+    history.add(guild_id, msg)
+metrics.gauge("history_messages", lambda: history.message_count, "Messages held in the in-memory history")
+metrics.gauge("history_bytes", lambda: history.nbytes, "Bytes of the in-memory history columns")
 
 if listening_path.is_file():
     with open(listening_path, 'rb') as file:
@@ -207,9 +178,115 @@ else:
     listening: dict[int, bool] = {}
     persist_listening()
 
+backfill_checkpoints = Checkpoints(settings.BACKFILL_CHECKPOINTS_PATH)
+
+retention_policies = RetentionPolicies(settings.RETENTION_PATH)
+# old messages are summarized and dropped in the background, see retention.py
+compactor = Compactor(
+    history, message_store, retention_policies, llm,
+    label=lambda channel_id: str(bot.get_channel(channel_id) or channel_id)[:15],
+    release=release_images)
+
+
+async def run_backfill(guild_id, channels, report=None, report_every=5.0):
+    """Backfill ``channels`` of a guild, calling ``report(text)`` with progress."""
+    before = history.oldest(guild_id)
+    # expired history is already summarized, it must not be fetched again
+    for channel_id, since in compactor.summarized_since(guild_id).items():
+        before[channel_id] = min(before.get(channel_id, since), since)
+    job = Backfill(guild_id, channels, remember_history, backfill_checkpoints,
+                   before=before, process=process_incoming_message)
+    task = asyncio.create_task(job.run())
+    bot.backfills.add(task)
+    try:
+        while not task.done():
+            await asyncio.wait([task], timeout=report_every)
+            if report is not None:
+                await report(job.report())
+        await task
+    finally:
+        bot.backfills.discard(task)
+    logger.info(f"Backfill of guild {guild_id} finished: {job.report()}")
+    return job
+
+
+class RAgentBot(commands.Bot):
+    _window_flusher = None
+    _metrics_server = None
+    _compactor = None
+    _collection_watcher = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.backfills: set[asyncio.Task] = set()
+
+    async def setup_hook(self):
+        try:
+            await bootstrap_collections()
+        except Exception:
+            # the vector stores still create bare collections on first insert
+            logger.exception("Bootstrapping the Qdrant collections failed")
+        ingestor.start()
+        self._window_flusher = asyncio.create_task(self._flush_idle_windows())
+        self._compactor = asyncio.create_task(compactor.run_forever())
+        self._collection_watcher = asyncio.create_task(self._follow_text_collection())
+        if settings.METRICS_PORT:
+            try:
+                self._metrics_server = await serve_metrics(metrics)
+            except OSError as err:
+                # e.g. a backfill run next to the bot, which has the port
+                logger.warning(f"Not serving metrics on port {settings.METRICS_PORT}: {err}")
+
+    async def _flush_idle_windows(self):
+        # conversations that went quiet are indexed without waiting for the
+        # next message in their channel
+        while True:
+            await asyncio.sleep(settings.WINDOW_MAX_GAP / 4)
+            try:
+                await flush_windows(settings.WINDOW_MAX_GAP)
+            except Exception:
+                logger.exception("Flushing idle windows failed")
+
+    async def _follow_text_collection(self):
+        # a reindex with another embedding model is picked up without a restart
+        while True:
+            await asyncio.sleep(settings.QDRANT_ALIAS_CHECK_INTERVAL)
+            try:
+                await follow_text_collection()
+            except Exception:
+                logger.exception("Following the text collection alias failed")
+
+    async def close(self):
+        if self._collection_watcher is not None:
+            self._collection_watcher.cancel()
+        if self._window_flusher is not None:
+            self._window_flusher.cancel()
+        if self._compactor is not None:
+            self._compactor.cancel()
+        if self._metrics_server is not None:
+            await self._metrics_server.cleanup()
+        # interrupted backfills flush their windows and resume from the checkpoint
+        for task in self.backfills:
+            task.cancel()
+        await asyncio.gather(*self.backfills, return_exceptions=True)
+        # flush open windows and queued messages into the index before going away
+        await flush_windows()
+        await ingestor.stop()
+        message_store.close()
+        embed_cache.close()
+        if keyword_index is not None:
+            keyword_index.close()
+        await image_downloader.close()
+        image_processor.shutdown()
+        await super().close()
+
+
+# channel name -> ids per guild, for #channel references in /rag questions
+channel_directory = ChannelDirectory()
+
 intents = discord.Intents.default()
 intents.message_content = True
-bot = commands.Bot(command_prefix='/', intents=intents)
+bot = RAgentBot(command_prefix='/', intents=intents)
 tree = bot.tree
 
 @bot.event
@@ -250,29 +327,79 @@ async def stop(interaction: discord.Interaction):
 async def forget(interaction: discord.Interaction):
     "Llama will forget everything it remembered. It will forget all messages, todo, reminders etc."
 
-    # forget_all(ctx)
-    from qdrant_client.http import models as rest
+    global listening
+    # waiting for queued points to land before deleting them can take a while
+    await interaction.response.defer()
+    guild_id = interaction.guild.id
+    listening.pop(guild_id, None)
+    persist_listening()
+    refs = history.image_refs(guild_id)
+    history.forget(guild_id)
+    message_store.forget(guild_id)
+    compactor.forget(guild_id)
+    backfill_checkpoints.forget(guild_id)
+    # both collections, the keyword index and the caches, see rag.forget_guild
+    await forget_guild(guild_id)
+    await release_images(refs)
+    await interaction.followup.send('**RAgent SYS**: All messages forgotten & stopped listening to yall')
+
+
+@tree.command(name="backfill", description="RAgent will read and remember the existing history of channels")
+@app_commands.describe(
+    channel="Channel to backfill (defaults to this one)",
+    channel_2="Another channel to backfill",
+    channel_3="Another channel to backfill",
+    all_channels="Backfill every channel RAgent can read")
+@app_commands.default_permissions(manage_guild=True)
+async def backfill(interaction: discord.Interaction,
+                   channel: discord.TextChannel = None,
+                   channel_2: discord.TextChannel = None,
+                   channel_3: discord.TextChannel = None,
+                   all_channels: bool = False):
+    await interaction.response.defer()
+    if all_channels:
+        channels = [c for c in interaction.guild.text_channels
+                    if c.permissions_for(interaction.guild.me).read_message_history]
+    else:
+        channels = [c for c in (channel, channel_2, channel_3) if c is not None] or [interaction.channel]
+    status = await interaction.followup.send(
+        f"**RAgent SYS**: Backfilling {len(channels)} channel(s)...", wait=True)
 
-    global qd_client
+    async def report(text):
+        try:
+            await status.edit(content=f"**RAgent SYS**: Backfilling...\n{text}")
+        except discord.HTTPException:
+            pass  # the interaction token expires after 15 minutes
 
     try:
-        global messages
-        global listening
-        messages.pop(interaction.guild.id)
-        listening.pop(interaction.guild.id)
-    except KeyError:
-        pass
-    persist_messages()
-    persist_listening()
-
-    qd_client.delete(
-        collection_name=qd_collection,
-        points_selector=rest.Filter(must=[
-            rest.FieldCondition(key="guild_id",
-                                match=rest.MatchValue(value=interaction.guild.id))
-        ]),
-    )
-    await interaction.response.send_message('**RAgent SYS**: All messages forgotten & stopped listening to yall')
+        job = await run_backfill(interaction.guild.id, channels, report)
+        result = f"**RAgent SYS**: Backfill finished.\n{job.report()}"
+    except Exception:
+        logger.exception("Backfill failed")
+        result = "**RAgent SYS**: The backfill failed, run /backfill again to resume it."
+    try:
+        await status.edit(content=result)
+    except discord.HTTPException:
+        await interaction.channel.send(result)
+
+
+@tree.command(name="retention", description="RAgent will summarize and then drop messages older than this")
+@app_commands.describe(
+    max_age_days="Messages older than this many days are summarized and dropped (0: no age limit)",
+    max_messages="Only this many of the newest messages of each channel are kept (0: no limit)",
+    channel="Only set it for this channel (defaults to the whole server)")
+@app_commands.default_permissions(manage_guild=True)
+async def retention(interaction: discord.Interaction,
+                    max_age_days: app_commands.Range[int, 0] = 0,
+                    max_messages: app_commands.Range[int, 0] = 0,
+                    channel: discord.TextChannel = None):
+    policy = RetentionPolicy(max_age_days, max_messages)
+    retention_policies.set(interaction.guild.id, policy, channel.id if channel is not None else None)
+    where = f"#{channel.name}" if channel is not None else "this server"
+    text = f"**RAgent SYS**: Keeping {policy.describe()} in {where}."
+    if max_age_days or max_messages:
+        text += " Older messages are replaced by daily and weekly summaries."
+    await interaction.response.send_message(text, ephemeral=True)
 
 
 #@bot.command(aliases=['st'])
@@ -290,7 +417,14 @@ async def status(interaction: discord.Interaction):
 #as for rag, we should support all channels, specified channels and the channel where the message is sent
 #as for rag, we should support different data sources.
 @tree.command(name="rag", description="RAgent will answer question based on local data and current channel history and LLM knowledge and logical ability")
-async def rag(interaction: discord.Interaction, query: str):
+@app_commands.describe(
+    channel="Only search this channel's history",
+    channel_2="Also search this channel",
+    channel_3="Also search this channel")
+async def rag(interaction: discord.Interaction, query: str,
+              channel: discord.abc.GuildChannel = None,
+              channel_2: discord.abc.GuildChannel = None,
+              channel_3: discord.abc.GuildChannel = None):
     await interaction.response.defer()
     global listening
     
@@ -308,11 +442,7 @@ async def rag(interaction: discord.Interaction, query: str):
     # it is not reasonable to use messages from a server as "replies"
     # here we should use last few messages from the channel as "replies"
     # however, here seems to be a sanity check, ignore
-    rag_messages = [
-        msg for msg in messages.get(interaction.guild.id, [])
-        if not msg.just_msg.startswith("**RAgent SYS**:") # can be deleted
-    ]
-    if len(rag_messages) == 0:
+    if history.user_count(interaction.guild.id) == 0:
         await interaction.response.send_message(
             "**RAgent SYS**: Hey, RAgent's knowledge base is empty now. Please say something before using rag function."
         )
@@ -320,9 +450,18 @@ async def rag(interaction: discord.Interaction, query: str):
     try:
         #async with interaction.typing():
             #response = await answer_query(messages, " ".join(query), ctx, bot)
-        response = await answer_query(messages, query, interaction, bot)
-            # await ctx.message.reply(response)
-        await chunk_reply(response, interaction, bot)
+        # channels picked as arguments or referenced as #channel narrow the search
+        channel_ids, query = channel_directory.resolve(interaction.guild, query)
+        picked = [c.id for c in (channel, channel_2, channel_3) if c is not None]
+        channel_ids = channel_directory.with_threads(interaction.guild, picked + channel_ids)
+        with metrics.timer("rag", interaction.guild.id):
+            if settings.STREAM_RESPONSES:
+                response = await stream_reply(
+                    answer_query_stream(history, query, interaction, bot, channel_ids), interaction, bot)
+            else:
+                response = await answer_query(history, query, interaction, bot, channel_ids)
+                # await ctx.message.reply(response)
+                await chunk_reply(response, interaction, bot)
         if listening.get(interaction.guild.id, False):
             #message = interaction.message
             # def remember_message(when, who, msg_content, guild_id, channel):
@@ -331,24 +470,104 @@ async def rag(interaction: discord.Interaction, query: str):
             timestamp = ((snowflake_id >> 22) + 1420070400000) / 1000
             timestamp = datetime.fromtimestamp(timestamp, tz=timezone.utc)
             remember_message(timestamp, bot.user, response, interaction.guild_id, interaction.channel)
-            index_message(timestamp, bot.user, response, interaction.guild_id, interaction.channel)
+            await index_message(timestamp, bot.user, response, interaction.guild_id, interaction.channel)
     except:
-        tb = traceback.format_exc()
-        print(tb)
+        logger.error(traceback.format_exc())
         await interaction.response.send_message(
             "**RAgent SYS**: The bot encountered an error, will try to fix it soon."
         )
 
+def _format_stats(guild_id):
+    def table(rows):
+        lines = [f"{'stage':<24}{'count':>8}{'p50':>8}{'p95':>8}{'p99':>8}"]
+        for stage, count, quantiles in rows:
+            lines.append(f"{stage:<24}{count:>8,}" + "".join(f"{seconds * 1000:>8,.0f}" for seconds in quantiles.values()))
+        return lines
+
+    # ingestion batches mix servers, so those stages only exist overall
+    lines = ["This server (ms):"] + table(metrics.stages(guild_id))
+    lines += ["", "All servers (ms):"] + table(metrics.stages())
+    lines.append("")
+    for name, value in metrics.gauges().items():
+        lines.append(f"{name:<32}{value:>12,.2f}")
+    return "\n".join(lines)
+
+
+@tree.command(name="stats", description="RAgent will show how long each step of answering and ingesting takes")
+@app_commands.default_permissions(manage_guild=True)
+async def stats(interaction: discord.Interaction):
+    parts = split_message(
+        f"**RAgent SYS**: Latencies over the last {metrics.window} samples of each stage\n"
+        f"```\n{_format_stats(interaction.guild.id)}\n```")
+    await interaction.response.send_message(parts[0], ephemeral=True)
+    for part in parts[1:]:
+        await interaction.followup.send(part, ephemeral=True)
+
+
 @bot.command()
 async def sync(ctx):
-    print("sync command")
-    print(ctx.author.id)
+    logger.info(f"sync command from {ctx.author.id}")
     if ctx.author.id == 799479143174897694:
         await bot.tree.sync()
         await ctx.send('**RAgent SYS**: Command tree synced.')
     else:
         await ctx.send('**RAgent SYS**: You must be the owner to use this command!')
 
+@bot.event
+async def on_guild_channel_create(channel):
+    channel_directory.invalidate(channel.guild.id)
+
+@bot.event
+async def on_guild_channel_delete(channel):
+    channel_directory.invalidate(channel.guild.id)
+
+@bot.event
+async def on_guild_channel_update(before, after):
+    channel_directory.invalidate(after.guild.id)
+
+@bot.event
+async def on_thread_create(thread):
+    channel_directory.invalidate(thread.guild.id)
+
+@bot.event
+async def on_thread_delete(thread):
+    channel_directory.invalidate(thread.guild.id)
+
+@bot.event
+async def on_thread_update(before, after):
+    channel_directory.invalidate(after.guild.id)
+
+# the raw events also arrive for messages posted before the bot started,
+# which are not in discord.py's message cache
+@bot.event
+async def on_raw_message_edit(payload):
+    content = payload.data.get("content")
+    if payload.guild_id is None or content is None:
+        return  # e.g. only an embed was added
+    users = [(int(user["id"]), user["username"]) for user in payload.data.get("mentions", [])]
+    try:
+        await edit_message(payload.guild_id, payload.channel_id, payload.message_id, replace_mentions(content, users))
+    except Exception:
+        logger.exception(f"Updating edited message {payload.message_id} failed")
+
+@bot.event
+async def on_raw_message_delete(payload):
+    if payload.guild_id is None:
+        return
+    try:
+        await delete_messages(payload.guild_id, payload.channel_id, [payload.message_id])
+    except Exception:
+        logger.exception(f"Forgetting deleted message {payload.message_id} failed")
+
+@bot.event
+async def on_raw_bulk_message_delete(payload):
+    if payload.guild_id is None:
+        return
+    try:
+        await delete_messages(payload.guild_id, payload.channel_id, list(payload.message_ids))
+    except Exception:
+        logger.exception(f"Forgetting {len(payload.message_ids)} deleted messages failed")
+
 @bot.event
 async def on_message(message):
     global listening
@@ -361,17 +580,15 @@ async def on_message(message):
     if listening.get(message.guild.id, False):
         # def remember_message(when, who, msg_content, guild_id, channel):
         # def index_message(when, who, msg_content, guild_id, channel):
-        image_urls = [a.url for a in message.attachments if a.content_type.startswith("image")]
-        print("image_urls", image_urls)
-        if image_urls:
-            print("hiiiiiiiiiiiiiiiiiiiiiii")
-            documents_url = await download_and_create_images(image_urls)
-            # this part should be rewrite into an async version
-            print("documents", documents_url)
-            images_base64 = remember_images(message.created_at, message.author, documents_url, message.guild.id, message.channel)
-            index_images(message.created_at, message.author, images_base64, message.guild.id, message.channel)
-        remember_message(message.created_at, message.author, message.content, message.guild.id, message.channel)
-        index_message(message.created_at, message.author, message.content, message.guild.id, message.channel)
+        with metrics.timer("on_message", message.guild.id):
+            attachments = [a for a in message.attachments if a.content_type.startswith("image")]
+            if attachments:
+                images = await download_and_create_images(attachments)
+                remember_images(message.created_at, message.author, images, message.guild.id, message.channel, message.id)
+                await index_images(message.created_at, message.author, images, message.guild.id, message.channel, message.id)
+            remember_message(message.created_at, message.author, message.content, message.guild.id, message.channel, message.id)
+            await index_message(message.created_at, message.author, message.content, message.guild.id, message.channel,
+                                message_id=message.id)
 
     if bot.user.mentioned_in(message):
         #query = message.content.replace(f'<@!{bot.user.id}>', '').strip()
@@ -390,18 +607,20 @@ async def on_message(message):
         try:
             async with message.channel.typing():
                 # response = await answer_query(messages, query, message, bot)
-                response = await chat_repl(messages, query, message, bot)
-                # await message.reply(response)
-                await chunk_reply(response, message, bot)
+                if settings.STREAM_RESPONSES:
+                    response = await stream_reply(chat_repl_stream(history, query, message, bot), message, bot)
+                else:
+                    response = await chat_repl(history, query, message, bot)
+                    # await message.reply(response)
+                    await chunk_reply(response, message, bot)
                 if listening.get(message.guild.id, False):
                     # def remember_message(when, who, msg_content, guild_id, channel):
                     # def index_message(when, who, msg_content, guild_id, channel):
                     remember_message(message.created_at, bot.user, response, message.guild.id, message.channel)
-                    index_message(message.created_at, bot.user, response, message.guild.id, message.channel)
+                    await index_message(message.created_at, bot.user, response, message.guild.id, message.channel)
 
         except:
-            tb = traceback.format_exc()
-            print(tb)
+            logger.error(traceback.format_exc())
             await message.reply(
                 "**RAgent SYS**: The bot encountered an error, will try to fix it soon."
             )
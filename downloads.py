@@ -0,0 +1,96 @@
+"""Pooled, size-capped attachment downloads.
+
+Bodies are streamed straight to disk and hashed on the way; nothing holds
+the whole file in memory, and the writes run in a thread so a slow disk
+does not stall the event loop.
+"""
+import asyncio
+import hashlib
+import os
+import uuid
+from dataclasses import dataclass
+from urllib.parse import urlparse
+
+import aiohttp
+
+import settings
+
+
+logger = settings.logging.getLogger("bot")
+
+CHUNK_SIZE = 64 * 1024
+
+
+@dataclass
+class DownloadedImage:
+    url: str
+    path: str
+    content_type: str
+    sha256: str
+
+    @property
+    def subtype(self):
+        """``png`` for ``image/png``, used as the stored file extension."""
+        subtype = self.content_type.split("/", 1)[-1].split(";", 1)[0]
+        return "".join(c for c in subtype if c.isalnum()) or "png"
+
+
+class ImageDownloader:
+    """One long-lived aiohttp session shared by every attachment download."""
+
+    def __init__(self, directory, max_bytes=None, max_concurrency=None, per_host=None):
+        self.directory = directory
+        self.max_bytes = max_bytes or settings.IMAGE_MAX_BYTES
+        self.per_host = per_host or settings.IMAGE_DOWNLOAD_PER_HOST
+        self._semaphore = asyncio.Semaphore(max_concurrency or settings.IMAGE_DOWNLOAD_CONCURRENCY)
+        self._session = None
+        os.makedirs(directory, exist_ok=True)
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit_per_host=self.per_host)
+            timeout = aiohttp.ClientTimeout(total=settings.IMAGE_DOWNLOAD_TIMEOUT)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return self._session
+
+    async def fetch(self, url):
+        """Stream ``url`` to disk, returning ``None`` if it fails or is too big."""
+        name = os.path.basename(urlparse(url).path) or "image"
+        path = os.path.join(self.directory, f"{uuid.uuid4().hex[:12]}-{name}")
+        async with self._semaphore:
+            try:
+                async with self._get_session().get(url) as response:
+                    response.raise_for_status()
+                    if (response.content_length or 0) > self.max_bytes:
+                        logger.warning(f"Skipping {url}: {response.content_length} bytes is over the limit")
+                        return None
+                    size = 0
+                    digest = hashlib.sha256()
+                    file = await asyncio.to_thread(open, path, "wb")
+                    try:
+                        async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                            size += len(chunk)
+                            if size > self.max_bytes:
+                                raise ValueError(f"body is over {self.max_bytes} bytes")
+                            digest.update(chunk)
+                            await asyncio.to_thread(file.write, chunk)
+                    finally:
+                        await asyncio.to_thread(file.close)
+                    return DownloadedImage(
+                        url=url,
+                        path=path,
+                        content_type=response.content_type,
+                        sha256=digest.hexdigest())
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as err:
+                logger.warning(f"Downloading {url} failed: {err}")
+                if os.path.exists(path):
+                    os.remove(path)
+        return None
+
+    async def fetch_all(self, urls):
+        images = await asyncio.gather(*(self.fetch(url) for url in urls))
+        return [image for image in images if image is not None]
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
@@ -0,0 +1,195 @@
+"""Persistent embedding cache shared by ingestion and retrieval.
+
+Vectors are keyed by ``(embedding model, sha256(text))`` in a small SQLite
+database and evicted least-recently-used once the cache outgrows
+``max_entries``. Hits only note their ``last_used`` time in memory; the
+notes are written in batches, with the next insert or every
+``TOUCH_BATCH`` hits. The async embedding paths run the cache off the
+event loop.
+"""
+import asyncio
+import hashlib
+import sqlite3
+import threading
+import time
+from array import array
+from typing import List
+
+from llama_index.core.base.embeddings.base import BaseEmbedding, Embedding
+from llama_index.core.bridge.pydantic import PrivateAttr
+
+import settings
+
+
+# last_used updates written per transaction
+TOUCH_BATCH = 1024
+
+
+def text_hash(text: str) -> bytes:
+    return hashlib.sha256(text.encode("utf-8")).digest()
+
+
+class EmbeddingCache:
+    def __init__(self, path, max_entries=None):
+        self.max_entries = max_entries or settings.EMBED_CACHE_MAX_ENTRIES
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " model TEXT NOT NULL,"
+            " hash BLOB NOT NULL,"
+            " vector BLOB NOT NULL,"
+            " last_used REAL NOT NULL,"
+            " PRIMARY KEY (model, hash))")
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS embeddings_lru ON embeddings (last_used)")
+        self._db.commit()
+        self._size = self._db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        # (model, hash) -> last_used of the hits not written yet
+        self._touched: dict[tuple[str, bytes], float] = {}
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def get_many(self, model, texts) -> List[Embedding | None]:
+        """Cached vectors for ``texts``, ``None`` where there is no entry."""
+        hashes = [text_hash(text) for text in texts]
+        found = {}
+        with self._lock:
+            unique = list(set(hashes))
+            # stay below SQLite's bound-parameter limit
+            for start in range(0, len(unique), 500):
+                chunk = unique[start:start + 500]
+                rows = self._db.execute(
+                    "SELECT hash, vector FROM embeddings WHERE model = ? AND hash IN "
+                    f"({','.join('?' * len(chunk))})",
+                    [model, *chunk]).fetchall()
+                for digest, vector in rows:
+                    found[digest] = array("f", vector).tolist()
+            now = time.time()
+            for digest in found:
+                self._touched[(model, digest)] = now
+            if len(self._touched) >= TOUCH_BATCH:
+                self._write_touched()
+                self._db.commit()
+            result = [found.get(digest) for digest in hashes]
+            hits = sum(vector is not None for vector in result)
+            self.hits += hits
+            self.misses += len(result) - hits
+        return result
+
+    def put_many(self, model, texts, embeddings):
+        now = time.time()
+        rows = [
+            (model, text_hash(text), array("f", embedding).tobytes(), now)
+            for text, embedding in zip(texts, embeddings)
+        ]
+        with self._lock:
+            self._write_touched()
+            before = self._db.total_changes
+            self._db.executemany(
+                "INSERT OR IGNORE INTO embeddings (model, hash, vector, last_used) "
+                "VALUES (?, ?, ?, ?)", rows)
+            self._size += self._db.total_changes - before
+            if self._size > self.max_entries:
+                self._evict()
+            self._db.commit()
+
+    def _write_touched(self):
+        if self._touched:
+            self._db.executemany(
+                "UPDATE embeddings SET last_used = ? WHERE model = ? AND hash = ?",
+                [(last_used, model, digest) for (model, digest), last_used in self._touched.items()])
+            self._touched = {}
+
+    def _evict(self):
+        # drop down to 90% so eviction does not run on every insert
+        excess = self._size - int(self.max_entries * 0.9)
+        self._db.execute(
+            "DELETE FROM embeddings WHERE rowid IN ("
+            " SELECT rowid FROM embeddings ORDER BY last_used LIMIT ?)", (excess,))
+        self._size -= excess
+
+    def close(self):
+        with self._lock:
+            self._write_touched()
+            self._db.commit()
+            self._db.close()
+
+
+class CachedEmbedding(BaseEmbedding):
+    """Wraps an embedding model and serves repeated texts from the cache.
+
+    Query and text embeddings share entries, which holds for symmetric
+    models such as OpenAI's text-embedding-3 family.
+    """
+
+    _inner: BaseEmbedding = PrivateAttr()
+    _cache: EmbeddingCache = PrivateAttr()
+
+    def __init__(self, inner: BaseEmbedding, cache: EmbeddingCache, **kwargs):
+        super().__init__(
+            model_name=inner.model_name,
+            embed_batch_size=inner.embed_batch_size,
+            callback_manager=inner.callback_manager,
+            **kwargs)
+        self._inner = inner
+        self._cache = cache
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CachedEmbedding"
+
+    @property
+    def cache(self) -> EmbeddingCache:
+        return self._cache
+
+    def _lookup(self, texts):
+        """Cached vectors plus the distinct texts that still need embedding."""
+        cached = self._cache.get_many(self.model_name, texts)
+        missing = list(dict.fromkeys(
+            text for text, vector in zip(texts, cached) if vector is None))
+        return cached, missing
+
+    def _fill(self, texts, cached, missing, embeddings):
+        self._cache.put_many(self.model_name, missing, embeddings)
+        fresh = dict(zip(missing, embeddings))
+        return [fresh[text] if vector is None else vector for text, vector in zip(texts, cached)]
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        cached, missing = self._lookup(texts)
+        if not missing:
+            return cached
+        return self._fill(texts, cached, missing, self._inner._get_text_embeddings(missing))
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        cached, missing = await asyncio.to_thread(self._lookup, texts)
+        if not missing:
+            return cached
+        embeddings = await self._inner._aget_text_embeddings(missing)
+        return await asyncio.to_thread(self._fill, texts, cached, missing, embeddings)
+
+    def _get_text_embedding(self, text: str) -> Embedding:
+        return self._get_text_embeddings([text])[0]
+
+    async def _aget_text_embedding(self, text: str) -> Embedding:
+        return (await self._aget_text_embeddings([text]))[0]
+
+    def _get_query_embedding(self, query: str) -> Embedding:
+        cached, missing = self._lookup([query])
+        if not missing:
+            return cached[0]
+        return self._fill([query], cached, missing, [self._inner._get_query_embedding(query)])[0]
+
+    async def _aget_query_embedding(self, query: str) -> Embedding:
+        cached, missing = await asyncio.to_thread(self._lookup, [query])
+        if not missing:
+            return cached[0]
+        embeddings = [await self._inner._aget_query_embedding(query)]
+        return (await asyncio.to_thread(self._fill, [query], cached, missing, embeddings))[0]
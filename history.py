@@ -0,0 +1,523 @@
+"""Compact, columnar in-memory history of every remembered message.
+
+A pydantic ``Message`` per message costs about a kilobyte: ``message_str``
+repeats ``just_msg``, every message carries its author's name and a full
+``datetime``. ``MessageHistory`` keeps the messages of a guild in parallel
+numpy columns instead::
+
+    posted_us  int64   posting time, microseconds since the epoch
+    channel    int32   index into the guild's interned channel ids
+    author     int32   index into the guild's interned author names
+    label      int32   index into the interned channel labels of message_str
+    flags      uint8   IMAGE | THREAD | NAIVE | SYSTEM | DELETED
+    message_id int64   Discord message id, 0 if unknown
+    start/size         utf-8 ``just_msg`` in one shared buffer per guild
+
+``message_str`` is not stored. It is rebuilt from the other columns, and has
+to come out exactly as it was indexed (the embedding cache is keyed by it);
+the rare message whose text does not follow ``format_message_str`` keeps it
+verbatim. Code that still wants ``Message``-like access gets ``MessageView``s,
+which read their row lazily.
+
+Every channel keeps its row numbers in posting order, so the newest messages
+of a channel come out in O(n) like the deques this replaces, and scans over a
+guild by channel or time (``oldest``, ``between``) run on whole columns.
+Edits and deletes find their rows through a message id -> row dict. An
+edited message gets its new text appended to the buffer, and a deleted one
+is only flagged DELETED (a tombstone that every read skips); the rows and
+bytes are reclaimed in one pass once a quarter of the guild is dead, or the
+next time retention drops rows.
+"""
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+from models import Message
+
+
+SYSTEM_PREFIX = "**RAgent SYS**:"
+
+IMAGE = 1
+THREAD = 2
+NAIVE = 4  # posted_at had no tzinfo, it is stored as if it were UTC
+SYSTEM = 8
+DELETED = 16
+
+# tombstones a guild tolerates before it is compacted, at least
+COMPACT_MIN_DEAD = 1024
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+MICROSECOND = timedelta(microseconds=1)
+
+
+def is_system(msg) -> bool:
+    return msg.just_msg.startswith(SYSTEM_PREFIX)
+
+
+def format_message_str(when, who, label, msg_content):
+    """The text a message is indexed and embedded with."""
+    return f"[{when.strftime('%m-%d-%Y %H:%M:%S')}] - @{who} on #[{label}]: `{msg_content}`"
+
+
+def to_micros(when):
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return (when - EPOCH) // MICROSECOND
+
+
+def from_micros(posted_us, naive=False):
+    when = EPOCH + timedelta(microseconds=int(posted_us))
+    return when.replace(tzinfo=None) if naive else when
+
+
+def _grown(array, capacity):
+    grown = np.empty(capacity, dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+
+class _Interner:
+    def __init__(self):
+        self.values = []
+        self._codes = {}
+
+    def code(self, value):
+        code = self._codes.get(value)
+        if code is None:
+            code = self._codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def find(self, value):
+        return self._codes.get(value)
+
+
+class _ChannelRows:
+    """Row numbers of one channel, sorted by posting time when read."""
+
+    __slots__ = ("rows", "size", "last_us", "ordered")
+
+    def __init__(self):
+        self.rows = np.empty(16, dtype=np.int32)
+        self.size = 0
+        self.last_us = np.iinfo(np.int64).min
+        self.ordered = True
+
+    def append(self, row, posted_us):
+        if self.size == len(self.rows):
+            self.rows = _grown(self.rows, 2 * len(self.rows))
+        self.rows[self.size] = row
+        self.size += 1
+        if posted_us < self.last_us:
+            # backfilled history arrives after newer messages
+            self.ordered = False
+        else:
+            self.last_us = posted_us
+
+    def sorted(self, posted_us):
+        rows = self.rows[:self.size]
+        if not self.ordered:
+            # mostly sorted runs, so the stable sort is close to linear
+            rows[:] = rows[np.argsort(posted_us[rows], kind="stable")]
+            self.ordered = True
+        return rows
+
+
+class _GuildColumns:
+    def __init__(self, capacity=256):
+        self.size = 0
+        self.posted_us = np.empty(capacity, dtype=np.int64)
+        self.channel = np.empty(capacity, dtype=np.int32)
+        self.author = np.empty(capacity, dtype=np.int32)
+        self.label = np.empty(capacity, dtype=np.int32)
+        self.flags = np.empty(capacity, dtype=np.uint8)
+        self.message_id = np.empty(capacity, dtype=np.int64)
+        self.start = np.empty(capacity, dtype=np.int64)
+        self.length = np.empty(capacity, dtype=np.int32)
+        self.text = bytearray()
+        self.channels = _Interner()
+        self.authors = _Interner()
+        self.labels = _Interner()
+        self.rows: list[_ChannelRows] = []
+        # row -> message_str that format_message_str cannot rebuild
+        self.verbatim: dict[int, str] = {}
+        # message id -> its first row, and the further rows of messages
+        # with several (one per image)
+        self.ids: dict[int, int] = {}
+        self.more_ids: dict[int, list[int]] = {}
+        # tombstoned rows, and buffer bytes no live row points at
+        self.dead = 0
+        self.dead_bytes = 0
+        # live non-system messages
+        self.user_count = 0
+
+    _COLUMNS = ("posted_us", "channel", "author", "label", "flags", "message_id", "start", "length")
+
+    def append(self, posted_at, author, channel_id, just_msg, message_str, is_image, is_in_thread, message_id=None):
+        row = self.size
+        if row == len(self.posted_us):
+            for name in self._COLUMNS:
+                setattr(self, name, _grown(getattr(self, name), max(2 * row, 256)))
+
+        posted_us = to_micros(posted_at)
+        flags = (IMAGE if is_image else 0) | (THREAD if is_in_thread else 0)
+        if posted_at.tzinfo is None:
+            flags |= NAIVE
+        if just_msg.startswith(SYSTEM_PREFIX):
+            flags |= SYSTEM
+        else:
+            self.user_count += 1
+
+        label = None
+        if not is_image:
+            # recover the channel label from message_str, and check that the
+            # stored columns rebuild it exactly
+            head = format_message_str(from_micros(posted_us, flags & NAIVE), author, "", "")
+            head, tail = head[:head.index("#[") + 2], "]: `" + just_msg + "`"
+            if message_str.startswith(head) and message_str.endswith(tail) \
+                    and len(message_str) >= len(head) + len(tail):
+                label = message_str[len(head):len(message_str) - len(tail)]
+        if label is None and message_str != just_msg:
+            self.verbatim[row] = message_str
+
+        channel = self.channels.code(channel_id)
+        if channel == len(self.rows):
+            self.rows.append(_ChannelRows())
+        self.posted_us[row] = posted_us
+        self.channel[row] = channel
+        self.author[row] = self.authors.code(author)
+        self.label[row] = -1 if label is None else self.labels.code(label)
+        self.flags[row] = flags
+        self.message_id[row] = message_id or 0
+        if message_id:
+            self._index_id(message_id, row)
+        self._set_text(row, just_msg)
+        self.rows[channel].append(row, posted_us)
+        self.size += 1
+
+    def _set_text(self, row, just_msg):
+        data = just_msg.encode("utf-8")
+        self.start[row] = len(self.text)
+        self.length[row] = len(data)
+        self.text += data
+
+    def _index_id(self, message_id, row):
+        if message_id in self.ids:
+            self.more_ids.setdefault(message_id, []).append(row)
+        else:
+            self.ids[message_id] = row
+
+    def find(self, message_ids):
+        """Rows of the messages with these ids (an image message has a row per image)."""
+        rows = []
+        for message_id in message_ids:
+            row = self.ids.get(message_id)
+            if row is not None:
+                rows.append(row)
+                rows.extend(self.more_ids.get(message_id, ()))
+        return np.array(sorted(rows), dtype=np.int64)
+
+    def live(self):
+        return (self.flags[:self.size] & DELETED) == 0
+
+    def live_tail(self, rows, n):
+        """The last ``n`` live rows of ``rows``, skipping tombstones."""
+        if not self.dead:
+            return rows[-n:]
+        take = n
+        while True:
+            tail = rows[-take:]
+            live = tail[(self.flags[tail] & DELETED) == 0]
+            if len(live) >= n or len(tail) == len(rows):
+                return live[-n:]
+            take *= 2
+
+    def tombstone(self, rows):
+        """Mark ``rows`` deleted; compacts once enough of the guild is dead."""
+        for row in rows:
+            message_id = int(self.message_id[row])
+            self.ids.pop(message_id, None)
+            self.more_ids.pop(message_id, None)
+            self.verbatim.pop(int(row), None)
+        self.user_count -= int(((self.flags[rows] & SYSTEM) == 0).sum())
+        self.flags[rows] |= DELETED
+        self.dead += len(rows)
+        self.dead_bytes += int(self.length[rows].sum())
+        if self.dead >= max(COMPACT_MIN_DEAD, self.size // 4) or self.dead_bytes > len(self.text) // 2:
+            self.keep(np.ones(self.size, dtype=bool))
+
+    def edit(self, row, just_msg):
+        self.dead_bytes += int(self.length[row])
+        self._set_text(row, just_msg)
+        # message_str is rebuilt from the new text; one that never followed
+        # format_message_str becomes the text itself
+        self.verbatim.pop(row, None)
+
+    def keep(self, mask):
+        """Drop every row where ``mask`` is false, and every tombstone,
+        renumbering the rest."""
+        rows = np.flatnonzero(mask & self.live())
+        renumbered = np.full(self.size, -1, dtype=np.int64)
+        renumbered[rows] = np.arange(len(rows))
+        starts, lengths = self.start[rows], self.length[rows].astype(np.int64)
+        # gather the kept texts into a new buffer in one go
+        offsets = np.zeros(len(rows), dtype=np.int64)
+        np.cumsum(lengths[:-1], out=offsets[1:])
+        text = np.frombuffer(self.text, dtype=np.uint8)
+        gather = np.repeat(starts - offsets, lengths) + np.arange(int(lengths.sum()))
+        self.text = bytearray(text[gather].tobytes())
+        for name in self._COLUMNS:
+            setattr(self, name, getattr(self, name)[rows].copy())
+        self.start = offsets
+        self.size = len(rows)
+        self.verbatim = {
+            int(renumbered[row]): message_str for row, message_str in self.verbatim.items()
+            if renumbered[row] >= 0}
+        for channel_rows in self.rows:
+            kept = renumbered[channel_rows.rows[:channel_rows.size]]
+            kept = kept[kept >= 0].astype(np.int32)
+            channel_rows.rows = kept if len(kept) else np.empty(16, dtype=np.int32)
+            channel_rows.size = len(kept)
+        self.ids, self.more_ids = {}, {}
+        for row in np.flatnonzero(self.message_id[:self.size]):
+            self._index_id(int(self.message_id[row]), int(row))
+        self.dead = self.dead_bytes = 0
+        self.user_count = int(((self.flags[:self.size] & SYSTEM) == 0).sum())
+
+    @property
+    def nbytes(self):
+        return (
+            sum(getattr(self, name).nbytes for name in self._COLUMNS)
+            + len(self.text)
+            + sum(rows.rows.nbytes for rows in self.rows))
+
+
+class MessageView:
+    """Read-only ``Message``-like access to one remembered message.
+
+    A view addresses a row, and rows are renumbered when messages are
+    dropped, so a view is only valid until the history next changes: never
+    hold one across an ``await``, copy it with ``to_message()`` instead.
+    """
+
+    __slots__ = ("_columns", "_row")
+
+    def __init__(self, columns, row):
+        self._columns = columns
+        self._row = row
+
+    @property
+    def posted_at(self) -> datetime:
+        columns = self._columns
+        return from_micros(columns.posted_us[self._row], columns.flags[self._row] & NAIVE)
+
+    @property
+    def author(self) -> str:
+        return self._columns.authors.values[self._columns.author[self._row]]
+
+    @property
+    def channel_id(self) -> int:
+        return self._columns.channels.values[self._columns.channel[self._row]]
+
+    @property
+    def just_msg(self) -> str:
+        columns, row = self._columns, self._row
+        start = int(columns.start[row])
+        return columns.text[start:start + int(columns.length[row])].decode("utf-8")
+
+    @property
+    def message_str(self) -> str:
+        columns, row = self._columns, self._row
+        verbatim = columns.verbatim.get(row)
+        if verbatim is not None:
+            return verbatim
+        label = columns.label[row]
+        if label < 0:
+            return self.just_msg
+        return format_message_str(
+            self.posted_at, self.author, columns.labels.values[label], self.just_msg)
+
+    @property
+    def is_image(self) -> bool:
+        return bool(self._columns.flags[self._row] & IMAGE)
+
+    @property
+    def is_in_thread(self) -> bool:
+        return bool(self._columns.flags[self._row] & THREAD)
+
+    @property
+    def message_id(self) -> int | None:
+        return int(self._columns.message_id[self._row]) or None
+
+    def to_message(self) -> Message:
+        return Message(
+            is_in_thread=self.is_in_thread,
+            is_image=self.is_image,
+            message_str=self.message_str,
+            posted_at=self.posted_at,
+            author=self.author,
+            channel_id=self.channel_id,
+            just_msg=self.just_msg,
+            message_id=self.message_id)
+
+    def __repr__(self):
+        return f"MessageView({self.message_str!r})"
+
+
+class MessageHistory:
+    def __init__(self, maxlen):
+        # how many of a channel's newest messages channel() returns
+        self.maxlen = maxlen
+        self._guilds: dict[int, _GuildColumns] = {}
+
+    def add(self, guild_id, msg: Message):
+        columns = self._guilds.get(guild_id)
+        if columns is None:
+            columns = self._guilds[guild_id] = _GuildColumns()
+        columns.append(
+            msg.posted_at, msg.author, msg.channel_id, msg.just_msg, msg.message_str,
+            msg.is_image, msg.is_in_thread, msg.message_id)
+
+    def extend(self, guild_id, msgs):
+        for msg in msgs:
+            self.add(guild_id, msg)
+
+    def _rows(self, guild_id, channel_id):
+        columns = self._guilds.get(guild_id)
+        if columns is None:
+            return None, None
+        channel = columns.channels.find(channel_id)
+        if channel is None:
+            return columns, None
+        return columns, columns.rows[channel].sorted(columns.posted_us)
+
+    def channel(self, guild_id, channel_id) -> list[MessageView]:
+        """The newest ``maxlen`` messages of a channel, oldest first."""
+        return self.last(guild_id, channel_id, self.maxlen)
+
+    def last(self, guild_id, channel_id, n) -> list[MessageView]:
+        """The last ``n`` messages of a channel, oldest first, in O(n)."""
+        columns, rows = self._rows(guild_id, channel_id)
+        if rows is None or n <= 0:
+            return []
+        return [MessageView(columns, int(row)) for row in columns.live_tail(rows, n)]
+
+    def nth_newest(self, guild_id, channel_id, n) -> datetime | None:
+        """Posting time of a channel's ``n``-th newest message, if it has that many."""
+        columns, rows = self._rows(guild_id, channel_id)
+        if rows is None or n <= 0:
+            return None
+        rows = columns.live_tail(rows, n)
+        if n > len(rows):
+            return None
+        return MessageView(columns, int(rows[0])).posted_at
+
+    def oldest(self, guild_id) -> dict[int, datetime]:
+        """Posting time of the oldest remembered message of every channel."""
+        columns = self._guilds.get(guild_id)
+        if columns is None or not columns.size:
+            return {}
+        live = np.flatnonzero(columns.live())
+        channel = columns.channel[live]
+        order = live[np.lexsort((columns.posted_us[live], channel))]
+        firsts = order[np.flatnonzero(np.diff(columns.channel[order], prepend=-1))]
+        return {
+            columns.channels.values[columns.channel[row]]: MessageView(columns, int(row)).posted_at
+            for row in firsts
+        }
+
+    def between(self, guild_id, since=None, until=None, channel_ids=None) -> list[MessageView]:
+        """Messages posted in ``[since, until)``, optionally only in
+        ``channel_ids``, oldest first."""
+        columns = self._guilds.get(guild_id)
+        if columns is None:
+            return []
+        posted_us = columns.posted_us[:columns.size]
+        mask = columns.live()
+        if since is not None:
+            mask &= posted_us >= to_micros(since)
+        if until is not None:
+            mask &= posted_us < to_micros(until)
+        if channel_ids is not None:
+            codes = [columns.channels.find(c) for c in channel_ids]
+            mask &= np.isin(columns.channel[:columns.size], [c for c in codes if c is not None])
+        rows = np.flatnonzero(mask)
+        rows = rows[np.argsort(posted_us[rows], kind="stable")]
+        return [MessageView(columns, int(row)) for row in rows]
+
+    def prune(self, guild_id, channel_id, before) -> tuple[int, list[str]]:
+        """Drop a channel's messages posted before ``before``; returns how
+        many, and the image refs among them."""
+        columns = self._guilds.get(guild_id)
+        channel = columns.channels.find(channel_id) if columns is not None else None
+        if channel is None:
+            return 0, []
+        expired = (columns.channel[:columns.size] == channel) & \
+            (columns.posted_us[:columns.size] < to_micros(before)) & columns.live()
+        count = int(expired.sum())
+        refs = [
+            MessageView(columns, int(row)).just_msg
+            for row in np.flatnonzero(expired & (columns.flags[:columns.size] & IMAGE).astype(bool))
+        ]
+        if count:
+            columns.keep(~expired)
+        return count, refs
+
+    def edit(self, guild_id, message_id, just_msg) -> list[MessageView]:
+        """Replace the text of a message; returns it, or nothing if it is not
+        remembered (or is an image)."""
+        columns = self._guilds.get(guild_id)
+        if columns is None or not message_id:
+            return []
+        edited = []
+        for row in columns.find([message_id]):
+            if not columns.flags[row] & IMAGE:
+                columns.edit(int(row), just_msg)
+                edited.append(MessageView(columns, int(row)))
+        return edited
+
+    def delete(self, guild_id, message_ids) -> list[Message]:
+        """Drop the messages with these ids; returns what was dropped."""
+        columns = self._guilds.get(guild_id)
+        if columns is None:
+            return []
+        rows = columns.find(message_ids)
+        if not len(rows):
+            return []
+        deleted = [MessageView(columns, int(row)).to_message() for row in rows]
+        columns.tombstone(rows)
+        return deleted
+
+    def image_refs(self, guild_id=None) -> set[str]:
+        """The image refs of a guild's messages, or of every guild's."""
+        guilds = self._guilds.values() if guild_id is None else [self._guilds.get(guild_id)]
+        refs = set()
+        for columns in guilds:
+            if columns is None:
+                continue
+            for row in np.flatnonzero((columns.flags[:columns.size] & (IMAGE | DELETED)) == IMAGE):
+                refs.add(MessageView(columns, int(row)).just_msg)
+        return refs
+
+    def guilds(self) -> list[int]:
+        return list(self._guilds)
+
+    def channel_ids(self, guild_id) -> list[int]:
+        columns = self._guilds.get(guild_id)
+        return list(columns.channels.values) if columns is not None else []
+
+    def user_count(self, guild_id) -> int:
+        columns = self._guilds.get(guild_id)
+        return columns.user_count if columns is not None else 0
+
+    def forget(self, guild_id):
+        self._guilds.pop(guild_id, None)
+
+    @property
+    def message_count(self):
+        return sum(columns.size - columns.dead for columns in self._guilds.values())
+
+    @property
+    def nbytes(self):
+        """Bytes held by the columns and text buffers (not the interned strings)."""
+        return sum(columns.nbytes for columns in self._guilds.values())
@@ -0,0 +1,59 @@
+"""CPU-bound image work, run in a process pool instead of on the event loop.
+
+``process_image`` runs inside the worker processes, so this module only
+depends on PIL and the standard library.
+"""
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from io import BytesIO
+
+from PIL import Image
+
+
+@dataclass
+class ProcessedImage:
+    format: str      # what the bytes really are, e.g. "png", whatever the upload claimed
+    thumb: bytes     # downscaled JPEG
+
+
+def process_image(path, max_side):
+    """Decode, normalize to RGB, downscale and JPEG-encode the file at ``path``.
+
+    The worker reads the file itself, so image bytes are never pickled
+    across the process boundary.
+    """
+    with Image.open(path) as image:
+        image_format = (image.format or "png").lower()
+        image.draft("RGB", (max_side, max_side))  # cheap JPEG downscale on decode
+        image.thumbnail((max_side, max_side))
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        out = BytesIO()
+        image.save(out, format="JPEG", quality=85)
+    return ProcessedImage(format=image_format, thumb=out.getvalue())
+
+
+class ImageProcessor:
+    def __init__(self, max_workers, max_side):
+        self.max_workers = max_workers
+        self.max_side = max_side
+        self._pool = None
+
+    def _get_pool(self):
+        if self._pool is None:
+            # spawn: forking a process that runs asyncio and store threads is unsafe
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context("spawn"))
+        return self._pool
+
+    async def process(self, path):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._get_pool(), process_image, path, self.max_side)
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True, cancel_futures=True)
+            self._pool = None
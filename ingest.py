@@ -0,0 +1,200 @@
+"""Background ingestion of chat nodes into the vector stores.
+
+``on_message`` only enqueues nodes; a pool of ``INGEST_WORKERS`` workers
+drains the queue in batches so that a burst of messages costs one
+embedding call and one bulk Qdrant upsert instead of one of each per
+message.
+"""
+import asyncio
+import time
+
+from llama_index.core.schema import ImageNode, MetadataMode
+
+import settings
+from metrics import metrics
+from scheduler import BULK, run_as
+
+
+logger = settings.logging.getLogger("bot")
+
+_STOP = object()
+
+
+class IngestPipeline:
+    def __init__(self, embed_model, text_store, image_embed_model=None, image_store=None,
+                 image_embed_cache=None, max_batch=None, max_linger=None, max_queue=None,
+                 max_retries=None, workers=None, on_indexed=None):
+        self.embed_model = embed_model
+        self.text_store = text_store
+        self.image_embed_model = image_embed_model
+        self.image_store = image_store
+        # reposted images share a content ref, so their vectors are reused
+        self.image_embed_cache = image_embed_cache
+        self.max_batch = max_batch or settings.INGEST_MAX_BATCH
+        self.max_linger = settings.INGEST_MAX_LINGER if max_linger is None else max_linger
+        self.max_retries = settings.INGEST_MAX_RETRIES if max_retries is None else max_retries
+        self._max_queue = max_queue or settings.INGEST_QUEUE_SIZE
+        # more than one worker overlaps embedding calls and upserts, which
+        # matters when a backfill keeps the queue full
+        self.workers = workers or settings.INGEST_WORKERS
+        # called with every batch of nodes once they are searchable
+        self.on_indexed = on_indexed
+        self._queue = None
+        self._workers = []
+        # one future per batch a worker is collecting or indexing
+        self._busy: set[asyncio.Future] = set()
+
+    @property
+    def depth(self):
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def start(self):
+        if self._workers:
+            return
+        self._queue = asyncio.Queue(maxsize=self._max_queue)
+        self._workers = [
+            asyncio.create_task(self._run(), name=f"ingest-worker-{i}")
+            for i in range(self.workers)
+        ]
+
+    async def put(self, node):
+        """Queue a node for indexing, waiting while the queue is full."""
+        if not self._workers:
+            self.start()
+        await self._queue.put(node)
+
+    async def put_many(self, nodes):
+        for node in nodes:
+            await self.put(node)
+
+    async def take(self, predicate):
+        """Remove the queued nodes matching ``predicate`` and return them,
+        once the batches the workers already hold are indexed.
+
+        Whatever the caller then writes for those nodes (an edit, a deletion)
+        cannot be overwritten by an older copy still on its way.
+        """
+        taken = []
+        if self._queue is not None:
+            kept = []
+            while not self._queue.empty():
+                item = self._queue.get_nowait()
+                (taken if item is not _STOP and predicate(item) else kept).append(item)
+            for item in kept:
+                self._queue.put_nowait(item)
+        if self._busy:
+            await asyncio.wait(list(self._busy))
+        return taken
+
+    async def stop(self):
+        """Flush everything still queued and stop the workers."""
+        if not self._workers:
+            return
+        # one sentinel per worker, each queued behind everything already waiting
+        for _ in self._workers:
+            await self._queue.put(_STOP)
+        await asyncio.gather(*self._workers)
+        self._workers = []
+
+    async def _run(self):
+        # batches mix guilds, and queue behind answers and summaries
+        run_as(BULK)
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is _STOP:
+                break
+            busy = asyncio.get_running_loop().create_future()
+            self._busy.add(busy)
+            try:
+                stopping = await self._collect_and_flush([item])
+            finally:
+                self._busy.discard(busy)
+                busy.set_result(None)
+
+    async def _collect_and_flush(self, batch):
+        """Fill ``batch`` up for ``max_linger`` seconds and index it; returns
+        whether the worker was told to stop meanwhile."""
+        stopping = False
+        deadline = time.monotonic() + self.max_linger
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            try:
+                if timeout > 0:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                else:
+                    item = self._queue.get_nowait()
+            except (asyncio.TimeoutError, asyncio.QueueEmpty):
+                break
+            if item is _STOP:
+                stopping = True
+                break
+            batch.append(item)
+        await self._flush(batch)
+        return stopping
+
+    async def _flush(self, batch):
+        text_nodes = [node for node in batch if not isinstance(node, ImageNode)]
+        image_nodes = [node for node in batch if isinstance(node, ImageNode)]
+        if text_nodes:
+            # model and store are picked together once per batch, so a batch
+            # (and its retries) never straddles a switch of the text collection
+            embed_model, text_store = self.embed_model, self.text_store
+            await self._with_retries(
+                lambda nodes: self._index_text(nodes, embed_model, text_store), text_nodes)
+        if image_nodes:
+            await self._with_retries(self._index_images, image_nodes)
+
+    async def _with_retries(self, index_fn, nodes):
+        for attempt in range(self.max_retries + 1):
+            try:
+                await index_fn(nodes)
+                metrics.inc("ingested_nodes", len(nodes))
+                if self.on_indexed is not None:
+                    self.on_indexed(nodes)
+                return
+            except Exception as err:
+                if attempt == self.max_retries:
+                    logger.error(f"Dropping {len(nodes)} nodes after {attempt + 1} attempts: {err}")
+                    metrics.inc("ingest_dropped_nodes", len(nodes))
+                    return
+                metrics.inc("ingest_retries")
+                delay = min(settings.INGEST_RETRY_BACKOFF * 2 ** attempt, 30)
+                logger.warning(f"Indexing {len(nodes)} nodes failed ({err}), retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+    async def _index_text(self, nodes, embed_model, text_store):
+        # nodes embedded by a previous attempt only need the upsert retried
+        pending = [node for node in nodes if node.embedding is None]
+        if pending:
+            texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for node in pending]
+            with metrics.timer("embed"):
+                embeddings = await embed_model.aget_text_embedding_batch(texts)
+            for node, embedding in zip(pending, embeddings):
+                node.embedding = embedding
+        with metrics.timer("upsert"):
+            await text_store.async_add(nodes)
+
+    async def _index_images(self, nodes):
+        pending = [node for node in nodes if node.embedding is None]
+        model = self.image_embed_model.model_name
+        if pending and self.image_embed_cache is not None:
+            cached = await asyncio.to_thread(
+                self.image_embed_cache.get_many, model, [node.metadata["image_ref"] for node in pending])
+            for node, embedding in zip(pending, cached):
+                node.embedding = embedding
+            pending = [node for node in pending if node.embedding is None]
+        if pending:
+            # local image encoders (CLIP) are CPU bound, keep them off the event loop
+            images = [node.resolve_image() for node in pending]
+            with metrics.timer("embed_image"):
+                embeddings = await asyncio.to_thread(
+                    self.image_embed_model.get_image_embedding_batch, images)
+            for node, embedding in zip(pending, embeddings):
+                node.embedding = embedding
+            if self.image_embed_cache is not None:
+                await asyncio.to_thread(
+                    self.image_embed_cache.put_many,
+                    model, [node.metadata["image_ref"] for node in pending], embeddings)
+        with metrics.timer("upsert_image"):
+            await self.image_store.async_add(nodes)
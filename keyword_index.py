@@ -0,0 +1,170 @@
+"""Lexical (BM25) index of everything that is embedded into Qdrant.
+
+Error codes, command names, ticket numbers and usernames are exact tokens
+that dense embeddings retrieve poorly. Every indexed node is also written to
+an SQLite FTS5 table, which maintains the inverted index incrementally and
+ranks with BM25, without any embedding call. Guild and channel ids are
+indexed columns, so a search only walks its own guild's postings.
+
+FTS5 cannot look rows up by an unindexed column, so a plain table maps
+every node id to its FTS rowid: adding a node replaces its earlier row, and
+deleting one is a key lookup instead of a scan of the guild.
+"""
+import json
+import re
+import sqlite3
+import threading
+
+from llama_index.core.schema import NodeWithScore, TextNode
+
+
+TOKEN = re.compile(r"\w+")
+# too common in questions to narrow anything down
+STOP_WORDS = frozenset("""
+a an and are as at be but by can could did do does for from had has have how i if in
+is it its me my no not of on or our so that the their them then there these they this
+to us was we were what when where which who why will with would you your
+""".split())
+
+
+def _match_query(text, guild_id, channel_ids=()):
+    terms = list(dict.fromkeys(
+        token.lower() for token in TOKEN.findall(text) if token.lower() not in STOP_WORDS))
+    if not terms:
+        return None
+    # quoted, so FTS5 never reads a term as an operator
+    phrases = " OR ".join(f'"{term}"' for term in terms)
+    query = f"guild : g{guild_id} AND text : ({phrases})"
+    if channel_ids:
+        channels = " OR ".join(f"c{channel_id}" for channel_id in channel_ids)
+        query += f" AND channel : ({channels})"
+    return query
+
+
+def _connect(path):
+    db = sqlite3.connect(path, check_same_thread=False)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    # "_" is part of a token, so ERR_CONN_RESET stays one term
+    db.execute(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS nodes USING fts5("
+        " text, guild, channel,"
+        " node_id UNINDEXED, metadata UNINDEXED,"
+        " tokenize=\"unicode61 tokenchars '_'\")")
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS node_rows ("
+        " node_id TEXT PRIMARY KEY, row INTEGER NOT NULL, guild TEXT NOT NULL)")
+    db.execute("CREATE INDEX IF NOT EXISTS node_rows_guild ON node_rows (guild)")
+    if db.execute("SELECT 1 FROM node_rows LIMIT 1").fetchone() is None:
+        # an index from before node_rows: map the newest row of every node
+        # id, and drop the duplicates re-added windows left behind
+        db.execute(
+            "INSERT INTO node_rows (node_id, row, guild)"
+            " SELECT node_id, MAX(rowid), guild FROM nodes GROUP BY node_id")
+        db.execute("DELETE FROM nodes WHERE rowid NOT IN (SELECT row FROM node_rows)")
+    db.commit()
+    return db
+
+
+class KeywordIndex:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = _connect(path)
+
+    def switch(self, path):
+        """Continue with the index at ``path``, e.g. the one ``reindex.py``
+        built next to a new collection version."""
+        db = _connect(path)
+        with self._lock:
+            self._db, old = db, self._db
+            self.path = path
+        old.close()
+
+    def add(self, nodes):
+        """Index ``nodes``, replacing the rows of earlier nodes with the same ids."""
+        rows = [
+            (node.get_content(),
+             f"g{node.metadata['guild_id']}",
+             f"c{node.metadata['channel_id']}",
+             node.node_id,
+             json.dumps(node.metadata))
+            for node in nodes
+        ]
+        with self._lock:
+            for row in rows:
+                self._delete_node(row[3])
+                cursor = self._db.execute(
+                    "INSERT INTO nodes (text, guild, channel, node_id, metadata) VALUES (?, ?, ?, ?, ?)", row)
+                self._db.execute(
+                    "INSERT INTO node_rows (node_id, row, guild) VALUES (?, ?, ?)",
+                    (row[3], cursor.lastrowid, row[1]))
+            self._db.commit()
+
+    def _delete_node(self, node_id, guild=None):
+        found = self._db.execute("SELECT row, guild FROM node_rows WHERE node_id = ?", (node_id,)).fetchone()
+        if found is None or (guild is not None and found[1] != guild):
+            return
+        self._db.execute("DELETE FROM nodes WHERE rowid = ?", (found[0],))
+        self._db.execute("DELETE FROM node_rows WHERE node_id = ?", (node_id,))
+
+    def search(self, guild_id, text, top_k, channel_ids=()):
+        """The ``top_k`` best BM25 matches for ``text`` in a guild, best first."""
+        query = _match_query(text, guild_id, channel_ids)
+        if query is None:
+            return []
+        with self._lock:
+            # only the text column counts towards the score
+            rows = self._db.execute(
+                "SELECT node_id, text, metadata, bm25(nodes, 1.0, 0.0, 0.0) AS rank"
+                " FROM nodes WHERE nodes MATCH ? ORDER BY rank LIMIT ?",
+                (query, top_k)).fetchall()
+        return [
+            NodeWithScore(node=TextNode(id_=node_id, text=text, metadata=json.loads(metadata)), score=-rank)
+            for node_id, text, metadata, rank in rows
+        ]
+
+    def delete(self, guild_id, node_ids):
+        with self._lock:
+            for node_id in node_ids:
+                self._delete_node(node_id, f"g{guild_id}")
+            self._db.commit()
+
+    def prune(self, guild_id, channel_id, before):
+        """Delete a channel's rows posted before ``before``, except summaries."""
+        with self._lock:
+            expired = self._db.execute(
+                "SELECT rowid, node_id FROM nodes WHERE nodes MATCH ?"
+                " AND json_extract(metadata, '$.posted_ts') < ?"
+                " AND json_extract(metadata, '$.summary_level') IS NULL",
+                (f"guild : g{guild_id} AND channel : c{channel_id}", before)).fetchall()
+            self._db.executemany("DELETE FROM nodes WHERE rowid = ?", [(row,) for row, _ in expired])
+            self._db.executemany("DELETE FROM node_rows WHERE node_id = ?", [(node_id,) for _, node_id in expired])
+            self._db.commit()
+
+    def forget(self, guild_id):
+        with self._lock:
+            self._db.execute("DELETE FROM nodes WHERE guild MATCH ?", (f"g{guild_id}",))
+            self._db.execute("DELETE FROM node_rows WHERE guild = ?", (f"g{guild_id}",))
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def reciprocal_rank_fusion(rankings, top_k, k=60):
+    """Merge best-first node lists by summing ``1 / (k + rank)`` per node.
+
+    Nodes are matched by text rather than id: a reindexed collection gives
+    the same text new point ids.
+    """
+    scores = {}
+    nodes = {}
+    for ranking in rankings:
+        for rank, node in enumerate(ranking):
+            key = node.node.get_content()
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank + 1)
+            nodes.setdefault(key, node)
+    best = sorted(scores, key=scores.get, reverse=True)[:top_k]
+    return [NodeWithScore(node=nodes[key].node, score=scores[key]) for key in best]
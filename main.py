@@ -1,8 +1,45 @@
-from discord_bot import bot
+import argparse
+import asyncio
+
 import settings
 
 def run():
+    # imported here so that spawned worker processes, which re-import this
+    # module, don't start a second bot
+    from discord_bot import bot
     bot.run(settings.DISCORD_API_SECRET, root_logger=True)
 
+def backfill(argv=None):
+    """Backfill channels without connecting to the gateway.
+
+    python main.py backfill CHANNEL_ID [CHANNEL_ID ...]
+    """
+    parser = argparse.ArgumentParser(prog="main.py backfill", description=backfill.__doc__.splitlines()[0])
+    parser.add_argument("channel_ids", type=int, nargs="+")
+    args = parser.parse_args(argv)
+
+    from discord_bot import bot, run_backfill
+
+    async def report(text):
+        print(text, end="\n\n", flush=True)
+
+    async def main():
+        async with bot:
+            # login runs setup_hook (ingestion, collections); closing the bot
+            # flushes everything that is still queued
+            await bot.login(settings.DISCORD_API_SECRET)
+            guilds = {}
+            for channel_id in args.channel_ids:
+                channel = await bot.fetch_channel(channel_id)
+                guilds.setdefault(channel.guild.id, []).append(channel)
+            await asyncio.gather(*(
+                run_backfill(guild_id, channels, report) for guild_id, channels in guilds.items()))
+
+    asyncio.run(main())
+
 if __name__ == "__main__":
-  run()
\ No newline at end of file
+  import sys
+  if sys.argv[1:2] == ["backfill"]:
+    backfill(sys.argv[2:])
+  else:
+    run()
@@ -0,0 +1,474 @@
+"""Append-only journal for remembered messages.
+
+Every remembered message is written as one JSON line to a journal, so the
+cost of persisting a message no longer depends on how much history exists.
+The journal is periodically folded into a snapshot by a background
+compaction, and replaying ``snapshot + journal`` at startup restores the
+full history.
+
+Files inside the store directory::
+
+    messages.snapshot.jsonl   header line + compacted records
+    messages.journal.1.jsonl  sealed journal waiting to be compacted
+    messages.journal.jsonl    live journal, appended to on every message
+
+Every record carries a monotonically increasing ``seq``. The snapshot header
+remembers the last ``seq`` it contains, so records that were compacted but
+not yet removed from a journal (e.g. after a crash mid-compaction) are
+skipped on replay instead of being loaded twice.
+
+Records are ``add`` (a message), ``edit`` (new text for a message),
+``delete`` (messages by id), ``forget`` (a whole guild), ``prune`` (the
+messages of a channel posted before a time, see ``retention.py``) and
+``summary`` (a daily or weekly summary of a channel). A record only changes
+what was written before it; compaction folds edits into their messages and
+drops whatever was removed.
+"""
+import bisect
+import json
+import os
+import pickle
+import threading
+from datetime import datetime, timezone
+from pathlib import Path
+
+import settings
+from models import Message
+
+
+logger = settings.logging.getLogger("bot")
+
+SNAPSHOT_VERSION = 1
+SNAPSHOT_NAME = "messages.snapshot.jsonl"
+SEALED_NAME = "messages.journal.1.jsonl"
+JOURNAL_NAME = "messages.journal.jsonl"
+
+
+def posted_ts(message):
+    """Epoch seconds of a journaled message (naive times are taken as UTC)."""
+    when = datetime.fromisoformat(message["posted_at"])
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return when.timestamp()
+
+
+class _Tombstones:
+    """What ``forget``, ``prune``, ``delete`` and newer ``summary`` records
+    remove, and what ``edit`` records change.
+
+    Fed every record once (``see``), then decides for every record whether
+    it survives (``keeps``) and what it looks like then (``applied``).
+    """
+
+    def __init__(self):
+        self.forgotten: dict[int, int] = {}
+        # (guild_id, message_id) -> seq of the delete / the newest edit
+        self._deleted: dict[tuple[int, int], int] = {}
+        self._edits: dict[tuple[int, int], dict] = {}
+        # (guild_id, channel_id) -> prune seqs and, from each on, the latest cutoff
+        self._prunes: dict[tuple[int, int], list[tuple[int, float]]] = {}
+        self._prune_index = None
+        # (guild_id, channel_id, level, start) -> seq of the newest summary
+        self._summaries: dict[tuple, int] = {}
+        # (guild_id, channel_id) -> [(seq, start, end)] of weekly summaries
+        self._weeks: dict[tuple[int, int], list[tuple[int, float, float]]] = {}
+
+    def see(self, record):
+        op = record["op"]
+        if op == "forget":
+            self.forgotten[record["guild_id"]] = record["seq"]
+        elif op == "edit":
+            self._edits[(record["guild_id"], record["message_id"])] = record
+        elif op == "delete":
+            for message_id in record["message_ids"]:
+                self._deleted[(record["guild_id"], message_id)] = record["seq"]
+        elif op == "prune":
+            key = (record["guild_id"], record["channel_id"])
+            self._prunes.setdefault(key, []).append((record["seq"], record["before"]))
+        elif op == "summary":
+            summary = record["summary"]
+            key = (record["guild_id"], summary["channel_id"])
+            self._summaries[key + (summary["level"], summary["start"])] = record["seq"]
+            if summary["level"] == "week":
+                self._weeks.setdefault(key, []).append((record["seq"], summary["start"], summary["end"]))
+
+    def _pruned_before(self, key, seq):
+        """The latest cutoff of the prunes of ``key`` written after ``seq``."""
+        if self._prune_index is None:
+            self._prune_index = {}
+            for prune_key, prunes in self._prunes.items():
+                seqs = [prune_seq for prune_seq, _ in prunes]
+                latest = [before for _, before in prunes]
+                for i in range(len(latest) - 2, -1, -1):
+                    latest[i] = max(latest[i], latest[i + 1])
+                self._prune_index[prune_key] = (seqs, latest)
+        index = self._prune_index.get(key)
+        if index is None:
+            return None
+        seqs, latest = index
+        i = bisect.bisect_right(seqs, seq)
+        return latest[i] if i < len(seqs) else None
+
+    def keeps(self, record):
+        guild_id, seq = record["guild_id"], record["seq"]
+        if seq <= self.forgotten.get(guild_id, 0):
+            return False
+        op = record["op"]
+        if op == "add":
+            message_id = record["message"].get("message_id")
+            if message_id and self._deleted.get((guild_id, message_id), 0) > seq:
+                return False
+            before = self._pruned_before((guild_id, record["message"]["channel_id"]), seq)
+            return before is None or posted_ts(record["message"]) >= before
+        if op == "summary":
+            summary = record["summary"]
+            key = (guild_id, summary["channel_id"])
+            if self._summaries.get(key + (summary["level"], summary["start"]), seq) > seq:
+                return False
+            # days rolled up into a week
+            return summary["level"] != "day" or not any(
+                week_seq > seq and start <= summary["start"] < end
+                for week_seq, start, end in self._weeks.get(key, ()))
+        # forget, prune, edit and delete records have been applied
+        return False
+
+    def applied(self, record):
+        """``record``, with the text of a later edit if its message has one."""
+        if record["op"] != "add" or record["message"]["is_image"]:
+            return record
+        edit = self._edits.get((record["guild_id"], record["message"].get("message_id")))
+        if edit is None or edit["seq"] < record["seq"]:
+            return record
+        message = dict(record["message"], just_msg=edit["just_msg"], message_str=edit["message_str"])
+        return dict(record, message=message)
+
+
+class MessageStore:
+    def __init__(self, directory, compact_every=None, fsync=None):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.snapshot_path = self.directory / SNAPSHOT_NAME
+        self.sealed_path = self.directory / SEALED_NAME
+        self.journal_path = self.directory / JOURNAL_NAME
+        self.compact_every = compact_every or settings.MESSAGE_STORE_COMPACT_EVERY
+        self.fsync = settings.MESSAGE_STORE_FSYNC if fsync is None else fsync
+
+        self._lock = threading.Lock()
+        self._compacting = None
+        self._since_compaction = 0
+        self._seq = self._recover()
+        self._journal = open(self.journal_path, "a", encoding="utf-8")
+
+    # -- recovery ---------------------------------------------------------
+
+    def _recover(self):
+        """Drop torn tail writes and return the highest seq on disk."""
+        last_seq = self._snapshot_seq()
+        for path in (self.sealed_path, self.journal_path):
+            if not path.is_file():
+                continue
+            good_offset = 0
+            with open(path, "rb") as file:
+                for line in file:
+                    if not line.endswith(b"\n"):
+                        break
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break
+                    good_offset += len(line)
+                    last_seq = max(last_seq, record["seq"])
+            if good_offset != path.stat().st_size:
+                logger.warning(f"Truncating torn tail of {path} at byte {good_offset}")
+                with open(path, "r+b") as file:
+                    file.truncate(good_offset)
+        return last_seq
+
+    def _snapshot_seq(self):
+        if not self.snapshot_path.is_file():
+            return 0
+        with open(self.snapshot_path, "r", encoding="utf-8") as file:
+            header = file.readline()
+        return json.loads(header)["seq"] if header else 0
+
+    # -- reading ----------------------------------------------------------
+
+    def _iter_file(self, path, after_seq=0):
+        if not path.is_file():
+            return
+        with open(path, "r", encoding="utf-8") as file:
+            for line in file:
+                record = json.loads(line)
+                if "version" in record:
+                    continue  # snapshot header
+                if record["seq"] > after_seq:
+                    yield record
+
+    def iter_records(self):
+        """Yield every record on disk, oldest first, without duplicates."""
+        if self._compacting is not None:
+            self._compacting.join()
+        self._journal.flush()
+        snapshot_seq = self._snapshot_seq()
+        yield from self._iter_file(self.snapshot_path)
+        yield from self._iter_file(self.sealed_path, after_seq=snapshot_seq)
+        yield from self._iter_file(self.journal_path, after_seq=snapshot_seq)
+
+    def _iter_surviving(self, op, guild_id=None):
+        tombstones = _Tombstones()
+        for record in self.iter_records():
+            tombstones.see(record)
+        for record in self.iter_records():
+            if record["op"] != op or (guild_id is not None and record["guild_id"] != guild_id):
+                continue
+            if tombstones.keeps(record):
+                yield tombstones.applied(record)
+
+    def iter_messages(self, guild_id=None):
+        """Stream ``(guild_id, Message)`` pairs that survive every ``forget``,
+        ``prune`` and ``delete``, as last edited."""
+        for record in self._iter_surviving("add", guild_id):
+            yield record["guild_id"], Message.model_validate(record["message"])
+
+    def iter_summaries(self, guild_id=None):
+        """Stream ``(guild_id, summary)`` for the summaries in effect."""
+        for record in self._iter_surviving("summary", guild_id):
+            yield record["guild_id"], record["summary"]
+
+    def load(self):
+        """Replay the store into ``{guild_id: [Message, ...]}``."""
+        messages: dict[int, list[Message]] = {}
+        for guild_id, message in self.iter_messages():
+            messages.setdefault(guild_id, []).append(message)
+        return messages
+
+    # -- writing ----------------------------------------------------------
+
+    def _write(self, record):
+        self._seq += 1
+        record["seq"] = self._seq
+        self._journal.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+    def _commit(self, count):
+        self._journal.flush()
+        if self.fsync:
+            os.fsync(self._journal.fileno())
+        self._since_compaction += count
+        if self._since_compaction >= self.compact_every:
+            self.compact()
+
+    def append(self, guild_id, message):
+        with self._lock:
+            self._write({
+                "op": "add",
+                "guild_id": guild_id,
+                "message": message.model_dump(mode="json")})
+        self._commit(1)
+
+    def extend(self, guild_id, messages):
+        count = 0
+        with self._lock:
+            for message in messages:
+                self._write({
+                    "op": "add",
+                    "guild_id": guild_id,
+                    "message": message.model_dump(mode="json")})
+                count += 1
+        self._commit(count)
+
+    def edit(self, guild_id, channel_id, message_id, just_msg, message_str):
+        with self._lock:
+            self._write({
+                "op": "edit",
+                "guild_id": guild_id,
+                "channel_id": channel_id,
+                "message_id": message_id,
+                "just_msg": just_msg,
+                "message_str": message_str})
+        self._commit(1)
+
+    def delete(self, guild_id, channel_id, message_ids):
+        with self._lock:
+            self._write({
+                "op": "delete",
+                "guild_id": guild_id,
+                "channel_id": channel_id,
+                "message_ids": list(message_ids)})
+        self._commit(1)
+
+    def forget(self, guild_id):
+        with self._lock:
+            self._write({"op": "forget", "guild_id": guild_id})
+        self._commit(1)
+
+    def prune(self, guild_id, channel_id, before, summaries=()):
+        """Drop a channel's messages posted before ``before`` (epoch seconds),
+        journaled together with the ``summaries`` that replace them."""
+        with self._lock:
+            for summary in summaries:
+                self._write({"op": "summary", "guild_id": guild_id, "summary": summary})
+            self._write({"op": "prune", "guild_id": guild_id, "channel_id": channel_id, "before": before})
+        self._commit(len(summaries) + 1)
+
+    def add_summaries(self, guild_id, summaries):
+        with self._lock:
+            for summary in summaries:
+                self._write({"op": "summary", "guild_id": guild_id, "summary": summary})
+        self._commit(len(summaries))
+
+    # -- compaction -------------------------------------------------------
+
+    def compact(self, wait=False):
+        """Seal the live journal and fold it into the snapshot in the background."""
+        with self._lock:
+            if self._compacting is not None and self._compacting.is_alive():
+                if wait:
+                    self._compacting.join()
+                return
+            self._since_compaction = 0
+            self._journal.flush()
+            # A sealed journal left behind by a crash is merged first and the
+            # live journal is sealed on the next round.
+            if not self.sealed_path.exists():
+                self._journal.close()
+                os.replace(self.journal_path, self.sealed_path)
+                self._journal = open(self.journal_path, "a", encoding="utf-8")
+            self._compacting = threading.Thread(
+                target=self._merge_sealed, name="message-store-compaction", daemon=True)
+            self._compacting.start()
+        if wait:
+            self._compacting.join()
+
+    def _merge_sealed(self):
+        snapshot_seq = self._snapshot_seq()
+
+        def merged():
+            yield from self._iter_file(self.snapshot_path)
+            yield from self._iter_file(self.sealed_path, after_seq=snapshot_seq)
+
+        # pass 1: find what forgets, prunes, deletes and newer summaries
+        # remove, and the newest edit of every message
+        last_seq = snapshot_seq
+        tombstones = _Tombstones()
+        for record in merged():
+            last_seq = max(last_seq, record["seq"])
+            tombstones.see(record)
+
+        # pass 2: keep only the messages and summaries nothing removed, as
+        # last edited
+        tmp_path = self.snapshot_path.with_suffix(".tmp")
+        kept = 0
+        with open(tmp_path, "w", encoding="utf-8") as out:
+            out.write(json.dumps({"version": SNAPSHOT_VERSION, "seq": last_seq}) + "\n")
+            for record in merged():
+                if not tombstones.keeps(record):
+                    continue
+                out.write(json.dumps(tombstones.applied(record), separators=(",", ":")) + "\n")
+                kept += 1
+            out.flush()
+            os.fsync(out.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        _fsync_dir(self.directory)
+        self.sealed_path.unlink(missing_ok=True)
+        logger.info(f"Compacted message store: {kept} records up to seq {last_seq}")
+
+    def close(self):
+        if self._compacting is not None:
+            self._compacting.join()
+        with self._lock:
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+            self._journal.close()
+
+
+def _fsync_dir(directory):
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def read_records(directory, after_seq=0, attempts=10):
+    """Yield the records after ``after_seq`` without opening the store.
+
+    Meant for other processes (see ``reindex.py``) while the bot keeps
+    appending and compacting: a torn last line is left for the next read, and
+    if a compaction moves records while they are read (a hole in the
+    contiguous journal seqs), the read restarts from the last record yielded.
+    """
+    directory = Path(directory)
+    last = after_seq
+    for _ in range(attempts):
+        snapshot_seq = 0
+        try:
+            with open(directory / SNAPSHOT_NAME, "r", encoding="utf-8") as file:
+                for line in file:
+                    record = json.loads(line)
+                    if "version" in record:
+                        snapshot_seq = record["seq"]
+                    elif record["seq"] > last:
+                        last = record["seq"]
+                        yield record
+        except FileNotFoundError:
+            pass
+        # everything past the snapshot is journaled with consecutive seqs
+        expected = max(last, snapshot_seq)
+        consistent = True
+        for name in (SEALED_NAME, JOURNAL_NAME):
+            try:
+                with open(directory / name, "rb") as file:
+                    for line in file:
+                        if not line.endswith(b"\n"):
+                            break
+                        record = json.loads(line)
+                        if record["seq"] <= expected:
+                            continue
+                        if record["seq"] != expected + 1:
+                            consistent = False
+                            break
+                        expected = last = record["seq"]
+                        yield record
+            except FileNotFoundError:
+                continue
+            if not consistent:
+                break
+        if consistent:
+            return
+    raise RuntimeError(f"{directory} kept changing while it was read")
+
+
+def migrate_pickle(pickle_path, store):
+    """One-shot import of the legacy ``messages.pkl`` into ``store``.
+
+    The pickle is renamed to ``*.migrated`` afterwards so it is never imported
+    twice. Returns the number of migrated messages.
+    """
+    pickle_path = Path(pickle_path)
+    if not pickle_path.is_file():
+        return 0
+    with open(pickle_path, "rb") as file:
+        legacy: dict[int, list[Message]] = pickle.load(file)
+    count = 0
+    for guild_id, messages in legacy.items():
+        store.extend(guild_id, messages)
+        count += len(messages)
+    store.compact(wait=True)
+    pickle_path.rename(pickle_path.with_name(pickle_path.name + ".migrated"))
+    logger.info(f"Migrated {count} messages from {pickle_path}")
+    return count
+
+
+if __name__ == "__main__":
+    import sys
+
+    persist_dir = sys.argv[1] if len(sys.argv) > 1 else "./.persist"
+    store = MessageStore(persist_dir)
+    migrated = migrate_pickle(Path(persist_dir) / "messages.pkl", store)
+    store.close()
+    print(f"Migrated {migrated} messages into {persist_dir}")
@@ -0,0 +1,152 @@
+"""Per-stage latencies, counters and gauges, exported in the Prometheus text format.
+
+Stages are timed with ``metrics.timer(stage, guild_id)``. The last
+``window`` samples of every stage, overall and per guild, give the
+p50/p95/p99 that ``/stats`` shows and ``/metrics`` exports as summaries.
+Gauges (queue depths, cache hit rates) are callables read at render time,
+so reading them costs nothing on the hot path.
+"""
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import numpy as np
+from aiohttp import web
+
+import settings
+
+
+logger = settings.logging.getLogger("bot")
+
+QUANTILES = (0.5, 0.95, 0.99)
+PREFIX = "ragent_"
+
+
+def _labels(**labels):
+    pairs = [f'{key}="{value}"' for key, value in labels.items() if value is not None]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _sort_key(key):
+    stage, guild_id = key
+    return stage, guild_id or 0
+
+
+class Metrics:
+    def __init__(self, window=None, guild_labels=None):
+        self.window = window or settings.METRICS_WINDOW
+        self.guild_labels = settings.METRICS_GUILD_LABELS if guild_labels is None else guild_labels
+        # (stage, guild_id or None) -> recent samples, and all-time count/sum
+        self._samples: dict[tuple[str, int | None], deque[float]] = {}
+        self._totals: dict[tuple[str, int | None], list] = {}
+        # (name, sorted label items) -> value
+        self._counters: dict[tuple[str, tuple], float] = {}
+        # name -> (help, fn)
+        self._gauges = {}
+
+    def observe(self, stage, seconds, guild_id=None):
+        keys = [(stage, None)] if guild_id is None else [(stage, None), (stage, guild_id)]
+        for key in keys:
+            samples = self._samples.get(key)
+            if samples is None:
+                samples = self._samples[key] = deque(maxlen=self.window)
+                self._totals[key] = [0, 0.0]
+            samples.append(seconds)
+            totals = self._totals[key]
+            totals[0] += 1
+            totals[1] += seconds
+
+    @contextmanager
+    def timer(self, stage, guild_id=None):
+        """Time the block as ``stage``; failures are counted, not timed."""
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.inc("stage_errors", stage=stage)
+            raise
+        self.observe(stage, time.perf_counter() - started, guild_id)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def gauge(self, name, fn, help=""):
+        self._gauges[name] = (help, fn)
+
+    def quantiles(self, stage, guild_id=None):
+        samples = self._samples.get((stage, guild_id))
+        if not samples:
+            return None
+        return dict(zip(QUANTILES, np.quantile(np.fromiter(samples, dtype=float), QUANTILES)))
+
+    def stages(self, guild_id=None):
+        """``(stage, count, {quantile: seconds})`` of every stage seen for a
+        guild, or overall."""
+        return [
+            (stage, self._totals[(stage, guild)][0], self.quantiles(stage, guild))
+            for stage, guild in sorted(self._samples, key=_sort_key) if guild == guild_id
+        ]
+
+    def gauges(self):
+        values = {}
+        for name, (_, fn) in self._gauges.items():
+            try:
+                values[name] = float(fn())
+            except Exception as err:
+                logger.warning(f"Reading gauge {name} failed: {err!r}")
+        return values
+
+    def render(self):
+        """Everything in the Prometheus text exposition format."""
+        lines = [
+            f"# HELP {PREFIX}stage_seconds Latency of each stage, over the last {self.window} samples",
+            f"# TYPE {PREFIX}stage_seconds summary",
+        ]
+        for stage, guild_id in sorted(self._samples, key=_sort_key):
+            if guild_id is not None and not self.guild_labels:
+                continue
+            guild = None if guild_id is None else str(guild_id)
+            for quantile, seconds in self.quantiles(stage, guild_id).items():
+                lines.append(f"{PREFIX}stage_seconds{_labels(stage=stage, guild=guild, quantile=quantile)} {seconds:.6f}")
+            count, total = self._totals[(stage, guild_id)]
+            lines.append(f"{PREFIX}stage_seconds_sum{_labels(stage=stage, guild=guild)} {total:.6f}")
+            lines.append(f"{PREFIX}stage_seconds_count{_labels(stage=stage, guild=guild)} {count}")
+
+        seen = set()
+        for (name, labels), value in sorted(self._counters.items()):
+            if name not in seen:
+                seen.add(name)
+                lines.append(f"# TYPE {PREFIX}{name}_total counter")
+            lines.append(f"{PREFIX}{name}_total{_labels(**dict(labels))} {value}")
+
+        values = self.gauges()
+        for name, (help, _) in sorted(self._gauges.items()):
+            if name not in values:
+                continue
+            if help:
+                lines.append(f"# HELP {PREFIX}{name} {help}")
+            lines.append(f"# TYPE {PREFIX}{name} gauge")
+            lines.append(f"{PREFIX}{name} {values[name]}")
+        return "\n".join(lines) + "\n"
+
+
+async def serve(metrics, host=None, port=None):
+    """Serve ``metrics.render()`` at ``http://host:port/metrics``; returns the
+    runner, whose ``cleanup()`` stops the server."""
+    async def handle(request):
+        return web.Response(
+            body=metrics.render().encode(),
+            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host or settings.METRICS_HOST, port or settings.METRICS_PORT)
+    await site.start()
+    return runner
+
+
+# one registry for the whole process; modules import it and record into it
+metrics = Metrics()
@@ -0,0 +1,193 @@
+"""Deterministic stand-ins for the embedding models and the LLM.
+
+``USE_MOCK=1`` selects them, so RAgent runs (and is benchmarked, see
+``benchmarks/end_to_end.py``) without any API key or model download.
+Embeddings hash words into a fixed number of dimensions, so texts that share
+words are similar and retrieval behaves plausibly. Every call sleeps for a
+configurable latency that stands in for the provider's round trip.
+"""
+import asyncio
+import hashlib
+import re
+import time
+from typing import Any, List, Sequence
+
+import numpy as np
+from llama_index.core.base.embeddings.base import BaseEmbedding, Embedding
+from llama_index.core.base.llms.types import (
+    ChatMessage,
+    ChatResponse,
+    ChatResponseAsyncGen,
+    CompletionResponse,
+    CompletionResponseAsyncGen,
+    CompletionResponseGen,
+    LLMMetadata,
+    MessageRole,
+)
+from llama_index.core.bridge.pydantic import Field
+from llama_index.core.embeddings import MultiModalEmbedding
+from llama_index.core.llms.callbacks import llm_chat_callback, llm_completion_callback
+from llama_index.core.llms.custom import CustomLLM
+from llama_index.core.schema import ImageType
+
+
+TOKEN = re.compile(r"\w+")
+
+
+def _hash(data):
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "little")
+
+
+def hash_embedding(text, dim):
+    """Unit vector of the signed hashes of ``text``'s lowercased words."""
+    vector = np.zeros(dim, dtype=np.float32)
+    for token in TOKEN.findall(text.lower()):
+        h = _hash(token.encode())
+        vector[h % dim] += 1.0 if (h >> 32) & 1 else -1.0
+    norm = np.linalg.norm(vector)
+    if not norm:
+        vector[0] = norm = 1.0
+    return (vector / norm).tolist()
+
+
+class HashEmbedding(BaseEmbedding):
+    dim: int = Field(default=256, description="Embedding size.")
+    latency: float = Field(default=0.0, description="Seconds every call (one batch) takes.")
+
+    def __init__(self, dim=256, latency=0.0, model_name=None, **kwargs):
+        super().__init__(model_name=model_name or f"mock-hash-{dim}", dim=dim, latency=latency, **kwargs)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "HashEmbedding"
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        time.sleep(self.latency)
+        return [hash_embedding(text, self.dim) for text in texts]
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        await asyncio.sleep(self.latency)
+        return [hash_embedding(text, self.dim) for text in texts]
+
+    def _get_text_embedding(self, text: str) -> Embedding:
+        return self._get_text_embeddings([text])[0]
+
+    async def _aget_text_embedding(self, text: str) -> Embedding:
+        return (await self._aget_text_embeddings([text]))[0]
+
+    def _get_query_embedding(self, query: str) -> Embedding:
+        return self._get_text_embedding(query)
+
+    async def _aget_query_embedding(self, query: str) -> Embedding:
+        return await self._aget_text_embedding(query)
+
+
+class HashImageEmbedding(MultiModalEmbedding, HashEmbedding):
+    """Images embed to a random unit vector seeded with their bytes."""
+
+    def __init__(self, dim=512, latency=0.0, **kwargs):
+        super().__init__(dim=dim, latency=latency, model_name=f"mock-image-{dim}", **kwargs)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "HashImageEmbedding"
+
+    def _image_embedding(self, img_file_path: ImageType) -> Embedding:
+        if isinstance(img_file_path, str):
+            with open(img_file_path, "rb") as file:
+                data = file.read()
+        else:
+            data = img_file_path.getvalue()
+        rng = np.random.default_rng(_hash(data))
+        vector = rng.standard_normal(self.dim).astype(np.float32)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def _get_image_embedding(self, img_file_path: ImageType) -> Embedding:
+        time.sleep(self.latency)
+        return self._image_embedding(img_file_path)
+
+    async def _aget_image_embedding(self, img_file_path: ImageType) -> Embedding:
+        await asyncio.sleep(self.latency)
+        return self._image_embedding(img_file_path)
+
+    def _get_image_embeddings(self, img_file_paths: List[ImageType]) -> List[Embedding]:
+        time.sleep(self.latency)
+        return [self._image_embedding(path) for path in img_file_paths]
+
+
+class MockChatLLM(CustomLLM):
+    """Answers with the last words of its prompt, one token at a time.
+
+    ``latency`` passes before the first token and ``token_latency`` between
+    tokens, so streaming and time-to-first-token behave like a real model.
+    """
+
+    latency: float = Field(default=0.0, description="Seconds before the first token.")
+    token_latency: float = Field(default=0.0, description="Seconds between tokens.")
+    answer_tokens: int = Field(default=32, description="Words in every answer.")
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "MockChatLLM"
+
+    @property
+    def metadata(self) -> LLMMetadata:
+        return LLMMetadata(context_window=128_000, num_output=self.answer_tokens, model_name="mock")
+
+    def _tokens(self, prompt):
+        words = prompt.split()[-self.answer_tokens:]
+        return [word + " " for word in words] or ["..."]
+
+    @llm_completion_callback()
+    def complete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponse:
+        tokens = self._tokens(prompt)
+        time.sleep(self.latency + self.token_latency * len(tokens))
+        return CompletionResponse(text="".join(tokens))
+
+    @llm_completion_callback()
+    def stream_complete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponseGen:
+        def gen():
+            text = ""
+            time.sleep(self.latency)
+            for token in self._tokens(prompt):
+                time.sleep(self.token_latency)
+                text += token
+                yield CompletionResponse(text=text, delta=token)
+        return gen()
+
+    @llm_completion_callback()
+    async def acomplete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponse:
+        tokens = self._tokens(prompt)
+        await asyncio.sleep(self.latency + self.token_latency * len(tokens))
+        return CompletionResponse(text="".join(tokens))
+
+    @llm_completion_callback()
+    async def astream_complete(
+            self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponseAsyncGen:
+        async def gen():
+            text = ""
+            await asyncio.sleep(self.latency)
+            for token in self._tokens(prompt):
+                await asyncio.sleep(self.token_latency)
+                text += token
+                yield CompletionResponse(text=text, delta=token)
+        return gen()
+
+    # CustomLLM runs the async chat methods synchronously, which would block
+    # the event loop for the whole simulated latency
+
+    @llm_chat_callback()
+    async def achat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponse:
+        response = await self.acomplete(self.messages_to_prompt(messages), formatted=True)
+        return ChatResponse(message=ChatMessage(role=MessageRole.ASSISTANT, content=response.text))
+
+    @llm_chat_callback()
+    async def astream_chat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponseAsyncGen:
+        completions = await self.astream_complete(self.messages_to_prompt(messages), formatted=True)
+
+        async def gen():
+            async for response in completions:
+                yield ChatResponse(
+                    message=ChatMessage(role=MessageRole.ASSISTANT, content=response.text),
+                    delta=response.delta)
+        return gen()
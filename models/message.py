@@ -9,3 +9,6 @@ class Message(BaseModel):
   author: str
   channel_id: int
   just_msg: str
+  # the Discord ids, unknown for messages remembered before they were kept
+  message_id: int | None = None
+  attachment_id: int | None = None
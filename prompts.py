@@ -18,3 +18,39 @@ prompt_template = (
 
 
 prompt = PromptTemplate(prompt_template)
+
+
+summary_prompt_template = (
+  "You are maintaining a running summary of a discord channel so that RAgent can keep track of long conversations.\n"
+  "Current summary:\n"
+  "---------------------\n"
+  "{summary}"
+  "\n---------------------\n"
+  "Newer chat messages, in the format @user: message:\n"
+  "---------------------\n"
+  "{messages}"
+  "\n---------------------\n"
+  "Rewrite the summary so that it also covers the newer messages. Keep who said what, decisions, open questions, links and commands. "
+  "Use at most {max_words} words and reply with the summary only."
+)
+
+
+summary_prompt = PromptTemplate(summary_prompt_template)
+
+
+rollup_prompt_template = (
+  "You are condensing old summaries of a discord channel so that RAgent can still answer questions about old discussions.\n"
+  "Current summary of this week:\n"
+  "---------------------\n"
+  "{summary}"
+  "\n---------------------\n"
+  "Summaries of single days of the same week, in the format date: summary:\n"
+  "---------------------\n"
+  "{days}"
+  "\n---------------------\n"
+  "Write one summary of the whole week that covers all of the above. Keep who said what, decisions, open questions, links and commands. "
+  "Use at most {max_words} words and reply with the summary only."
+)
+
+
+rollup_prompt = PromptTemplate(rollup_prompt_template)
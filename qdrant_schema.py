@@ -0,0 +1,226 @@
+"""Layout of the Qdrant collections, created or migrated at startup.
+
+Every search filters on ``guild_id``, so the collections are set up the way
+Qdrant recommends for multi-tenancy: no global HNSW graph (``m=0``) and a
+graph per payload value instead (``payload_m``), built for the integer and
+keyword fields that have payload indexes. Scalar quantization and on-disk
+vectors are optional.
+
+The text collection records the embedding model and size its vectors were
+made with (and the keyword index built alongside it) in a marker point, so
+a bot that follows the alias to a new version knows which model to query
+it with.
+
+Running this module bootstraps the collections without starting the bot::
+
+    python qdrant_schema.py --dim 1536
+"""
+import argparse
+import asyncio
+import uuid
+from dataclasses import dataclass
+
+from qdrant_client.http import models as rest
+
+import settings
+
+
+logger = settings.logging.getLogger("bot")
+
+_MATCH = rest.IntegerIndexParams(type=rest.IntegerIndexType.INTEGER, lookup=True, range=False)
+_RANGE = rest.IntegerIndexParams(type=rest.IntegerIndexType.INTEGER, lookup=False, range=True)
+
+# payload field -> index; posted_ts is the message time in epoch seconds,
+# message_ids the Discord messages a point was built from (for edits and
+# deletes)
+PAYLOAD_INDEXES = {
+    "guild_id": _MATCH,
+    "channel_id": _MATCH,
+    "author": rest.PayloadSchemaType.KEYWORD,
+    "posted_ts": _RANGE,
+    "message_ids": _MATCH,
+}
+
+
+# the marker has no guild_id, so no search or guild-scoped delete touches it
+MARKER_ID = str(uuid.uuid5(uuid.NAMESPACE_URL, "ragent-collection-marker"))
+MARKER_KEY = "collection_marker"
+
+
+@dataclass
+class CollectionLayout:
+    on_disk: bool = False
+    quantization: bool = False
+    payload_m: int = 16
+    m: int = 0  # 0: only the per-tenant graphs, filtered search is all we do
+
+    @classmethod
+    def from_settings(cls):
+        return cls(
+            on_disk=settings.QDRANT_ON_DISK,
+            quantization=settings.QDRANT_QUANTIZATION,
+            payload_m=settings.QDRANT_PAYLOAD_M,
+            m=settings.QDRANT_HNSW_M)
+
+    def hnsw(self):
+        return rest.HnswConfigDiff(m=self.m, payload_m=self.payload_m, on_disk=self.on_disk)
+
+    def quantization_config(self):
+        if not self.quantization:
+            return None
+        return rest.ScalarQuantization(scalar=rest.ScalarQuantizationConfig(
+            type=rest.ScalarType.INT8, quantile=0.99, always_ram=True))
+
+
+async def ensure_collection(client, name, vector_size, layout=None):
+    """Create ``name`` with ``layout``, or migrate an existing collection to it.
+
+    ``client`` is an ``AsyncQdrantClient``. Returns ``True`` if anything changed.
+    """
+    layout = layout or CollectionLayout.from_settings()
+    if not await client.collection_exists(name):
+        logger.info(f"Creating Qdrant collection {name} ({vector_size} dims)")
+        await client.create_collection(
+            collection_name=name,
+            vectors_config=rest.VectorParams(
+                size=vector_size,
+                distance=rest.Distance.COSINE,
+                on_disk=layout.on_disk),
+            hnsw_config=layout.hnsw(),
+            quantization_config=layout.quantization_config())
+        await _ensure_payload_indexes(client, name, {})
+        return True
+
+    info = await client.get_collection(name)
+    changed = await _ensure_payload_indexes(client, name, info.payload_schema or {})
+    hnsw = info.config.hnsw_config
+    vectors = info.config.params.vectors
+    update = {}
+    if hnsw.m != layout.m or hnsw.payload_m != layout.payload_m:
+        update["hnsw_config"] = layout.hnsw()
+    if isinstance(vectors, rest.VectorParams) and bool(vectors.on_disk) != layout.on_disk:
+        update["vectors_config"] = {"": rest.VectorParamsDiff(on_disk=layout.on_disk)}
+    if layout.quantization and info.config.quantization_config is None:
+        update["quantization_config"] = layout.quantization_config()
+    elif not layout.quantization and info.config.quantization_config is not None:
+        update["quantization_config"] = rest.Disabled.DISABLED
+    if update:
+        logger.info(f"Migrating Qdrant collection {name}: {', '.join(update)}")
+        await client.update_collection(collection_name=name, **update)
+    return changed or bool(update)
+
+
+async def resolve_alias(client, alias):
+    """The collection ``alias`` points at, or ``None``."""
+    for description in (await client.get_aliases()).aliases:
+        if description.alias_name == alias:
+            return description.collection_name
+    return None
+
+
+async def ensure_aliased_collection(client, alias, vector_size, layout=None):
+    """Like ``ensure_collection``, for a collection that is addressed by an alias.
+
+    New deployments get ``<alias>_v1`` behind the alias, so ``reindex.py`` can
+    later build ``<alias>_v2`` and switch to it atomically. A collection
+    created under the plain name before versioning is left where it is.
+    """
+    target = await resolve_alias(client, alias)
+    if target is None and await client.collection_exists(alias):
+        return await ensure_collection(client, alias, vector_size, layout)
+    if target is None:
+        target = f"{alias}_v1"
+        await ensure_collection(client, target, vector_size, layout)
+        await switch_alias(client, alias, target)
+        return True
+    return await ensure_collection(client, target, vector_size, layout)
+
+
+async def switch_alias(client, alias, target, attempts=3):
+    """Point ``alias`` at ``target`` and return what it pointed at before.
+
+    Moving an alias is a single atomic request, so searches never see a
+    missing collection. The exception is a collection created under the
+    alias's name before versioning: it has to be deleted before the alias can
+    take its name, which leaves a gap of one request.
+    """
+    current = await resolve_alias(client, alias)
+    if current is not None:
+        await client.update_collection_aliases(change_aliases_operations=[
+            rest.DeleteAliasOperation(delete_alias=rest.DeleteAlias(alias_name=alias)),
+            rest.CreateAliasOperation(create_alias=rest.CreateAlias(
+                collection_name=target, alias_name=alias)),
+        ])
+        return current
+    for attempt in range(attempts):
+        if await client.collection_exists(alias):
+            logger.warning(f"Deleting unversioned collection {alias} to put the alias in its place")
+            await client.delete_collection(alias)
+        try:
+            await client.update_collection_aliases(change_aliases_operations=[
+                rest.CreateAliasOperation(create_alias=rest.CreateAlias(
+                    collection_name=target, alias_name=alias)),
+            ])
+            return alias
+        except Exception:
+            # an insert recreated the plain collection in between
+            if attempt == attempts - 1:
+                raise
+
+
+async def read_marker(client, name):
+    """The marker of collection ``name`` (``model``, ``dim``, ``keyword_index``
+    and ``serving``), or ``None``."""
+    records = await client.retrieve(collection_name=name, ids=[MARKER_ID], with_payload=True)
+    return records[0].payload.get(MARKER_KEY) if records else None
+
+
+async def write_marker(client, name, model, dim, keyword_index=None, serving=False):
+    """Record what the vectors of collection ``name`` were embedded with.
+
+    ``serving`` is set by the bot once it queries and ingests with ``model``
+    (see ``mark_serving``).
+    """
+    marker = {"model": model, "dim": dim, "keyword_index": keyword_index, "serving": serving}
+    await client.upsert(collection_name=name, points=[
+        rest.PointStruct(id=MARKER_ID, vector=[1.0] + [0.0] * (dim - 1), payload={MARKER_KEY: marker}),
+    ])
+    return marker
+
+
+async def mark_serving(client, name):
+    marker = await read_marker(client, name)
+    if marker is not None:
+        await client.set_payload(
+            collection_name=name, payload={MARKER_KEY: dict(marker, serving=True)}, points=[MARKER_ID])
+
+
+async def _ensure_payload_indexes(client, name, existing):
+    created = False
+    for field, schema in PAYLOAD_INDEXES.items():
+        if field in existing:
+            continue
+        await client.create_payload_index(
+            collection_name=name,
+            field_name=field,
+            field_schema=schema,
+            wait=True)
+        created = True
+    return created
+
+
+if __name__ == "__main__":
+    from qdrant_client import AsyncQdrantClient
+
+    parser = argparse.ArgumentParser(description="Create or migrate the RAgent Qdrant collections.")
+    parser.add_argument("--dim", type=int, required=True, help="text embedding size")
+    parser.add_argument("--image-dim", type=int, default=512, help="image embedding size")
+    args = parser.parse_args()
+
+    async def main():
+        client = AsyncQdrantClient(url=settings.QDRANT_URL, api_key=settings.QDRANT_API_KEY)
+        await ensure_aliased_collection(client, settings.QDRANT_COLLECTION, args.dim)
+        await ensure_collection(client, settings.QDRANT_IMAGE_COLLECTION, args.image_dim)
+        await client.close()
+
+    asyncio.run(main())
@@ -1,44 +1,91 @@
 from llama_index.core import StorageContext
 from llama_index.core.indices import MultiModalVectorStoreIndex
 from llama_index.core import Settings
-from llama_index.core.postprocessor import FixedRecencyPostprocessor
 
 from llama_index.vector_stores.qdrant import QdrantVectorStore
-from llama_index.core.schema import TextNode, QueryBundle, ImageNode
+from llama_index.core.schema import TextNode, QueryBundle, ImageNode, NodeWithScore, MetadataMode
+from llama_index.core.vector_stores.utils import metadata_dict_to_node
+from llama_index.core.base.response.schema import AsyncStreamingResponse
 from llama_index.core.vector_stores.types import (
     MetadataFilter,
     MetadataFilters,
     FilterOperator,
+    FilterCondition,
 )
 from llama_index.core import set_global_handler
-from llama_index.core.base.llms.types import ChatMessage, MessageRole
+from llama_index.core import get_response_synthesizer
 import qdrant_client
+from qdrant_client.http import models as rest
 import os
-import aiohttp
+import time
+import uuid
+from datetime import datetime, timezone
 import asyncio
-from PIL import Image
-from io import BytesIO
 
 
 import settings
 from prompts import prompt
-
-set_global_handler("simple")
+from ingest import IngestPipeline
+from concurrency import QueryLimiter
+from embed_cache import EmbeddingCache, CachedEmbedding
+from downloads import ImageDownloader
+from content_store import ImageStore
+from image_proc import ImageProcessor
+from context_builder import ContextBuilder
+from answer_cache import AnswerCache
+from windows import WindowBuilder
+from qdrant_schema import ensure_collection, ensure_aliased_collection, resolve_alias, read_marker, write_marker, mark_serving
+from timescope import parse_time_scope
+from keyword_index import KeywordIndex, reciprocal_rank_fusion
+from metrics import metrics
+from scheduler import Scheduler, ScheduledEmbedding, ScheduledLLM, Coalescer, INTERACTIVE, scheduled
+
+logger = settings.logging.getLogger("bot")
+
+if settings.LLAMA_INDEX_DEBUG:
+  set_global_handler("simple")
 
 # initialize qdrant client
-qd_client = qdrant_client.QdrantClient(
-  url=settings.QDRANT_URL,
-  api_key=settings.QDRANT_API_KEY
-)
+if settings.QDRANT_PATH:
+  # local mode keeps its data in the client, so a second (sync) client would
+  # see an empty database; the async one is all the bot uses
+  qd_client = None
+  qd_aclient = qdrant_client.AsyncQdrantClient(
+    **({"location": ":memory:"} if settings.QDRANT_PATH == ":memory:" else {"path": settings.QDRANT_PATH})
+  )
+else:
+  qd_client = qdrant_client.QdrantClient(
+    url=settings.QDRANT_URL,
+    api_key=settings.QDRANT_API_KEY
+  )
+  # the bot itself only talks to qdrant through the async client
+  qd_aclient = qdrant_client.AsyncQdrantClient(
+    url=settings.QDRANT_URL,
+    api_key=settings.QDRANT_API_KEY
+  )
 
-qd_collection = 'discord_llamabot'
+# the text collection is reached through an alias that reindex.py can move
+# to a version embedded with another model; the bot reads and writes the
+# version the alias pointed at when it last looked (set by
+# bootstrap_collections and follow_text_collection), never the alias itself,
+# so its vectors never land in a collection of another model
+qd_collection = settings.QDRANT_COLLECTION
+qd_image_collection = settings.QDRANT_IMAGE_COLLECTION
 use_openai = bool(os.environ.get("USE_OPENAI", False))
 use_cohere = bool(os.environ.get("USE_COHERE", False))
-
-if use_openai:
+# CLIP by default
+image_embed_model = "clip:ViT-B/32"
+
+if settings.USE_MOCK:
+  from mock_models import HashEmbedding, HashImageEmbedding, MockChatLLM
+  logger.info("Using mock models")
+  llm = MockChatLLM(latency=settings.MOCK_LLM_LATENCY, token_latency=settings.MOCK_LLM_TOKEN_LATENCY)
+  embed_model = HashEmbedding(latency=settings.MOCK_EMBED_LATENCY)
+  image_embed_model = HashImageEmbedding(latency=settings.MOCK_EMBED_LATENCY)
+elif use_openai:
   from llama_index.llms.openai import OpenAI
   from llama_index.embeddings.openai import OpenAIEmbedding
-  print("Using GPT-4")
+  logger.info("Using GPT-4")
   llm=OpenAI(
     #model="gpt-4-0125-preview",
     model="gpt-4o"
@@ -46,17 +93,40 @@ if use_openai:
   embed_model = OpenAIEmbedding(model="text-embedding-3-small")
 elif use_cohere:
   from llama_index.llms import Cohere
-  print("Using Cohere")
+  logger.info("Using Cohere")
   llm=Cohere(api_key=os.environ.get('COHERE_KEY'))
 else:
   from llama_index.llms.gemini import Gemini
-  print("Using Gemini Pro")
+  logger.info("Using Gemini Pro")
   llm=Gemini()
 
+# every embedding and llm call waits for a slot of the shared scheduler:
+# answers go before summaries and ingestion, and guilds take turns
+scheduler = Scheduler()
+llm = ScheduledLLM(llm, scheduler)
+
+# ingestion and retrieval share one embedding cache, in front of the
+# scheduler so that cached texts never wait
+os.makedirs(os.path.dirname(settings.EMBED_CACHE_PATH), exist_ok=True)
+embed_cache = EmbeddingCache(settings.EMBED_CACHE_PATH)
+embed_model = CachedEmbedding(ScheduledEmbedding(embed_model, scheduler), embed_cache)
+
+def load_embed_model(name, dim):
+  """The text embedding model ``name``, wrapped like ``embed_model``; for a
+  collection reindex.py built with another model than the configured one."""
+  if settings.USE_MOCK:
+    model = HashEmbedding(dim=dim, latency=settings.MOCK_EMBED_LATENCY, model_name=name)
+  elif use_openai:
+    model = OpenAIEmbedding(model=name)
+  else:
+    raise ValueError(f"Cannot load embedding model {name}")
+  return CachedEmbedding(ScheduledEmbedding(model, scheduler), embed_cache)
+
 vector_store = QdrantVectorStore(client=qd_client,
+                                aclient=qd_aclient,
                                 collection_name=qd_collection)
 image_store = QdrantVectorStore(
-    client=qd_client, collection_name="image_collection"
+    client=qd_client, aclient=qd_aclient, collection_name=qd_image_collection
 )
 storage_context = StorageContext.from_defaults(vector_store=vector_store, image_store=image_store)
 
@@ -67,186 +137,714 @@ Settings.embed_model = embed_model
 # index = VectorStoreIndex([],
 #                storage_context=storage_context,
 #                          embed_model=embed_model)
-index = MultiModalVectorStoreIndex([], storage_context=storage_context, embed_model=embed_model)
+index = MultiModalVectorStoreIndex(
+  [], storage_context=storage_context, embed_model=embed_model, image_embed_model=image_embed_model)
+
+# messages are embedded and upserted in batches by a background worker,
+# started from the bot's setup_hook and flushed on shutdown
+def _invalidate_answers(nodes):
+  # cached /rag answers drawn from these channels may be stale now that the
+  # new content is searchable
+  for guild_id, channel_id in {(node.metadata['guild_id'], node.metadata['channel_id']) for node in nodes}:
+    answer_cache.invalidate_channel(guild_id, channel_id)
+
+ingestor = IngestPipeline(
+  embed_model=embed_model,
+  text_store=vector_store,
+  image_embed_model=index.image_embed_model,
+  image_store=image_store,
+  image_embed_cache=embed_cache,
+  on_indexed=_invalidate_answers,
+)
 
-def index_message(when, who, msg_content, guild_id, channel):
-  msg_str = f"[{when.strftime('%m-%d-%Y %H:%M:%S')}] - @{who} on #[{str(channel)[:15]}]: `{msg_content}`"
-  
-  node = TextNode(
+async def bootstrap_collections():
+  """Create the collections, or migrate them to the configured layout, and
+  use the text collection the alias points at with the model it records."""
+  text_dim = len(await embed_model.aget_text_embedding("dimension probe"))
+  image_dim = len(await asyncio.to_thread(index.image_embed_model.get_text_embedding, "dimension probe"))
+  await ensure_aliased_collection(qd_aclient, settings.QDRANT_COLLECTION, text_dim)
+  await ensure_collection(qd_aclient, qd_image_collection, image_dim)
+  collection = await resolve_alias(qd_aclient, settings.QDRANT_COLLECTION) or settings.QDRANT_COLLECTION
+  marker = await read_marker(qd_aclient, collection)
+  if marker is None:
+    # built before markers, by this bot and so with its model
+    marker = await write_marker(
+      qd_aclient, collection, embed_model.model_name, text_dim,
+      keyword_index=keyword_index.path if keyword_index is not None else None, serving=True)
+  _use_text_collection(collection, marker)
+
+def _use_text_collection(collection, marker):
+  """Query and ingest ``collection`` with the model its ``marker`` names.
+
+  Everything is swapped without an await in between, and every batch of the
+  ingest workers picks its model and store together, so no vector is written
+  into a collection of another model. Nodes still queued go to the new
+  collection.
+  """
+  global qd_collection, embed_model, vector_store, storage_context, index
+  model = embed_model
+  if marker['model'] != embed_model.model_name:
+    model = load_embed_model(marker['model'], marker['dim'])
+  store = QdrantVectorStore(client=qd_client, aclient=qd_aclient, collection_name=collection)
+  if keyword_index is not None and marker.get('keyword_index') and marker['keyword_index'] != keyword_index.path:
+    keyword_index.switch(marker['keyword_index'])
+  qd_collection = collection
+  embed_model = Settings.embed_model = model
+  vector_store = store
+  storage_context = StorageContext.from_defaults(vector_store=vector_store, image_store=image_store)
+  index = MultiModalVectorStoreIndex(
+    [], storage_context=storage_context, embed_model=embed_model, image_embed_model=index.image_embed_model)
+  ingestor.embed_model = embed_model
+  ingestor.text_store = vector_store
+  invalidate_retrievers()
+  # cached answers were matched by embeddings of the previous model
+  answer_cache.clear()
+  logger.info(f"Using Qdrant collection {collection} with {marker['model']} ({marker['dim']} dims)")
+
+async def follow_text_collection():
+  """Switch to the collection the alias points at, if reindex.py moved it,
+  and tell reindex.py so (it then indexes what the bot remembered meanwhile).
+  Returns whether it switched."""
+  collection = await resolve_alias(qd_aclient, settings.QDRANT_COLLECTION)
+  if collection is None or collection == qd_collection:
+    return False
+  marker = await read_marker(qd_aclient, collection)
+  if marker is None:
+    logger.warning(f"Not switching to Qdrant collection {collection}: it records no embedding model")
+    return False
+  _use_text_collection(collection, marker)
+  await mark_serving(qd_aclient, collection)
+  return True
+
+# exact tokens (error codes, commands, names) are found lexically, and
+# without an embedding call
+keyword_index = KeywordIndex(settings.KEYWORD_INDEX_PATH) if settings.RAG_HYBRID else None
+
+query_limiter = QueryLimiter(settings.RAG_MAX_CONCURRENCY, settings.RAG_MAX_CONCURRENCY_PER_GUILD)
+
+# retrieval objects are built once and reused across /rag calls: one
+# retriever per guild (its guild_id filter is baked in), and a single
+# synthesizer shared by every guild
+synthesizer = get_response_synthesizer(llm=llm, text_qa_template=prompt)
+streaming_synthesizer = get_response_synthesizer(llm=llm, text_qa_template=prompt, streaming=True)
+_retrievers = {}
+# repeated /rag questions are answered without retrieval or an llm call
+answer_cache = AnswerCache()
+
+def _retrieval_config():
+  # anything a cached retriever depends on; a change rebuilds it
+  return (settings.RAG_TOP_K, id(index))
+
+def get_retriever(guild_id, channel_ids=()):
+  """The cached retriever for a guild, optionally narrowed to some channels."""
+  config = _retrieval_config()
+  key = (guild_id, tuple(sorted(channel_ids)))
+  cached = _retrievers.get(key)
+  if cached is None or cached[0] != config:
+    filters = [
+      MetadataFilter(
+        key="guild_id", operator=FilterOperator.EQ, value=guild_id
+      )
+    ]
+    if channel_ids:
+      # FilterOperator.IN stringifies its values and never matches integer
+      # ids, so "channel_id IN (...)" is an OR group of exact matches
+      filters.append(MetadataFilters(
+        filters=[
+          MetadataFilter(key="channel_id", operator=FilterOperator.EQ, value=channel_id)
+          for channel_id in key[1]
+        ],
+        condition=FilterCondition.OR))
+    cached = _retrievers[key] = (
+      config,
+      index.as_retriever(filters=MetadataFilters(filters=filters), similarity_top_k=settings.RAG_TOP_K))
+  return cached[1]
+
+def invalidate_retrievers(guild_id=None):
+  if guild_id is None:
+    _retrievers.clear()
+  else:
+    for key in [key for key in _retrievers if key[0] == guild_id]:
+      del _retrievers[key]
+
+async def _scroll_time_range(guild_id, start, end, channel_ids=()):
+  """The newest messages of a guild within [start, end), without a vector search."""
+  conditions = [
+    rest.FieldCondition(key="guild_id", match=rest.MatchValue(value=guild_id)),
+    rest.FieldCondition(key="posted_ts", range=rest.Range(gte=start, lt=end)),
+  ]
+  if channel_ids:
+    conditions.append(rest.FieldCondition(key="channel_id", match=rest.MatchAny(any=list(channel_ids))))
+  records, _ = await qd_aclient.scroll(
+    collection_name=qd_collection,
+    scroll_filter=rest.Filter(must=conditions),
+    order_by=rest.OrderBy(key="posted_ts", direction=rest.Direction.DESC),
+    limit=settings.RAG_TOP_K,
+    with_payload=True)
+  return [NodeWithScore(node=metadata_dict_to_node(record.payload), score=1.0) for record in records]
+
+async def retrieve(guild_id, query_bundle, channel_ids=()):
+  """Top-k chat messages of a guild for a query, most similar first.
+
+  A time-scoped query gets the newest messages of its range instead, ordered
+  by Qdrant on ``posted_ts``; any other query keeps its similarity (or
+  fused) order. A non-empty ``channel_ids`` only searches those channels.
+  """
+  scope = parse_time_scope(query_bundle.query_str)
+  if scope is not None:
+    # "what happened yesterday" is answered by a range scroll over posted_ts
+    nodes = await _scroll_time_range(guild_id, *scope, channel_ids)
+    if nodes:
+      return nodes
+  if keyword_index is None:
+    # text only: image hits would need a multi-modal llm to be useful here
+    nodes = await get_retriever(guild_id, channel_ids).atext_retrieve(query_bundle)
+  else:
+    dense, sparse = await asyncio.gather(
+      asyncio.wait_for(
+        get_retriever(guild_id, channel_ids).atext_retrieve(query_bundle),
+        settings.RAG_DENSE_TIMEOUT),
+      asyncio.to_thread(
+        keyword_index.search, guild_id, query_bundle.query_str, settings.RAG_TOP_K, channel_ids),
+      return_exceptions=True)
+    if isinstance(sparse, BaseException):
+      raise sparse
+    if isinstance(dense, BaseException):
+      logger.warning(f"Vector search failed, answering from keywords only: {dense!r}")
+      metrics.inc("dense_search_failures")
+      dense = []
+    with metrics.timer("postprocess", guild_id):
+      nodes = reciprocal_rank_fusion([dense, sparse], settings.RAG_TOP_K)
+  return nodes
+
+# messages are buffered into per-channel conversation windows, and a window
+# is indexed as one node once it closes
+windows = WindowBuilder() if settings.INGEST_WINDOWS else None
+
+# points are keyed by the Discord ids they were built from, so an edit
+# upserts over the old point and a delete knows which points to touch;
+# message_ids in the payload finds every point a message went into
+def message_point_id(message_id):
+  return str(uuid.uuid5(uuid.NAMESPACE_URL, f"ragent-message:{message_id}"))
+
+def image_point_id(attachment_id):
+  return str(uuid.uuid5(uuid.NAMESPACE_URL, f"ragent-image:{attachment_id}"))
+
+def window_point_id(guild_id, channel_id, messages):
+  # messages remembered without an id are told apart by their time
+  keys = ",".join(str(msg.message_id or msg.posted_at.timestamp()) for msg in messages)
+  return str(uuid.uuid5(uuid.NAMESPACE_URL, f"ragent-window:{guild_id}:{channel_id}:{keys}"))
+
+def window_node(window):
+  return TextNode(
+    id_=window_point_id(window.guild_id, window.channel_id, window.messages),
+    text=window.text,
+    metadata={
+      'author': ", ".join(dict.fromkeys(msg.author for msg in window.messages)),
+      'posted_at': str(window.messages[-1].posted_at),
+      'posted_ts': int(window.messages[-1].posted_at.timestamp()),
+      'channel_id': window.channel_id,
+      'guild_id': window.guild_id,
+      'message_ids': [msg.message_id for msg in window.messages if msg.message_id],
+      # one entry per message, with its span in the text, for citations
+      'messages': window.citations()
+    },
+    excluded_llm_metadata_keys=['author', 'posted_at', 'posted_ts', 'channel_id', 'guild_id', 'message_ids', 'messages'],
+    excluded_embed_metadata_keys=['author', 'posted_at', 'posted_ts', 'channel_id', 'guild_id', 'message_ids', 'messages'],
+  )
+
+async def _index_text_nodes(nodes):
+  if not nodes:
+    return
+  if keyword_index is not None:
+    await asyncio.to_thread(keyword_index.add, nodes)
+  await ingestor.put_many(nodes)
+
+async def flush_windows(max_idle=None, builder=None):
+  """Index the open windows idle for ``max_idle`` seconds, or all of them."""
+  builder = builder or windows
+  if builder is None:
+    return
+  await _index_text_nodes([window_node(window) for window in builder.drain(max_idle)])
+
+def message_node(msg_str, when, who, guild_id, channel_id, message_id=None):
+  return TextNode(
+    id_=message_point_id(message_id) if message_id else str(uuid.uuid4()),
     text=msg_str,
     metadata={
       'author': str(who),
       'posted_at': str(when),
-      'channel_id': channel.id,
-      'guild_id': guild_id
+      'posted_ts': int(when.timestamp()),
+      'channel_id': channel_id,
+      'guild_id': guild_id,
+      'message_ids': [message_id] if message_id else [],
     },
-    excluded_llm_metadata_keys=['author', 'posted_at', 'channel_id', 'guild_id'],
-    excluded_embed_metadata_keys=['author', 'posted_at', 'channel_id', 'guild_id'],
+    excluded_llm_metadata_keys=['author', 'posted_at', 'posted_ts', 'channel_id', 'guild_id', 'message_ids'],
+    excluded_embed_metadata_keys=['author', 'posted_at', 'posted_ts', 'channel_id', 'guild_id', 'message_ids'],
   )
 
-  index.insert_nodes([node])
+async def index_message(when, who, msg_content, guild_id, channel, builder=None, message_id=None):
+  """Index a message, into ``builder``'s windows if given (backfills keep
+  their own, so old history never lands in a live channel's window)."""
+  msg_str = f"[{when.strftime('%m-%d-%Y %H:%M:%S')}] - @{who} on #[{str(channel)[:15]}]: `{msg_content}`"
+
+  builder = builder or windows
+  if builder is not None:
+    closed = builder.add(guild_id, channel.id, when, str(who), msg_str, message_id)
+    await _index_text_nodes([window_node(window) for window in closed])
+    return
 
-def index_images(when, who, image_base64, guild_id, channel):
+  await _index_text_nodes([message_node(msg_str, when, who, guild_id, channel.id, message_id)])
+
+async def index_images(when, who, images, guild_id, channel, message_id=None):
+  """Index ``(attachment_id, StoredImage)`` pairs of a message."""
   nodes = []
-  for image in image_base64:
+  for attachment_id, image in images:
+    # the payload points at the downscaled file instead of carrying base64
     node = ImageNode(
-      image=image,
+      id_=image_point_id(attachment_id),
+      image_path=image.thumb_path,
       metadata={
         'author': str(who),
         'posted_at': str(when),
+        'posted_ts': int(when.timestamp()),
         'channel_id': channel.id,
-        'guild_id': guild_id
+        'guild_id': guild_id,
+        'message_ids': [message_id] if message_id else [],
+        'image_ref': image.ref
       },
-      excluded_llm_metadata_keys=['author', 'posted_at', 'channel_id', 'guild_id'],
-      excluded_embed_metadata_keys=['author', 'posted_at', 'channel_id', 'guild_id'],
+      excluded_llm_metadata_keys=['author', 'posted_at', 'posted_ts', 'channel_id', 'guild_id', 'message_ids', 'image_ref'],
+      excluded_embed_metadata_keys=['author', 'posted_at', 'posted_ts', 'channel_id', 'guild_id', 'message_ids', 'image_ref'],
     )
     nodes.append(node)
-  index.insert_nodes(nodes)
-
-async def chat_repl(messages, query, message, bot):
-  channel_id = message.channel.id
-  chat_history = [ChatMessage(role=MessageRole.SYSTEM, content="You are a helpful assistant. Your name is RAgent.")]
-  tmp = []
-  for msg in messages.get(message.guild.id, []):
-    if msg.channel_id == channel_id:
-      tmp.append(msg)
-      if msg.author != str(bot.user):
-        if msg.is_image:
-          chat_history.append(ChatMessage(role=MessageRole.USER, content=[{"type":"image_url", "image_url":{"url":msg.just_msg}}]))
-        else:
-          chat_history.append(ChatMessage(role=MessageRole.USER, content=msg.just_msg))
-      else:
-        if msg.is_image:
-          chat_history.append(ChatMessage(role=MessageRole.ASSISTANT, content=[{"type":"image_url", "image_url":{"url":msg.just_msg}}]))
-        else:
-          chat_history.append(ChatMessage(role=MessageRole.ASSISTANT, content=msg.just_msg))
-  # print(chat_history)
-  print('Mooooo')
-  print(message.attachments)
-  # print("chat history")
-  # print(chat_history)
-  # print("messages")
-  # print(tmp)
-  r = llm.chat(chat_history)
-  # print(r)
-  return r.message.content
-
-async def answer_query(messages, query, interaction, bot):
-
-  # 1. specify channel in the query
-  # 2. get channel id by channel name
-  # 3. filter by these channel id
-  # 4. avoid triggering this step if # is in the query somehow
-  # 5. the position of # is not determined
-  # 6. first step: get the channel id name dict 
-  channel_id = interaction.channel.id
-  thread_messages = [
-    msg.just_msg for msg in messages.get(interaction.guild.id, []) if msg.channel_id==channel_id
-  ][-1*settings.LAST_N_MESSAGES:-1]
-  # thread_messages = [
-  #   msg.message_str for msg in messages.get(interaction.guild.id, [])
-  # ]
-
-  # replies seems wrong, and what is context_str?
-  partially_formatted_prompt = prompt.partial_format(
-    replies="\n".join(thread_messages),
-    user_asking=str(interaction.user.name),
-    bot_name=str(bot.user)
+  await ingestor.put_many(nodes)
+
+def rewritten_node(node, lines):
+  """``node`` with the messages in ``lines`` (message id -> new line)
+  rewritten, or dropped where the new line is ``None``; ``None`` if no
+  message is left."""
+  metadata = dict(node.metadata)
+  if 'messages' not in metadata:
+    # a single message
+    line = lines[metadata['message_ids'][0]]
+    if line is None:
+      return None
+    text = line
+  else:
+    # the window text is its messages' lines, at the spans of the citations
+    kept = []
+    for citation in metadata['messages']:
+      line = node.text[citation['start']:citation['end']]
+      message_id = citation.get('message_id')
+      if message_id in lines:
+        line = lines[message_id]
+        if line is None:
+          continue
+      kept.append((citation, line))
+    if not kept:
+      return None
+    citations, offset = [], 0
+    for citation, line in kept:
+      citations.append(dict(citation, start=offset, end=offset + len(line)))
+      offset += len(line) + 1
+    text = "\n".join(line for _, line in kept)
+    last = datetime.fromisoformat(citations[-1]['posted_at'])
+    metadata.update(
+      author=", ".join(dict.fromkeys(citation['author'] for citation in citations)),
+      posted_at=str(last),
+      posted_ts=int(last.timestamp()),
+      message_ids=[citation['message_id'] for citation in citations if citation.get('message_id')],
+      messages=citations)
+  return TextNode(
+    id_=node.node_id,
+    text=text,
+    metadata=metadata,
+    excluded_llm_metadata_keys=node.excluded_llm_metadata_keys,
+    excluded_embed_metadata_keys=node.excluded_embed_metadata_keys,
   )
 
-  # we might filter further to get specified channels messages
-  filters = MetadataFilters(
-    filters=[
-      MetadataFilter(
-        key="guild_id", operator=FilterOperator.EQ, value=interaction.guild.id
-      )
-    ]
+def _with_messages(guild_id, message_ids):
+  return rest.Filter(must=[
+    rest.FieldCondition(key="guild_id", match=rest.MatchValue(value=guild_id)),
+    rest.FieldCondition(key="message_ids", match=rest.MatchAny(any=list(message_ids))),
+  ])
+
+async def indexed_nodes(collection_name, guild_id, message_ids):
+  """The text nodes of a collection built from any of ``message_ids``."""
+  nodes, offset = [], None
+  while True:
+    records, offset = await qd_aclient.scroll(
+      collection_name=collection_name,
+      scroll_filter=_with_messages(guild_id, message_ids),
+      limit=256,
+      offset=offset,
+      with_payload=True)
+    nodes.extend(metadata_dict_to_node(record.payload) for record in records)
+    if offset is None:
+      return nodes
+
+async def rewrite_messages(guild_id, channel_id, lines):
+  """Apply edits and deletes of messages to every index, in place.
+
+  ``lines`` maps a message id to the new line it is indexed with, or to
+  ``None`` if the message was deleted. Only the points built from those
+  messages are re-embedded or deleted.
+  """
+  message_ids = set(lines)
+  if windows is not None:
+    windows.rewrite(guild_id, channel_id, lines)
+  queued = await ingestor.take(
+    lambda node: node.metadata.get('guild_id') == guild_id
+    and not message_ids.isdisjoint(node.metadata.get('message_ids', ())))
+  deleted = [message_id for message_id, line in lines.items() if line is None]
+  # images only go away with their message
+  await ingestor.put_many([
+    node for node in queued
+    if isinstance(node, ImageNode) and not set(deleted).intersection(node.metadata['message_ids'])])
+  # a queued node is newer than the point with its id
+  nodes = {node.node_id: node for node in await indexed_nodes(qd_collection, guild_id, message_ids)}
+  nodes.update((node.node_id, node) for node in queued if not isinstance(node, ImageNode))
+
+  rewritten, dropped = [], []
+  for node in nodes.values():
+    new = rewritten_node(node, lines)
+    if new is None:
+      dropped.append(node.node_id)
+    else:
+      rewritten.append(new)
+  await _upsert_text_nodes(rewritten)
+  if dropped:
+    await qd_aclient.delete(collection_name=qd_collection, points_selector=rest.PointIdsList(points=dropped))
+    if keyword_index is not None:
+      await asyncio.to_thread(keyword_index.delete, guild_id, dropped)
+  if deleted:
+    await qd_aclient.delete(
+      collection_name=qd_image_collection, points_selector=_with_messages(guild_id, deleted))
+  answer_cache.invalidate_channel(guild_id, channel_id)
+  metrics.inc("rewritten_points", len(rewritten))
+  metrics.inc("deleted_points", len(dropped))
+
+async def forget_guild(guild_id):
+  """Remove a guild from every index in one go: queued and open nodes, both
+  Qdrant collections, the keyword index and the per-guild caches."""
+  if windows is not None:
+    windows.forget(guild_id)
+  await ingestor.take(lambda node: node.metadata.get('guild_id') == guild_id)
+  selector = rest.Filter(must=[
+    rest.FieldCondition(key="guild_id", match=rest.MatchValue(value=guild_id))])
+  deletes = [
+    qd_aclient.delete(collection_name=qd_collection, points_selector=selector),
+    qd_aclient.delete(collection_name=qd_image_collection, points_selector=selector),
+  ]
+  if keyword_index is not None:
+    deletes.append(asyncio.to_thread(keyword_index.forget, guild_id))
+  await asyncio.gather(*deletes)
+  invalidate_retrievers(guild_id)
+  context_builder.forget(guild_id)
+  answer_cache.forget(guild_id)
+
+# old messages are replaced by summaries of whole days and weeks (see
+# retention.py); a summary point has a stable id per period, so rewriting a
+# summary replaces it
+SUMMARY_LEVELS = ("day", "week")
+
+def summary_id(guild_id, summary):
+  key = f"ragent-summary:{guild_id}:{summary['channel_id']}:{summary['level']}:{summary['start']}"
+  return str(uuid.uuid5(uuid.NAMESPACE_URL, key))
+
+def summary_node(guild_id, summary):
+  start = datetime.fromtimestamp(summary['start'], tz=timezone.utc)
+  end = datetime.fromtimestamp(summary['end'], tz=timezone.utc)
+  period = start.strftime('%m-%d-%Y') if summary['level'] == "day" else f"week of {start.strftime('%m-%d-%Y')}"
+  authors = ", ".join(f"@{author}" for author in summary['authors'])
+  return TextNode(
+    id_=summary_id(guild_id, summary),
+    text=f"[{period}] - summary of {summary['messages']} messages by {authors} on #[{summary['label']}]: `{summary['text']}`",
+    metadata={
+      'author': ", ".join(summary['authors']),
+      'posted_at': str(end),
+      # inside the period, so time scoped questions and recency sorting see it
+      'posted_ts': summary['end'] - 1,
+      'channel_id': summary['channel_id'],
+      'guild_id': guild_id,
+      'summary_level': summary['level'],
+      'period_start': summary['start'],
+      'period_end': summary['end'],
+      'message_count': summary['messages'],
+    },
+    excluded_llm_metadata_keys=['author', 'posted_at', 'posted_ts', 'channel_id', 'guild_id', 'summary_level', 'period_start', 'period_end', 'message_count'],
+    excluded_embed_metadata_keys=['author', 'posted_at', 'posted_ts', 'channel_id', 'guild_id', 'summary_level', 'period_start', 'period_end', 'message_count'],
   )
 
-  # why are we using data_key here, and what is FixedRecencyPostprocessor?
-  postprocessor = FixedRecencyPostprocessor(
-      top_k=8, 
-      date_key="posted_at", # the key in the metadata to find the date
-  )
+def expired_filter(guild_id, channel_id, before):
+  """A channel's points posted before ``before``, except its summaries."""
+  return rest.Filter(
+    must=[
+      rest.FieldCondition(key="guild_id", match=rest.MatchValue(value=guild_id)),
+      rest.FieldCondition(key="channel_id", match=rest.MatchValue(value=channel_id)),
+      rest.FieldCondition(key="posted_ts", range=rest.Range(lt=before)),
+    ],
+    must_not=[
+      rest.FieldCondition(key="summary_level", match=rest.MatchAny(any=list(SUMMARY_LEVELS))),
+    ])
+
+async def _upsert_text_nodes(nodes):
+  """Embed and upsert ``nodes`` right away, replacing the points with the
+  same ids."""
+  if not nodes:
+    return
+  # the same pair even if the bot switches collections meanwhile
+  model, store = embed_model, vector_store
+  if keyword_index is not None:
+    await asyncio.to_thread(keyword_index.add, nodes)
+  with metrics.timer("embed"):
+    embeddings = await model.aget_text_embedding_batch(
+      [node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes])
+  for node, embedding in zip(nodes, embeddings):
+    node.embedding = embedding
+  with metrics.timer("upsert"):
+    await store.async_add(nodes)
+
+async def index_summaries(guild_id, summaries):
+  """Embed and upsert summaries right away, unlike queued messages: the
+  messages they replace are deleted next."""
+  await _upsert_text_nodes([summary_node(guild_id, summary) for summary in summaries])
+
+async def drop_summaries(guild_id, summaries):
+  ids = [summary_id(guild_id, summary) for summary in summaries]
+  if not ids:
+    return
+  await qd_aclient.delete(collection_name=qd_collection, points_selector=rest.PointIdsList(points=ids))
+  if keyword_index is not None:
+    await asyncio.to_thread(keyword_index.delete, guild_id, ids)
+
+async def prune_index(guild_id, channel_id, before):
+  """Delete the messages, windows and images of a channel posted before
+  ``before`` (epoch seconds) from every index; summaries stay."""
+  selector = expired_filter(guild_id, channel_id, before)
+  await qd_aclient.delete(collection_name=qd_collection, points_selector=selector)
+  await qd_aclient.delete(collection_name=qd_image_collection, points_selector=selector)
+  if keyword_index is not None:
+    await asyncio.to_thread(keyword_index.prune, guild_id, channel_id, before)
+
+# identical requests in flight at the same time (same guild, channel and
+# question) are answered once
+coalescer = Coalescer()
+
+def _coalesce_key(kind, guild_id, channel_id, query, channel_ids=()):
+  return (kind, guild_id, channel_id, query, tuple(sorted(channel_ids)))
+
+async def chat_repl(history, query, message, bot):
+  guild_id = message.guild.id
+  with scheduled(INTERACTIVE, guild_id):
+    return await coalescer.run(
+      _coalesce_key("chat", guild_id, message.channel.id, query),
+      lambda: _chat_repl(history, query, message, bot))
+
+async def chat_repl_stream(history, query, message, bot):
+  """Like chat_repl, but yields the reply as it is generated."""
+  guild_id = message.guild.id
+  with scheduled(INTERACTIVE, guild_id):
+    deltas = coalescer.stream(
+      _coalesce_key("chat", guild_id, message.channel.id, query),
+      lambda: _chat_repl_stream(history, query, message, bot))
+  async for delta in deltas:
+    yield delta
+
+async def _chat_repl(history, query, message, bot):
+  async with query_limiter.slot(message.guild.id):
+    # the newest turns that fit the token budget, after a rolling summary of
+    # everything older
+    chat_history = context_builder.build(
+      message.guild.id,
+      message.channel.id,
+      history.channel(message.guild.id, message.channel.id),
+      str(bot.user))
+    with metrics.timer("chat", message.guild.id):
+      r = await llm.achat(chat_history)
+  return r.message.content
 
-  # what is index.as_query_engine?
-  query_engine = index.as_query_engine(
-    filters=filters,
-    similarity_top_k=8,
-    node_postprocessors=[postprocessor])
+async def _chat_repl_stream(history, query, message, bot):
+  async with query_limiter.slot(message.guild.id):
+    chat_history = context_builder.build(
+      message.guild.id,
+      message.channel.id,
+      history.channel(message.guild.id, message.channel.id),
+      str(bot.user))
+    started = time.perf_counter()
+    first = True
+    async for r in await llm.astream_chat(chat_history):
+      if first:
+        metrics.observe("chat_first_token", time.perf_counter() - started, message.guild.id)
+        first = False
+      yield r.delta or ""
+    metrics.observe("chat", time.perf_counter() - started, message.guild.id)
+
+def _prepare_answer(history, query, interaction, bot):
+  last_messages = [
+    msg for msg in history.last(interaction.guild.id, interaction.channel.id, settings.LAST_N_MESSAGES)[:-1]
+    if not msg.is_image
+  ]
+  thread_messages = [msg.just_msg for msg in last_messages]
+  # thread_messages = [
+  #   msg.message_str for msg in messages.get(interaction.guild.id, [])
+  # ]
 
-  # what is update_prompts?
-  # this code is ... confusing.
-  query_engine.update_prompts(
-      {"response_synthesizer:text_qa_template": partially_formatted_prompt}
-  )
+  # each recent message is embedded on its own; the embedding cache serves
+  # the ones already seen by an earlier question. Only with INGEST_WINDOWS=0
+  # is message_str also the indexed text, whose vectors ingestion cached
+  replies_query = [msg.message_str for msg in last_messages] + [query]
 
-  replies_query = [
-    msg.just_msg for msg in messages.get(interaction.guild.id, []) if msg.channel_id==channel_id
-  ][-1*settings.LAST_N_MESSAGES:-1]
-  replies_query.append(query)
-
-  # print(replies_query)
-  # what is QueryBundle, what is custome_embedding_strs?
-  # it seems in here query_str is formatted, context_str is formatted by retreiving using custom_embedding_strs
-  # check this part!
-  # print(query_engine.get_prompts())
-  return str(query_engine.query(QueryBundle(
+  # query_str goes into the prompt, while retrieval embeds the recent channel
+  # messages together with the query (custom_embedding_strs)
+  query_bundle = QueryBundle(
     query_str=query,
     custom_embedding_strs=replies_query
-  )))
+  )
+  # the per-call prompt variables are filled in at synthesis time, so the
+  # shared synthesizers never need update_prompts
+  prompt_kwargs = dict(
+    replies="\n".join(thread_messages),
+    user_asking=str(interaction.user.name),
+    bot_name=str(bot.user))
+  return query_bundle, prompt_kwargs
+
+def _source_channels(nodes):
+  return {n.node.metadata['channel_id'] for n in nodes if 'channel_id' in n.node.metadata}
+
+async def _lookup_answer(guild_id, query, channel_ids):
+  """The query embedding, a cached answer or ``None``, and the cache epoch."""
+  try:
+    with metrics.timer("embed_query", guild_id):
+      embedding = await asyncio.wait_for(embed_model.aget_query_embedding(query), settings.RAG_DENSE_TIMEOUT)
+  except Exception as err:
+    # the keyword index can still answer without the embedder
+    logger.warning(f"Embedding the query failed, skipping the answer cache: {err!r}")
+    return None, None, None
+  # "what happened today" must not be answered from yesterday's cache
+  if parse_time_scope(query) is not None:
+    return embedding, None, None
+  scope = frozenset(channel_ids)
+  return embedding, answer_cache.get(guild_id, embedding, scope), answer_cache.epoch()
+
+def _record_answer(guild_id, cached, seconds):
+  answer_cache.record(cached, seconds)
+  metrics.observe("answer_cached" if cached else "answer", seconds, guild_id)
+
+async def answer_query(history, query, interaction, bot, channel_ids=()):
+  """Answer ``query`` from the guild's history, or only ``channel_ids``' if given.
+
+  The same question asked in the same channel while it is being answered
+  shares that answer.
+  """
+  guild_id = interaction.guild.id
+  with scheduled(INTERACTIVE, guild_id):
+    return await coalescer.run(
+      _coalesce_key("answer", guild_id, interaction.channel.id, query, channel_ids),
+      lambda: _answer_query(history, query, interaction, bot, channel_ids))
+
+async def answer_query_stream(history, query, interaction, bot, channel_ids=()):
+  """Like answer_query, but yields the answer as it is generated."""
+  guild_id = interaction.guild.id
+  with scheduled(INTERACTIVE, guild_id):
+    deltas = coalescer.stream(
+      _coalesce_key("answer", guild_id, interaction.channel.id, query, channel_ids),
+      lambda: _answer_query_stream(history, query, interaction, bot, channel_ids))
+  async for delta in deltas:
+    yield delta
+
+async def _answer_query(history, query, interaction, bot, channel_ids=()):
+  started = time.perf_counter()
+  guild_id = interaction.guild.id
+  embedding, cached, epoch = await _lookup_answer(guild_id, query, channel_ids)
+  if cached is not None:
+    _record_answer(guild_id, True, time.perf_counter() - started)
+    return cached.answer
+  query_bundle, prompt_kwargs = _prepare_answer(history, query, interaction, bot)
+  async with query_limiter.slot(guild_id):
+    with metrics.timer("retrieve", guild_id):
+      nodes = await retrieve(guild_id, query_bundle, channel_ids)
+    with metrics.timer("synthesize", guild_id):
+      response = await synthesizer.asynthesize(query_bundle, nodes, **prompt_kwargs)
+  answer_cache.put(guild_id, query, embedding, str(response), _source_channels(nodes), epoch, frozenset(channel_ids))
+  _record_answer(guild_id, False, time.perf_counter() - started)
+  return str(response)
+
+async def _answer_query_stream(history, query, interaction, bot, channel_ids=()):
+  started = time.perf_counter()
+  guild_id = interaction.guild.id
+  embedding, cached, epoch = await _lookup_answer(guild_id, query, channel_ids)
+  if cached is not None:
+    _record_answer(guild_id, True, time.perf_counter() - started)
+    yield cached.answer
+    return
+  query_bundle, prompt_kwargs = _prepare_answer(history, query, interaction, bot)
+  deltas = []
+  async with query_limiter.slot(guild_id):
+    with metrics.timer("retrieve", guild_id):
+      nodes = await retrieve(guild_id, query_bundle, channel_ids)
+    synthesis_started = time.perf_counter()
+    response = await streaming_synthesizer.asynthesize(query_bundle, nodes, **prompt_kwargs)
+    if isinstance(response, AsyncStreamingResponse):
+      async for delta in response.async_response_gen():
+        if not deltas:
+          metrics.observe("synthesize_first_token", time.perf_counter() - synthesis_started, guild_id)
+        deltas.append(delta)
+        yield delta
+    else:
+      deltas.append(str(response))
+      yield str(response)
+    metrics.observe("synthesize", time.perf_counter() - synthesis_started, guild_id)
+  answer_cache.put(guild_id, query, embedding, "".join(deltas), _source_channels(nodes), epoch, frozenset(channel_ids))
+  _record_answer(guild_id, False, time.perf_counter() - started)
 
 # Directory to save images
 IMAGE_DIR = './images'
 
-# Ensure the directory exists
-os.makedirs(IMAGE_DIR, exist_ok=True)
-
-async def download_and_create_images(image_urls):
-    async def download_image(session, url):
-        try:
-            async with session.get(url) as response:
-                response.raise_for_status()
-
-                # Get image from response
-                image_data = await response.read()
-                image = Image.open(BytesIO(image_data))
-
-                # Create a unique filename
-                filename = os.path.join(IMAGE_DIR, os.path.basename(url))
-                print("filename", filename)
-                file_type = filename[filename.rfind('.'):filename.rfind('?')]
-                # if not filename.lower().endswith('.jpg') and not filename.lower().endswith('.png'):
-                #     filename += '.jpg'  # Assume JPEG format if no extension
-
-                # Save the image locally
-                filename += file_type
-                print("filename", filename)
-                image.save(filename)
-                return filename
-        except aiohttp.ClientError as http_err:
-            print(f"HTTP error occurred: {http_err}")
-        except Exception as err:
-            print(f"An error occurred: {err}")
-
-        return None
-
-    # def create_image_document(image_path):
-    #     # Create a document with the image path and any required metadata
-    #     return Document(
-    #         content="Image",
-    #         metadata={"image_path": image_path}
-    #     )
-
-    async with aiohttp.ClientSession() as session:
-        # Create a list of download tasks
-        tasks = [download_image(session, url) for url in image_urls]
-
-        # Run all tasks concurrently
-        image_paths = await asyncio.gather(*tasks)
-
-        # Create documents for each successfully downloaded image
-        # documents = [SimpleDirectoryReader(path).load_data() for path in image_paths if path]
-
-    return image_paths
-  
\ No newline at end of file
+# images are stored once per content hash; messages and qdrant only keep refs
+image_files = ImageStore(IMAGE_DIR)
+# one pooled session for all attachment downloads, closed with the bot
+image_downloader = ImageDownloader(image_files.incoming)
+# decoding/resizing/encoding runs in worker processes, off the event loop
+image_processor = ImageProcessor(settings.IMAGE_WORKERS, settings.IMAGE_THUMB_MAX_SIDE)
+
+async def store_image(image):
+  # add() without a processed image only succeeds if the content is already
+  # stored; it re-checks under its lock, since the files can be released
+  # while we wait here. Storing moves and writes files, so it runs off the loop
+  stored = await asyncio.to_thread(image_files.add, image)
+  if stored is not None:
+    return stored
+  try:
+    with metrics.timer("image_encode"):
+      processed = await image_processor.process(image.path)
+  except Exception as err:
+    logger.warning(f"Not an image {image.url}: {err}")
+    await asyncio.to_thread(image_files.discard, image)
+    return None
+  return await asyncio.to_thread(image_files.add, image, processed)
+
+context_builder = ContextBuilder(llm, image_files.data_url, settings.CHAT_SUMMARIES_PATH)
+
+async def download_and_create_images(attachments):
+  """Download and store image attachments, returning ``(attachment_id,
+  StoredImage)`` pairs for the ones that worked."""
+  attachment_ids = {attachment.url: attachment.id for attachment in attachments}
+  with metrics.timer("image_download"):
+    downloaded = await image_downloader.fetch_all(list(attachment_ids))
+  stored = await asyncio.gather(*(store_image(image) for image in downloaded))
+  return [
+    (attachment_ids[image.url], stored_image)
+    for image, stored_image in zip(downloaded, stored) if stored_image is not None
+  ]
+
+# read whenever metrics are rendered (/metrics, /stats)
+metrics.gauge("ingest_queue_depth", lambda: ingestor.depth, "Nodes waiting to be embedded and upserted")
+metrics.gauge("answers_in_flight", lambda: query_limiter.in_flight, "Answers being generated")
+metrics.gauge("answers_waiting", lambda: query_limiter.waiting, "Answers waiting for a concurrency slot")
+metrics.gauge("open_windows", lambda: windows.open_count if windows is not None else 0, "Conversation windows not indexed yet")
+metrics.gauge("llm_waiting", lambda: scheduler.waiting("llm"), "LLM calls waiting for the scheduler")
+metrics.gauge("embed_waiting", lambda: scheduler.waiting("embed"), "Embedding calls waiting for the scheduler")
+metrics.gauge("embed_cache_hit_rate", lambda: embed_cache.hit_rate, "Share of embeddings served from the cache")
+metrics.gauge("answer_cache_hit_rate", lambda: answer_cache.hit_rate, "Share of /rag answers served from the cache")
+metrics.gauge("answer_cache_entries", lambda: answer_cache.stats()["entries"], "Cached /rag answers")
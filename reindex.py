@@ -0,0 +1,394 @@
+"""Rebuild the text collection from the message store, e.g. after switching
+embedding models.
+
+Every remembered message is streamed from the message store (read-only, so
+the bot can keep running), grouped into the same nodes live ingestion
+builds, re-embedded in large concurrent batches and written into a new
+collection version ``<collection>_v<N>``, together with a keyword index of
+its own. The new version records the model it was embedded with (see
+``qdrant_schema.write_marker``). Once it has caught up with the store, the
+collection alias is moved to it in one atomic request, so ``/rag`` never
+sees a half-built index.
+
+A running bot keeps using the previous version until it notices the move
+(every ``QDRANT_ALIAS_CHECK_INTERVAL`` seconds); it then switches its
+embedding model, collection and keyword index together and marks the new
+version as serving. Until then it still indexes new messages into the
+previous version, so the last catch-up pass waits for that mark
+(``--wait-for-bot``).
+
+    python reindex.py --dry-run        # nodes, tokens, cost and time estimate
+    python reindex.py                  # build, catch up, switch
+    python reindex.py --drop-old       # ... and delete the previous version
+
+Progress is checkpointed (``--checkpoint``); running the command again
+resumes the unfinished version.
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import time
+from datetime import datetime
+from pathlib import Path
+
+from llama_index.core.schema import MetadataMode
+from llama_index.vector_stores.qdrant import QdrantVectorStore
+from qdrant_client.http import models as rest
+
+import settings
+import rag
+from context_builder import count_tokens
+from keyword_index import KeywordIndex
+from message_store import read_records
+from models import Message
+from qdrant_schema import ensure_collection, switch_alias, resolve_alias, read_marker, write_marker
+from windows import WindowBuilder
+
+
+logger = settings.logging.getLogger("bot")
+
+
+def _is_rate_limit(err):
+    status = getattr(err, "status_code", None) or getattr(getattr(err, "response", None), "status_code", None)
+    return status == 429 or "ratelimit" in type(err).__name__.lower() or "429" in str(err)
+
+
+class AdaptiveLimiter:
+    """Runs calls with a concurrency that adapts to the provider's rate limit.
+
+    Concurrency grows by one after every success up to ``max_concurrency``
+    and is halved, with an exponential pause, on every rate-limit error.
+    """
+
+    def __init__(self, max_concurrency, max_retries=8):
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.limit = max(1, max_concurrency // 2)
+        self.rate_limited = 0
+        self._in_flight = 0
+        self._changed = asyncio.Condition()
+
+    async def run(self, fn, *args):
+        for attempt in range(self.max_retries + 1):
+            async with self._changed:
+                await self._changed.wait_for(lambda: self._in_flight < self.limit)
+                self._in_flight += 1
+            try:
+                result = await fn(*args)
+            except Exception as err:
+                if not _is_rate_limit(err) or attempt == self.max_retries:
+                    raise
+                self.rate_limited += 1
+                self.limit = max(1, self.limit // 2)
+                await asyncio.sleep(min(2 ** attempt, 60))
+                continue
+            finally:
+                async with self._changed:
+                    self._in_flight -= 1
+                    self._changed.notify_all()
+            self.limit = min(self.max_concurrency, self.limit + 1)
+            return result
+
+
+def keyword_index_path(target):
+    """Where the keyword index of collection version ``target`` is built."""
+    root, ext = os.path.splitext(settings.KEYWORD_INDEX_PATH)
+    return f"{root}.{target}{ext}"
+
+
+class Reindexer:
+    def __init__(self, persist_dir, target, batch_size, concurrency, checkpoint_path, dry_run=False,
+                 keyword_index=None):
+        self.persist_dir = persist_dir
+        self.target = target
+        self.batch_size = batch_size
+        self.checkpoint_path = Path(checkpoint_path)
+        self.dry_run = dry_run
+        self.limiter = AdaptiveLimiter(concurrency)
+        self.store = QdrantVectorStore(aclient=rag.qd_aclient, collection_name=target)
+        self.keyword_index = keyword_index
+        self.builder = WindowBuilder() if settings.INGEST_WINDOWS else None
+        self.seq = 0
+        self.messages = 0
+        self.nodes = 0
+        self.tokens = 0
+        self.started = time.monotonic()
+        self._pending = []
+        self._tasks = set()
+
+    def save_checkpoint(self):
+        tmp_path = self.checkpoint_path.with_suffix(".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump({
+                "target": self.target,
+                "seq": self.seq,
+                "model": rag.embed_model.model_name,
+                "messages": self.messages,
+                "nodes": self.nodes,
+            }, file)
+        tmp_path.replace(self.checkpoint_path)
+
+    async def _embed_and_upsert(self, nodes):
+        texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes]
+        embeddings = await rag.embed_model.aget_text_embedding_batch(texts)
+        for node, embedding in zip(nodes, embeddings):
+            node.embedding = embedding
+        await self.store.async_add(nodes)
+        if self.keyword_index is not None:
+            await asyncio.to_thread(self.keyword_index.add, nodes)
+
+    async def _submit(self, nodes):
+        self.nodes += len(nodes)
+        self.tokens += sum(count_tokens(node.get_content()) for node in nodes)
+        if self.dry_run:
+            return
+        while len(self._tasks) >= self.limiter.max_concurrency * 2:
+            await asyncio.wait(self._tasks, return_when=asyncio.FIRST_COMPLETED)
+        task = asyncio.create_task(self.limiter.run(self._embed_and_upsert, nodes))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _add(self, nodes):
+        self._pending.extend(nodes)
+        while len(self._pending) >= self.batch_size:
+            batch, self._pending = self._pending[:self.batch_size], self._pending[self.batch_size:]
+            await self._submit(batch)
+
+    async def flush(self):
+        """Close every window and wait until everything read so far is stored."""
+        if self.builder is not None:
+            self._pending.extend(rag.window_node(window) for window in self.builder.drain())
+        if self._pending:
+            batch, self._pending = self._pending, []
+            await self._submit(batch)
+        if self._tasks:
+            # raises the first failure, the checkpoint then stays behind it
+            await asyncio.gather(*self._tasks)
+
+    async def _forget(self, guild_id):
+        if self.builder is not None:
+            self.builder.forget(guild_id)
+        self._pending = [node for node in self._pending if node.metadata["guild_id"] != guild_id]
+        await self.flush()
+        if not self.dry_run:
+            await rag.qd_aclient.delete(
+                collection_name=self.target,
+                points_selector=rest.Filter(must=[
+                    rest.FieldCondition(key="guild_id", match=rest.MatchValue(value=guild_id))]))
+            if self.keyword_index is not None:
+                await asyncio.to_thread(self.keyword_index.forget, guild_id)
+
+    async def _prune(self, guild_id, channel_id, before):
+        # the expired messages were indexed above, and are replaced by the
+        # summaries journaled right before this record
+        await self.flush()
+        if not self.dry_run:
+            await rag.qd_aclient.delete(
+                collection_name=self.target,
+                points_selector=rag.expired_filter(guild_id, channel_id, before))
+            if self.keyword_index is not None:
+                await asyncio.to_thread(self.keyword_index.prune, guild_id, channel_id, before)
+
+    async def _rewrite(self, guild_id, lines):
+        # the edited or deleted messages were indexed above; their points are
+        # rewritten like the bot rewrites them (see rag.rewrite_messages)
+        await self.flush()
+        if self.dry_run:
+            return
+        dropped = []
+        nodes = await rag.indexed_nodes(self.target, guild_id, list(lines))
+        if self.keyword_index is not None:
+            # rewritten nodes are added again with the next batch
+            await asyncio.to_thread(self.keyword_index.delete, guild_id, [node.node_id for node in nodes])
+        for node in nodes:
+            rewritten = rag.rewritten_node(node, lines)
+            if rewritten is None:
+                dropped.append(node.node_id)
+            else:
+                await self._add([rewritten])
+        if dropped:
+            await rag.qd_aclient.delete(
+                collection_name=self.target, points_selector=rest.PointIdsList(points=dropped))
+
+    async def _summary(self, guild_id, summary):
+        await self._add([rag.summary_node(guild_id, summary)])
+        if summary["level"] == "week":
+            # the days it rolls up were indexed before
+            await self.flush()
+            if not self.dry_run:
+                await rag.qd_aclient.delete(
+                    collection_name=self.target,
+                    points_selector=rest.Filter(must=[
+                        rest.FieldCondition(key="guild_id", match=rest.MatchValue(value=guild_id)),
+                        rest.FieldCondition(key="channel_id", match=rest.MatchValue(value=summary["channel_id"])),
+                        rest.FieldCondition(key="summary_level", match=rest.MatchValue(value="day")),
+                        rest.FieldCondition(key="period_start", range=rest.Range(gte=summary["start"], lt=summary["end"])),
+                    ]))
+                if self.keyword_index is not None:
+                    days = [
+                        {"channel_id": summary["channel_id"], "level": "day", "start": start}
+                        for start in range(summary["start"], summary["end"], 24 * 3600)
+                    ]
+                    await asyncio.to_thread(
+                        self.keyword_index.delete, guild_id, [rag.summary_id(guild_id, day) for day in days])
+
+    async def run_pass(self, checkpoint_every):
+        """Index every record after the checkpoint; returns how many were read."""
+        read = 0
+        for record in read_records(self.persist_dir, after_seq=self.seq):
+            read += 1
+            if record["op"] == "forget":
+                await self._forget(record["guild_id"])
+            elif record["op"] == "prune":
+                await self._prune(record["guild_id"], record["channel_id"], record["before"])
+            elif record["op"] == "summary":
+                await self._summary(record["guild_id"], record["summary"])
+            elif record["op"] == "edit":
+                await self._rewrite(record["guild_id"], {record["message_id"]: record["message_str"]})
+            elif record["op"] == "delete":
+                await self._rewrite(record["guild_id"], dict.fromkeys(record["message_ids"]))
+            else:
+                msg = Message.model_validate(record["message"])
+                # images live in their own collection, which does not depend
+                # on the text embedding model
+                if not msg.is_image:
+                    self.messages += 1
+                    await self._add(self._nodes_for(record["guild_id"], msg))
+            self.seq = record["seq"]
+            if read % checkpoint_every == 0:
+                await self.flush()
+                if not self.dry_run:
+                    self.save_checkpoint()
+                logger.info(self.report())
+        await self.flush()
+        if not self.dry_run:
+            self.save_checkpoint()
+        return read
+
+    def _nodes_for(self, guild_id, msg):
+        if self.builder is None:
+            return [rag.message_node(msg.message_str, msg.posted_at, msg.author, guild_id, msg.channel_id, msg.message_id)]
+        closed = self.builder.add(guild_id, msg.channel_id, msg.posted_at, msg.author, msg.message_str, msg.message_id)
+        return [rag.window_node(window) for window in closed]
+
+    def report(self):
+        elapsed = time.monotonic() - self.started
+        return (f"{self.messages:,} messages -> {self.nodes:,} nodes, {self.tokens:,} tokens "
+                f"in {elapsed:.0f}s ({self.nodes / max(elapsed, 1e-9):,.0f} nodes/s, "
+                f"concurrency {self.limiter.limit}, {self.limiter.rate_limited} rate limited)")
+
+
+async def next_version(client, alias):
+    versions = [0]
+    pattern = re.compile(rf"^{re.escape(alias)}_v(\d+)$")
+    for collection in (await client.get_collections()).collections:
+        match = pattern.match(collection.name)
+        if match:
+            versions.append(int(match.group(1)))
+    return f"{alias}_v{max(versions) + 1}"
+
+
+async def sample_throughput(batch_size):
+    """Nodes per second of one embedding call of ``batch_size`` texts."""
+    # unique texts, so the embedding cache cannot answer them
+    texts = [f"[{datetime.now()}] - @sample on #[sample]: `reindex throughput probe {i}`" for i in range(batch_size)]
+    started = time.perf_counter()
+    await rag.embed_model.aget_text_embedding_batch(texts)
+    return batch_size / (time.perf_counter() - started)
+
+
+async def wait_until_serving(client, target, timeout):
+    """Wait up to ``timeout`` seconds for a running bot to switch to ``target``."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        marker = await read_marker(client, target)
+        if marker and marker.get("serving"):
+            return True
+        await asyncio.sleep(min(2.0, settings.QDRANT_ALIAS_CHECK_INTERVAL))
+    return False
+
+
+async def main(args):
+    client = rag.qd_aclient
+    alias = settings.QDRANT_COLLECTION
+    checkpoint_path = Path(args.checkpoint)
+    checkpoint = {}
+    if checkpoint_path.is_file() and not args.restart:
+        with open(checkpoint_path, "r", encoding="utf-8") as file:
+            checkpoint = json.load(file)
+    target = checkpoint.get("target") or await next_version(client, alias)
+
+    keyword_index = None
+    if settings.RAG_HYBRID and not args.dry_run:
+        keyword_index = KeywordIndex(keyword_index_path(target))
+    reindexer = Reindexer(args.persist_dir, target, args.batch_size, args.concurrency, checkpoint_path,
+                          dry_run=args.dry_run, keyword_index=keyword_index)
+    if args.dry_run:
+        await reindexer.run_pass(args.checkpoint_every)
+        per_second = await sample_throughput(args.batch_size) * args.concurrency
+        print(reindexer.report())
+        print(f"estimated cost: ${reindexer.tokens / 1e6 * args.price_per_million:,.2f} "
+              f"at ${args.price_per_million}/1M tokens")
+        print(f"estimated time: {reindexer.nodes / per_second / 60:,.1f} min "
+              f"at ~{per_second:,.0f} nodes/s ({args.concurrency} concurrent batches of {args.batch_size})")
+        return
+
+    if checkpoint:
+        reindexer.seq = checkpoint["seq"]
+        reindexer.messages = checkpoint.get("messages", 0)
+        reindexer.nodes = checkpoint.get("nodes", 0)
+        print(f"Resuming {target} after seq {reindexer.seq}")
+    dim = len(await rag.embed_model.aget_text_embedding("dimension probe"))
+    await ensure_collection(client, target, dim)
+    await write_marker(client, target, rag.embed_model.model_name, dim,
+                       keyword_index=keyword_index.path if keyword_index is not None else None)
+    await reindexer.run_pass(args.checkpoint_every)
+    # the bot kept remembering messages meanwhile; catch up until quiet
+    while await reindexer.run_pass(args.checkpoint_every) > args.catch_up_threshold:
+        pass
+
+    current = await resolve_alias(client, alias)
+    previous_marker = await read_marker(client, current) if current is not None else None
+    previous = await switch_alias(client, alias, target)
+    # until a running bot has switched, it indexes what it remembers into the
+    # previous version only; that is picked up by the pass after it did
+    serving = args.wait_for_bot > 0 and await wait_until_serving(client, target, args.wait_for_bot)
+    if args.wait_for_bot > 0 and not serving:
+        print(f"No bot switched to {target} within {args.wait_for_bot:.0f}s; "
+              f"messages it indexes before switching are only in {previous}")
+    await reindexer.run_pass(args.checkpoint_every)
+    if keyword_index is not None:
+        keyword_index.close()
+    checkpoint_path.unlink(missing_ok=True)
+    print(reindexer.report())
+    print(f"{alias} now points at {target} (was {previous})")
+    if args.drop_old and previous and previous != alias and previous != target:
+        await client.delete_collection(previous)
+        print(f"Deleted {previous}")
+        # the bot let go of the previous keyword index when it switched
+        old_keywords = (previous_marker or {}).get("keyword_index")
+        if serving and old_keywords and old_keywords != settings.KEYWORD_INDEX_PATH:
+            for suffix in ("", "-wal", "-shm"):
+                Path(old_keywords + suffix).unlink(missing_ok=True)
+            print(f"Deleted {old_keywords}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild the text collection from the message store.")
+    parser.add_argument("--dry-run", action="store_true", help="only estimate nodes, tokens, cost and time")
+    parser.add_argument("--batch-size", type=int, default=256, help="texts per embedding call")
+    parser.add_argument("--concurrency", type=int, default=8, help="most embedding calls in flight")
+    parser.add_argument("--persist-dir", default="./.persist", help="the bot's message store")
+    parser.add_argument("--checkpoint", default="./.persist/reindex.json")
+    parser.add_argument("--checkpoint-every", type=int, default=10_000, help="records between checkpoints")
+    parser.add_argument("--catch-up-threshold", type=int, default=100,
+                        help="switch once a catch-up pass reads at most this many records")
+    parser.add_argument("--restart", action="store_true", help="ignore the checkpoint and start a new version")
+    parser.add_argument("--drop-old", action="store_true", help="delete the previous version after switching")
+    parser.add_argument("--wait-for-bot", type=float, default=120,
+                        help="seconds to wait for a running bot to switch before the last pass (0: no bot runs)")
+    parser.add_argument("--price-per-million", type=float, default=0.02,
+                        help="embedding price in $ per 1M tokens (text-embedding-3-small: 0.02)")
+    asyncio.run(main(parser.parse_args()))
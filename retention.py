@@ -0,0 +1,290 @@
+"""Retention: old messages are replaced by daily and weekly summaries.
+
+A channel's policy (``/retention``, or the ``RETENTION_*`` defaults) limits
+how old its messages may get and how many it keeps. Every
+``RETENTION_INTERVAL`` seconds the compactor expires what is beyond that,
+rounded down to whole UTC days, channel by channel:
+
+1. the expired messages of each day are summarized by the LLM into one
+   summary per channel and day, which is embedded and upserted right away;
+2. their message, window and image points are deleted from Qdrant and the
+   keyword index;
+3. the summaries are journaled in the message store together with a
+   ``prune`` record, and the in-memory history drops the messages.
+
+Day summaries older than ``RETENTION_WEEKLY_AFTER_DAYS`` are rolled up into
+one summary per week the same way. Summary points carry ``summary_level``
+and the ``period_start``/``period_end`` they cover, and keep the same id for
+the same period, so a run interrupted at any step is simply repeated.
+"""
+import asyncio
+import itertools
+import json
+import time
+from collections import Counter
+from dataclasses import asdict, dataclass
+from pathlib import Path
+
+import settings
+from context_builder import count_tokens
+from history import from_micros, to_micros
+from metrics import metrics
+from prompts import rollup_prompt, summary_prompt
+from rag import answer_cache, drop_summaries, index_summaries, prune_index
+from scheduler import BACKGROUND, scheduled
+
+
+logger = settings.logging.getLogger("bot")
+
+DAY = 86400
+WEEK = 7 * DAY
+# epoch seconds are counted from a Thursday; weeks start on Mondays
+_MONDAY = 4 * DAY
+# summaries name their most active authors, not everyone
+MAX_AUTHORS = 10
+
+
+def day_start(ts):
+    return int(ts - ts % DAY)
+
+
+def week_start(ts):
+    return int(ts - (ts - _MONDAY) % WEEK)
+
+
+def _render(msg):
+    return f"@{msg.author}: {msg.just_msg}" if not msg.is_image else f"@{msg.author} posted an image"
+
+
+@dataclass
+class RetentionPolicy:
+    max_age_days: int = 0
+    max_messages: int = 0
+
+    @classmethod
+    def default(cls):
+        return cls(settings.RETENTION_MAX_AGE_DAYS, settings.RETENTION_MAX_MESSAGES)
+
+    def describe(self):
+        limits = []
+        if self.max_age_days:
+            limits.append(f"the last {self.max_age_days} days")
+        if self.max_messages:
+            limits.append(f"the newest {self.max_messages:,} messages of each channel")
+        return " and ".join(limits) or "every message"
+
+
+class RetentionPolicies:
+    """Per-guild and per-channel policies; a channel's replaces its guild's."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        # "guild_id" or "guild_id:channel_id" -> policy fields
+        self._policies: dict[str, dict] = {}
+        if self.path.is_file():
+            with open(self.path, "r", encoding="utf-8") as file:
+                self._policies = json.load(file)
+
+    def get(self, guild_id, channel_id=None) -> RetentionPolicy:
+        for key in (f"{guild_id}:{channel_id}", str(guild_id)):
+            if key in self._policies:
+                return RetentionPolicy(**self._policies[key])
+        return RetentionPolicy.default()
+
+    def set(self, guild_id, policy, channel_id=None):
+        key = str(guild_id) if channel_id is None else f"{guild_id}:{channel_id}"
+        self._policies[key] = asdict(policy)
+        self._save()
+
+    def _save(self):
+        tmp_path = self.path.with_suffix(".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(self._policies, file)
+        tmp_path.replace(self.path)
+
+
+def expiry(history, guild_id, channel_id, policy, now):
+    """Epoch seconds (a UTC midnight) before which a channel's messages
+    expire, or ``None``."""
+    before = 0
+    if policy.max_age_days:
+        before = now - policy.max_age_days * DAY
+    if policy.max_messages:
+        # the oldest message that is kept
+        kept = history.nth_newest(guild_id, channel_id, policy.max_messages)
+        if kept is not None:
+            before = max(before, to_micros(kept) / 1e6)
+    return day_start(before) or None
+
+
+class Compactor:
+    def __init__(self, history, store, policies, llm, label, interval=None, release=None):
+        """``label(channel_id)`` names a channel in summaries, like the
+        ``#[...]`` of message_str; ``await release(refs)`` is handed the
+        image refs of expired messages, whose files may be unused now."""
+        self.history = history
+        self.store = store
+        self.policies = policies
+        self.llm = llm
+        self.label = label
+        self.release = release
+        self.interval = interval or settings.RETENTION_INTERVAL
+        # (guild_id, channel_id) -> {(level, start): summary}
+        self._summaries: dict[tuple[int, int], dict[tuple[str, int], dict]] = {}
+        for guild_id, summary in store.iter_summaries():
+            self._remember(guild_id, summary)
+
+    def _remember(self, guild_id, summary):
+        self._summaries.setdefault((guild_id, summary["channel_id"]), {})[
+            (summary["level"], summary["start"])] = summary
+
+    def summarized_since(self, guild_id):
+        """Start of the oldest summary of every channel that has one."""
+        since = {}
+        for (guild, channel_id), known in self._summaries.items():
+            if guild == guild_id and known:
+                since[channel_id] = from_micros(min(start for _, start in known) * 10**6)
+        return since
+
+    def forget(self, guild_id):
+        for key in [key for key in self._summaries if key[0] == guild_id]:
+            del self._summaries[key]
+
+    async def run_forever(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.run()
+            except Exception:
+                logger.exception("Retention compaction failed")
+
+    async def run(self, now=None):
+        now = now or time.time()
+        guilds = dict.fromkeys(self.history.guilds() + [guild_id for guild_id, _ in self._summaries])
+        for guild_id in guilds:
+            # summaries wait for answers, and guilds take turns
+            with scheduled(BACKGROUND, guild_id):
+                oldest = self.history.oldest(guild_id)
+                for channel_id, first in oldest.items():
+                    before = expiry(self.history, guild_id, channel_id, self.policies.get(guild_id, channel_id), now)
+                    if before is None:
+                        continue
+                    # a long backlog is worked off a bounded number of days per run
+                    before = min(before, day_start(to_micros(first) / 1e6) + settings.RETENTION_DAYS_PER_RUN * DAY)
+                    try:
+                        with metrics.timer("retention_expire", guild_id):
+                            await self.expire(guild_id, channel_id, before)
+                    except Exception:
+                        logger.exception(f"Expiring channel {channel_id} of guild {guild_id} failed")
+                if settings.RETENTION_WEEKLY_AFTER_DAYS:
+                    try:
+                        with metrics.timer("retention_rollup", guild_id):
+                            await self.roll_up(guild_id, week_start(now - settings.RETENTION_WEEKLY_AFTER_DAYS * DAY))
+                    except Exception:
+                        logger.exception(f"Rolling up the summaries of guild {guild_id} failed")
+
+    async def expire(self, guild_id, channel_id, before):
+        """Summarize and drop a channel's messages posted before ``before``;
+        returns how many were dropped."""
+        # copies: the history changes while the summaries are written
+        msgs = [
+            msg.to_message()
+            for msg in self.history.between(guild_id, until=from_micros(before * 10**6), channel_ids=[channel_id])
+        ]
+        if not msgs:
+            return 0
+        known = self._summaries.get((guild_id, channel_id), {})
+        summaries = []
+        for day, group in itertools.groupby(msgs, key=lambda msg: day_start(to_micros(msg.posted_at) / 1e6)):
+            group = list(group)
+            # backfilled history can expire into a day that already has a summary
+            previous = known.get(("day", day))
+            text = await self._summarize(previous, group)
+            authors = Counter(msg.author for msg in group)
+            if previous is not None:
+                authors.update(dict.fromkeys(previous["authors"], 0))
+            summaries.append({
+                "channel_id": channel_id,
+                "label": self.label(channel_id),
+                "level": "day",
+                "start": day,
+                "end": day + DAY,
+                "text": text,
+                "messages": len(group) + (previous["messages"] if previous else 0),
+                "authors": [author for author, _ in authors.most_common(MAX_AUTHORS)],
+            })
+
+        await index_summaries(guild_id, summaries)
+        await prune_index(guild_id, channel_id, before)
+        self.store.prune(guild_id, channel_id, before, summaries)
+        for summary in summaries:
+            self._remember(guild_id, summary)
+        dropped, image_refs = self.history.prune(guild_id, channel_id, from_micros(before * 10**6))
+        answer_cache.invalidate_channel(guild_id, channel_id)
+        if image_refs and self.release is not None:
+            await self.release(image_refs)
+        metrics.inc("expired_messages", dropped)
+        metrics.inc("summaries_written", len(summaries), level="day")
+        logger.info(f"Replaced {dropped} messages of channel {channel_id} with {len(summaries)} daily summaries")
+        return dropped
+
+    async def _summarize(self, previous, msgs):
+        """Fold ``msgs`` into ``previous``'s text, a token-bounded batch per LLM call."""
+        text = previous["text"] if previous else ""
+        batch, tokens = [], 0
+        for line in map(_render, msgs):
+            batch.append(line)
+            tokens += count_tokens(line)
+            if tokens >= settings.RETENTION_SUMMARY_BATCH_TOKENS:
+                text = await self._fold(text, batch)
+                batch, tokens = [], 0
+        if batch:
+            text = await self._fold(text, batch)
+        return text
+
+    async def _fold(self, text, lines):
+        response = await self.llm.acomplete(summary_prompt.format(
+            summary=text or "(none yet)",
+            messages="\n".join(lines),
+            max_words=settings.RETENTION_SUMMARY_WORDS))
+        return response.text.strip()
+
+    async def roll_up(self, guild_id, horizon):
+        """Replace the day summaries of weeks that ended before ``horizon``
+        with one summary per week."""
+        for (guild, channel_id), known in list(self._summaries.items()):
+            if guild != guild_id:
+                continue
+            days = sorted(
+                (summary for (level, start), summary in known.items() if level == "day" and start < horizon),
+                key=lambda summary: summary["start"])
+            # horizon is a week start, so these weeks are complete
+            for week, group in itertools.groupby(days, key=lambda summary: week_start(summary["start"])):
+                group = list(group)
+                previous = known.get(("week", week))
+                response = await self.llm.acomplete(rollup_prompt.format(
+                    summary=previous["text"] if previous else "(none yet)",
+                    days="\n".join(
+                        f"{from_micros(summary['start'] * 10**6).strftime('%m-%d-%Y')}: {summary['text']}"
+                        for summary in group),
+                    max_words=settings.RETENTION_SUMMARY_WORDS))
+                authors = Counter()
+                for summary in group + ([previous] if previous else []):
+                    authors.update(dict.fromkeys(summary["authors"], summary["messages"]))
+                summary = {
+                    "channel_id": channel_id,
+                    "label": group[-1]["label"],
+                    "level": "week",
+                    "start": week,
+                    "end": week + WEEK,
+                    "text": response.text.strip(),
+                    "messages": sum(day["messages"] for day in group) + (previous["messages"] if previous else 0),
+                    "authors": [author for author, _ in authors.most_common(MAX_AUTHORS)],
+                }
+                await index_summaries(guild_id, [summary])
+                await drop_summaries(guild_id, group)
+                self.store.add_summaries(guild_id, [summary])
+                for day in group:
+                    del known[("day", day["start"])]
+                self._remember(guild_id, summary)
+                metrics.inc("summaries_written", 1, level="week")
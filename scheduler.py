@@ -0,0 +1,385 @@
+"""Central scheduling of outbound LLM and embedding calls.
+
+Every call to a provider first takes a slot from the ``Scheduler``:
+
+* priority classes: interactive answers (``INTERACTIVE``) go before
+  background summaries (``BACKGROUND``), which go before ingestion and
+  backfills (``BULK``);
+* within a class guilds take turns, so a noisy server queues behind itself
+  instead of ahead of everyone else;
+* every provider has a token bucket (calls per second plus a burst) and a
+  cap on calls in flight.
+
+The class and guild of a call come from context variables, set with
+``scheduled()`` around a block or ``run_as()`` at the top of a task, so the
+calls llama-index makes internally (a retriever embedding its query, a
+synthesizer calling the LLM) are scheduled without passing anything through.
+``ScheduledEmbedding`` and ``ScheduledLLM`` wrap the models to do that.
+
+``Coalescer`` runs identical in-flight requests (same guild, channel and
+query) once and shares the result, or replays the stream, with each caller.
+"""
+import asyncio
+import time
+from collections import OrderedDict, deque
+from contextlib import AsyncExitStack, asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from typing import Any, List, Sequence
+
+from llama_index.core.base.embeddings.base import BaseEmbedding, Embedding
+from llama_index.core.base.llms.types import (
+    ChatMessage,
+    ChatResponse,
+    ChatResponseAsyncGen,
+    ChatResponseGen,
+    CompletionResponse,
+    CompletionResponseAsyncGen,
+    CompletionResponseGen,
+    LLMMetadata,
+)
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.llms.llm import LLM
+
+import settings
+from metrics import metrics
+
+
+INTERACTIVE = 0
+BACKGROUND = 1
+BULK = 2
+PRIORITY_NAMES = ("interactive", "background", "bulk")
+
+_priority: ContextVar[int] = ContextVar("scheduler_priority", default=INTERACTIVE)
+_guild: ContextVar[int | None] = ContextVar("scheduler_guild", default=None)
+
+
+@contextmanager
+def scheduled(priority, guild_id=None):
+    """Schedule the calls made inside the block as ``priority`` for ``guild_id``."""
+    priority_token, guild_token = _priority.set(priority), _guild.set(guild_id)
+    try:
+        yield
+    finally:
+        _priority.reset(priority_token)
+        _guild.reset(guild_token)
+
+
+def run_as(priority, guild_id=None):
+    """Like ``scheduled``, for the rest of the current task."""
+    _priority.set(priority)
+    _guild.set(guild_id)
+
+
+class TokenBucket:
+    """``rate`` calls per second on average, up to ``burst`` at once (rate 0: unlimited)."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self._updated = time.monotonic()
+
+    def delay(self):
+        """Seconds until a token is available."""
+        if not self.rate:
+            return 0.0
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        if self.rate:
+            self.tokens -= 1
+
+
+class _Provider:
+    def __init__(self, name, rate, burst, concurrency):
+        self.name = name
+        self.bucket = TokenBucket(rate, burst)
+        self.concurrency = concurrency
+        self.in_flight = 0
+        # per priority: guild -> waiters, in the order guilds take turns
+        self.queues: list[OrderedDict[int | None, deque[asyncio.Future]]] = [
+            OrderedDict() for _ in PRIORITY_NAMES]
+        self._timer = None
+
+    @property
+    def waiting(self):
+        return sum(len(waiters) for queue in self.queues for waiters in queue.values())
+
+    def enqueue(self, priority, guild_id):
+        future = asyncio.get_running_loop().create_future()
+        self.queues[priority].setdefault(guild_id, deque()).append(future)
+        self.dispatch()
+        return future
+
+    def _next(self):
+        for queue in self.queues:
+            while queue:
+                guild_id, waiters = next(iter(queue.items()))
+                future = waiters.popleft()
+                if waiters:
+                    # the guild's next call waits for every other guild's turn
+                    queue.move_to_end(guild_id)
+                else:
+                    del queue[guild_id]
+                if not future.cancelled():
+                    return future
+        return None
+
+    def dispatch(self):
+        self._timer = None
+        while self.in_flight < self.concurrency:
+            if not any(self.queues):
+                return
+            delay = self.bucket.delay()
+            if delay > 0:
+                if self._timer is None:
+                    self._timer = asyncio.get_running_loop().call_later(delay, self.dispatch)
+                return
+            future = self._next()
+            if future is None:
+                return
+            self.bucket.take()
+            self.in_flight += 1
+            future.set_result(None)
+
+    def release(self):
+        self.in_flight -= 1
+        self.dispatch()
+
+
+class Scheduler:
+    def __init__(self, providers=None):
+        """``providers`` maps a provider name to ``(rate, burst, concurrency)``."""
+        if providers is None:
+            providers = {
+                "llm": (settings.LLM_RATE, settings.LLM_BURST, settings.LLM_CONCURRENCY),
+                "embed": (settings.EMBED_RATE, settings.EMBED_BURST, settings.EMBED_CONCURRENCY),
+            }
+        self._providers = {name: _Provider(name, *limits) for name, limits in providers.items()}
+
+    def waiting(self, provider):
+        return self._providers[provider].waiting
+
+    def in_flight(self, provider):
+        return self._providers[provider].in_flight
+
+    @asynccontextmanager
+    async def slot(self, provider, priority=None, guild_id=None):
+        """Wait for a call to ``provider``, in the current context's class and
+        guild unless given."""
+        priority = _priority.get() if priority is None else priority
+        guild_id = _guild.get() if guild_id is None else guild_id
+        state = self._providers[provider]
+        started = time.perf_counter()
+        future = state.enqueue(priority, guild_id)
+        try:
+            await future
+        except asyncio.CancelledError:
+            # granted and cancelled at the same time
+            if future.done() and not future.cancelled():
+                state.release()
+            raise
+        metrics.observe(f"{provider}_wait_{PRIORITY_NAMES[priority]}", time.perf_counter() - started, guild_id)
+        try:
+            yield
+        finally:
+            state.release()
+
+
+class ScheduledEmbedding(BaseEmbedding):
+    """Wraps an embedding model so that its async calls take scheduler slots.
+
+    Sits under the embedding cache, so cached texts never wait.
+    """
+
+    _inner: BaseEmbedding = PrivateAttr()
+    _scheduler: Scheduler = PrivateAttr()
+
+    def __init__(self, inner: BaseEmbedding, scheduler: Scheduler, **kwargs):
+        super().__init__(
+            model_name=inner.model_name,
+            embed_batch_size=inner.embed_batch_size,
+            callback_manager=inner.callback_manager,
+            **kwargs)
+        self._inner = inner
+        self._scheduler = scheduler
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "ScheduledEmbedding"
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        return self._inner._get_text_embeddings(texts)
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        async with self._scheduler.slot("embed"):
+            return await self._inner._aget_text_embeddings(texts)
+
+    def _get_text_embedding(self, text: str) -> Embedding:
+        return self._inner._get_text_embedding(text)
+
+    async def _aget_text_embedding(self, text: str) -> Embedding:
+        async with self._scheduler.slot("embed"):
+            return await self._inner._aget_text_embedding(text)
+
+    def _get_query_embedding(self, query: str) -> Embedding:
+        return self._inner._get_query_embedding(query)
+
+    async def _aget_query_embedding(self, query: str) -> Embedding:
+        async with self._scheduler.slot("embed"):
+            return await self._inner._aget_query_embedding(query)
+
+
+class ScheduledLLM(LLM):
+    """Wraps an LLM so that its async calls take scheduler slots; a stream
+    keeps its slot until it is exhausted. The sync calls pass straight through."""
+
+    _inner: LLM = PrivateAttr()
+    _scheduler: Scheduler = PrivateAttr()
+
+    def __init__(self, inner: LLM, scheduler: Scheduler, **kwargs):
+        super().__init__(
+            callback_manager=inner.callback_manager,
+            system_prompt=inner.system_prompt,
+            messages_to_prompt=inner.messages_to_prompt,
+            completion_to_prompt=inner.completion_to_prompt,
+            **kwargs)
+        self._inner = inner
+        self._scheduler = scheduler
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "ScheduledLLM"
+
+    @property
+    def metadata(self) -> LLMMetadata:
+        return self._inner.metadata
+
+    def chat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponse:
+        return self._inner.chat(messages, **kwargs)
+
+    def complete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponse:
+        return self._inner.complete(prompt, formatted=formatted, **kwargs)
+
+    def stream_chat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponseGen:
+        return self._inner.stream_chat(messages, **kwargs)
+
+    def stream_complete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponseGen:
+        return self._inner.stream_complete(prompt, formatted=formatted, **kwargs)
+
+    async def achat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponse:
+        async with self._scheduler.slot("llm"):
+            return await self._inner.achat(messages, **kwargs)
+
+    async def acomplete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponse:
+        async with self._scheduler.slot("llm"):
+            return await self._inner.acomplete(prompt, formatted=formatted, **kwargs)
+
+    async def _stream(self, start):
+        stack = AsyncExitStack()
+        await stack.enter_async_context(self._scheduler.slot("llm"))
+        try:
+            responses = await start()
+        except BaseException:
+            await stack.aclose()
+            raise
+
+        async def gen():
+            async with stack:
+                async for response in responses:
+                    yield response
+        return gen()
+
+    async def astream_chat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponseAsyncGen:
+        return await self._stream(lambda: self._inner.astream_chat(messages, **kwargs))
+
+    async def astream_complete(
+            self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponseAsyncGen:
+        return await self._stream(lambda: self._inner.astream_complete(prompt, formatted=formatted, **kwargs))
+
+
+class _Broadcast:
+    """One stream of deltas, replayed to every subscriber."""
+
+    def __init__(self, deltas):
+        self.deltas = []
+        self.done = False
+        self.error = None
+        self._changed = asyncio.Condition()
+        self.task = asyncio.create_task(self._pump(deltas))
+
+    async def _pump(self, deltas):
+        try:
+            async for delta in deltas:
+                async with self._changed:
+                    self.deltas.append(delta)
+                    self._changed.notify_all()
+        except Exception as err:
+            self.error = err
+        finally:
+            async with self._changed:
+                self.done = True
+                self._changed.notify_all()
+
+    async def subscribe(self):
+        i = 0
+        while True:
+            async with self._changed:
+                await self._changed.wait_for(lambda: self.done or i < len(self.deltas))
+                pending = self.deltas[i:]
+                done = self.done
+            for delta in pending:
+                yield delta
+            i += len(pending)
+            if done and i == len(self.deltas):
+                if self.error is not None:
+                    raise self.error
+                return
+
+
+class Coalescer:
+    """Shares identical in-flight requests.
+
+    The first request for a key runs; the ones arriving while it is in flight
+    wait for its result (``run``) or replay its stream (``stream``). A caller
+    that goes away does not cancel the shared work for the others.
+    """
+
+    def __init__(self):
+        self._running: dict[tuple, asyncio.Future] = {}
+        self._streams: dict[tuple, _Broadcast] = {}
+        self.coalesced = 0
+
+    def _joined(self, key):
+        self.coalesced += 1
+        metrics.inc("coalesced_requests", kind=key[0])
+
+    async def run(self, key, fn):
+        """``await fn()`` once for all concurrent callers with the same ``key``.
+
+        ``fn()`` runs in a task that inherits the first caller's context.
+        """
+        task = self._running.get(key)
+        if task is None:
+            task = self._running[key] = asyncio.ensure_future(fn())
+            task.add_done_callback(lambda _: self._running.pop(key, None))
+        else:
+            self._joined(key)
+        return await asyncio.shield(task)
+
+    def stream(self, key, fn):
+        """Iterate ``fn()`` once for all concurrent callers with the same ``key``.
+
+        ``fn()`` starts right away, in a task that inherits the caller's
+        context (and so its scheduling class).
+        """
+        broadcast = self._streams.get(key)
+        if broadcast is None:
+            broadcast = self._streams[key] = _Broadcast(fn())
+            broadcast.task.add_done_callback(lambda _: self._streams.pop(key, None))
+        else:
+            self._joined(key)
+        return broadcast.subscribe()
@@ -8,11 +8,156 @@ from dotenv import load_dotenv
 load_dotenv()
 
 LAST_N_MESSAGES = 8
+# how many indexed messages /rag retrieves as context
+RAG_TOP_K = int(os.environ.get('RAG_TOP_K', 8))
+# newest messages of a channel used for recent-context lookups; this does not
+# bound the in-memory history, which keeps every message until retention
+# drops it (see retention.py)
+RECENT_MESSAGES_PER_CHANNEL = int(os.environ.get('RECENT_MESSAGES_PER_CHANNEL', 200))
 
 DISCORD_API_SECRET = os.environ.get('DISCORD_API_TOKEN', "")
 
 QDRANT_API_KEY = os.environ.get('QDRANT_KEY', '')
 QDRANT_URL = os.environ.get('QDRANT_URL', '')
+# ':memory:' or a directory runs Qdrant in-process (local mode) instead of
+# connecting to QDRANT_URL
+QDRANT_PATH = os.environ.get('QDRANT_PATH', '')
+QDRANT_COLLECTION = os.environ.get('QDRANT_COLLECTION', 'discord_llamabot')
+QDRANT_IMAGE_COLLECTION = os.environ.get('QDRANT_IMAGE_COLLECTION', 'image_collection')
+# collection layout (see qdrant_schema): per-guild HNSW graphs with
+# QDRANT_PAYLOAD_M links instead of a global graph, optional int8 scalar
+# quantization and vectors kept on disk instead of in RAM
+QDRANT_HNSW_M = int(os.environ.get('QDRANT_HNSW_M', 0))
+QDRANT_PAYLOAD_M = int(os.environ.get('QDRANT_PAYLOAD_M', 16))
+QDRANT_QUANTIZATION = bool(int(os.environ.get('QDRANT_QUANTIZATION', 0)))
+QDRANT_ON_DISK = bool(int(os.environ.get('QDRANT_ON_DISK', 0)))
+# seconds between checks whether reindex.py moved the collection alias to a
+# new version, which the bot then switches to along with its embedding model
+QDRANT_ALIAS_CHECK_INTERVAL = float(os.environ.get('QDRANT_ALIAS_CHECK_INTERVAL', 30))
+
+# message journal: fold the journal into a snapshot every N appended records,
+# fsync every append when durability matters more than throughput
+MESSAGE_STORE_COMPACT_EVERY = int(os.environ.get('MESSAGE_STORE_COMPACT_EVERY', 5000))
+MESSAGE_STORE_FSYNC = bool(int(os.environ.get('MESSAGE_STORE_FSYNC', 0)))
+
+# background ingestion: embed/upsert up to INGEST_MAX_BATCH nodes at once,
+# waiting at most INGEST_MAX_LINGER seconds for a batch to fill up
+INGEST_MAX_BATCH = int(os.environ.get('INGEST_MAX_BATCH', 64))
+INGEST_MAX_LINGER = float(os.environ.get('INGEST_MAX_LINGER', 0.5))
+INGEST_QUEUE_SIZE = int(os.environ.get('INGEST_QUEUE_SIZE', 2000))
+INGEST_MAX_RETRIES = int(os.environ.get('INGEST_MAX_RETRIES', 5))
+INGEST_RETRY_BACKOFF = float(os.environ.get('INGEST_RETRY_BACKOFF', 0.5))
+INGEST_WORKERS = int(os.environ.get('INGEST_WORKERS', 4))
+
+# embeddings are cached by (model, text hash) and evicted least-recently-used
+EMBED_CACHE_PATH = os.environ.get('EMBED_CACHE_PATH', './.persist/embeddings.sqlite3')
+EMBED_CACHE_MAX_ENTRIES = int(os.environ.get('EMBED_CACHE_MAX_ENTRIES', 500000))
+
+# image attachments: bytes cap per file, concurrent downloads overall / per host
+IMAGE_MAX_BYTES = int(os.environ.get('IMAGE_MAX_BYTES', 25 * 1024 * 1024))
+IMAGE_DOWNLOAD_CONCURRENCY = int(os.environ.get('IMAGE_DOWNLOAD_CONCURRENCY', 8))
+IMAGE_DOWNLOAD_PER_HOST = int(os.environ.get('IMAGE_DOWNLOAD_PER_HOST', 4))
+IMAGE_DOWNLOAD_TIMEOUT = float(os.environ.get('IMAGE_DOWNLOAD_TIMEOUT', 60))
+# longest side of the downscaled copy that is embedded and shown to the LLM
+IMAGE_THUMB_MAX_SIDE = int(os.environ.get('IMAGE_THUMB_MAX_SIDE', 768))
+# worker processes for decoding/resizing/encoding images
+IMAGE_WORKERS = int(os.environ.get('IMAGE_WORKERS', os.cpu_count() or 2))
+
+# mention replies: token budget for the chat history sent to the LLM, how many
+# of the newest images are sent as images, and when older turns get folded
+# into the rolling per-channel summary
+CHAT_CONTEXT_TOKENS = int(os.environ.get('CHAT_CONTEXT_TOKENS', 6000))
+CHAT_CONTEXT_IMAGES = int(os.environ.get('CHAT_CONTEXT_IMAGES', 2))
+CHAT_IMAGE_TOKENS = int(os.environ.get('CHAT_IMAGE_TOKENS', 800))
+CHAT_SUMMARY_BATCH_TOKENS = int(os.environ.get('CHAT_SUMMARY_BATCH_TOKENS', 1500))
+CHAT_SUMMARY_WORDS = int(os.environ.get('CHAT_SUMMARY_WORDS', 250))
+CHAT_SUMMARIES_PATH = os.environ.get('CHAT_SUMMARIES_PATH', './.persist/summaries.json')
+
+# post answers while they are generated, editing the message at most once
+# per STREAM_EDIT_INTERVAL seconds (Discord allows ~5 edits per 5s)
+STREAM_RESPONSES = bool(int(os.environ.get('STREAM_RESPONSES', 1)))
+STREAM_EDIT_INTERVAL = float(os.environ.get('STREAM_EDIT_INTERVAL', 1.2))
+
+# /rag answers are reused for later questions of the same guild whose
+# embeddings are at least this similar, until a source channel gets a new
+# message or ANSWER_CACHE_TTL seconds pass
+ANSWER_CACHE_THRESHOLD = float(os.environ.get('ANSWER_CACHE_THRESHOLD', 0.92))
+ANSWER_CACHE_TTL = float(os.environ.get('ANSWER_CACHE_TTL', 3600))
+ANSWER_CACHE_MAX_ENTRIES = int(os.environ.get('ANSWER_CACHE_MAX_ENTRIES', 256))
+
+# consecutive messages of a channel are indexed together as one node per
+# conversation window; a window closes after WINDOW_MAX_GAP seconds of
+# silence (which also bounds how long a message waits to become searchable),
+# WINDOW_MAX_TURNS author changes or WINDOW_MAX_TOKENS tokens, and the next
+# one repeats its last WINDOW_OVERLAP messages. INGEST_WINDOWS=0 indexes
+# every message on its own
+INGEST_WINDOWS = bool(int(os.environ.get('INGEST_WINDOWS', 1)))
+WINDOW_MAX_TOKENS = int(os.environ.get('WINDOW_MAX_TOKENS', 384))
+WINDOW_MAX_TURNS = int(os.environ.get('WINDOW_MAX_TURNS', 8))
+WINDOW_MAX_GAP = float(os.environ.get('WINDOW_MAX_GAP', 300))
+WINDOW_OVERLAP = int(os.environ.get('WINDOW_OVERLAP', 2))
+
+# /rag fuses the vector search with a BM25 keyword index (reciprocal rank
+# fusion); when the embedder takes longer than RAG_DENSE_TIMEOUT seconds or
+# fails, the keyword results are used on their own
+RAG_HYBRID = bool(int(os.environ.get('RAG_HYBRID', 1)))
+RAG_DENSE_TIMEOUT = float(os.environ.get('RAG_DENSE_TIMEOUT', 5))
+KEYWORD_INDEX_PATH = os.environ.get('KEYWORD_INDEX_PATH', './.persist/keywords.sqlite3')
+
+# /backfill: channels paged at the same time, and where their progress is
+# checkpointed so an interrupted backfill resumes
+BACKFILL_CONCURRENCY = int(os.environ.get('BACKFILL_CONCURRENCY', 4))
+BACKFILL_CHECKPOINTS_PATH = os.environ.get('BACKFILL_CHECKPOINTS_PATH', './.persist/backfill.json')
+
+# Prometheus metrics at http://METRICS_HOST:METRICS_PORT/metrics (0 turns the
+# endpoint off, /stats keeps working); latency quantiles cover the last
+# METRICS_WINDOW samples of each stage, and METRICS_GUILD_LABELS=0 drops the
+# per-guild series when there are too many guilds to export
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 9108))
+METRICS_HOST = os.environ.get('METRICS_HOST', '127.0.0.1')
+METRICS_WINDOW = int(os.environ.get('METRICS_WINDOW', 1024))
+METRICS_GUILD_LABELS = bool(int(os.environ.get('METRICS_GUILD_LABELS', 1)))
+# print every llama-index event to stdout (llama-index's "simple" handler)
+LLAMA_INDEX_DEBUG = bool(int(os.environ.get('LLAMA_INDEX_DEBUG', 0)))
+
+# deterministic offline embeddings and LLM (mock_models) instead of the real
+# providers, with a simulated latency per embedding call, before the first
+# token and between tokens
+USE_MOCK = bool(int(os.environ.get('USE_MOCK', 0)))
+MOCK_EMBED_LATENCY = float(os.environ.get('MOCK_EMBED_LATENCY', 0.05))
+MOCK_LLM_LATENCY = float(os.environ.get('MOCK_LLM_LATENCY', 0.5))
+MOCK_LLM_TOKEN_LATENCY = float(os.environ.get('MOCK_LLM_TOKEN_LATENCY', 0.01))
+
+# retention (see retention.py): messages older than RETENTION_MAX_AGE_DAYS or
+# beyond the newest RETENTION_MAX_MESSAGES of a channel are replaced by daily
+# summaries (0 keeps everything; /retention overrides both per guild or
+# channel), and daily summaries older than RETENTION_WEEKLY_AFTER_DAYS are
+# rolled up into weekly ones (0 never does). The compactor runs every
+# RETENTION_INTERVAL seconds and summarizes at most RETENTION_DAYS_PER_RUN
+# days of a channel per run
+RETENTION_MAX_AGE_DAYS = int(os.environ.get('RETENTION_MAX_AGE_DAYS', 0))
+RETENTION_MAX_MESSAGES = int(os.environ.get('RETENTION_MAX_MESSAGES', 0))
+RETENTION_WEEKLY_AFTER_DAYS = int(os.environ.get('RETENTION_WEEKLY_AFTER_DAYS', 28))
+RETENTION_INTERVAL = float(os.environ.get('RETENTION_INTERVAL', 3600))
+RETENTION_DAYS_PER_RUN = int(os.environ.get('RETENTION_DAYS_PER_RUN', 30))
+RETENTION_SUMMARY_WORDS = int(os.environ.get('RETENTION_SUMMARY_WORDS', 200))
+RETENTION_SUMMARY_BATCH_TOKENS = int(os.environ.get('RETENTION_SUMMARY_BATCH_TOKENS', 6000))
+RETENTION_PATH = os.environ.get('RETENTION_PATH', './.persist/retention.json')
+
+# how many /rag and mention replies may be generated at the same time
+RAG_MAX_CONCURRENCY = int(os.environ.get('RAG_MAX_CONCURRENCY', 16))
+RAG_MAX_CONCURRENCY_PER_GUILD = int(os.environ.get('RAG_MAX_CONCURRENCY_PER_GUILD', 4))
+
+# every LLM and embedding call waits for the scheduler (see scheduler.py):
+# *_RATE calls per second on average (0: unlimited), up to *_BURST at once,
+# and at most *_CONCURRENCY in flight; answers go before summaries, which go
+# before ingestion
+LLM_RATE = float(os.environ.get('LLM_RATE', 0))
+LLM_BURST = int(os.environ.get('LLM_BURST', 10))
+LLM_CONCURRENCY = int(os.environ.get('LLM_CONCURRENCY', 16))
+EMBED_RATE = float(os.environ.get('EMBED_RATE', 0))
+EMBED_BURST = int(os.environ.get('EMBED_BURST', 20))
+EMBED_CONCURRENCY = int(os.environ.get('EMBED_CONCURRENCY', 8))
 
 logs_file_path = "logs/infos.log"
 logs_file = Path(logs_file_path)
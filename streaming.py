@@ -0,0 +1,150 @@
+"""Incremental splitting and delivery of LLM output to Discord.
+
+``MessageSplitter`` cuts a stream of text into Discord-sized messages as it
+arrives, closing and reopening code blocks across cuts, and touches every
+character a bounded number of times. ``DiscordStreamer`` posts the message
+being generated and edits it as tokens come in, at most once per
+``STREAM_EDIT_INTERVAL`` seconds.
+"""
+import re
+import time
+
+import settings
+from metrics import metrics
+
+
+FENCE = "```"
+CLOSE_FENCE = "\n```"
+# headings, bold titles and numbered points make good places to cut
+SECTION = re.compile(r"\n(?:#{1,3} |\*\*|\d+\.\s)")
+
+
+def _fence_state(text, in_code, lang):
+    """Code block state after ``text``, starting from ``(in_code, lang)``."""
+    i = text.find(FENCE)
+    while i != -1:
+        if in_code:
+            in_code, lang = False, ""
+        else:
+            end = text.find("\n", i + 3)
+            in_code, lang = True, text[i + 3:end].strip() if end != -1 else ""
+        i = text.find(FENCE, i + 3)
+    return in_code, lang
+
+
+class MessageSplitter:
+    def __init__(self, limit=2000):
+        self.limit = limit
+        self._buf = ""
+        self._pos = 0  # start of the message being built
+        self._in_code = False  # code block state at _pos
+        self._lang = ""
+
+    def _prefix(self):
+        return f"{FENCE}{self._lang}\n" if self._in_code else ""
+
+    def _room(self):
+        return self.limit - len(self._prefix()) - len(CLOSE_FENCE)
+
+    def feed(self, text):
+        """Add ``text`` and return the messages that are now complete."""
+        self._buf += text
+        parts = []
+        while len(self._buf) - self._pos > self._room():
+            parts.append(self._cut())
+        if self._pos > 1 << 16:
+            self._buf = self._buf[self._pos:]
+            self._pos = 0
+        return parts
+
+    def _split_point(self, window):
+        if not self._in_code:
+            last = None
+            for last in SECTION.finditer(window, min(500, len(window))):
+                pass
+            if last is not None and last.start() > 0:
+                return last.start()
+        lo = min(1500, len(window) // 2)
+        newline = window.rfind("\n", lo)
+        if newline > 0:
+            return newline
+        sentence = window.rfind(". ", lo)
+        if sentence > 0:
+            return sentence + 1
+        space = window.rfind(" ", lo)
+        if space > 0:
+            return space
+        return len(window)
+
+    def _cut(self):
+        prefix = self._prefix()
+        window = self._buf[self._pos:self._pos + self._room()]
+        split = self._split_point(window)
+        # never cut through a run of backticks
+        while split > 1 and window[split - 1] == "`":
+            split -= 1
+        body = window[:split]
+        self._in_code, self._lang = _fence_state(body, self._in_code, self._lang)
+        self._pos += split
+        return prefix + body + (CLOSE_FENCE if self._in_code else "")
+
+    def pending(self):
+        """The incomplete message as it should be displayed right now."""
+        body = self._buf[self._pos:]
+        if not body.strip():
+            # a code block continued by a cut shows nothing until it has text
+            return ""
+        in_code, _ = _fence_state(body, self._in_code, self._lang)
+        return self._prefix() + body + (CLOSE_FENCE if in_code else "")
+
+    def flush(self):
+        """Everything that is left, as complete messages."""
+        text = self.pending()
+        self._buf, self._pos, self._in_code, self._lang = "", 0, False, ""
+        return [text] if text.strip() else []
+
+
+def split_message(content, limit=2000):
+    splitter = MessageSplitter(limit)
+    return splitter.feed(content) + splitter.flush()
+
+
+class DiscordStreamer:
+    def __init__(self, send, edit_interval=None, limit=2000, guild_id=None):
+        # send(content) posts a new message and returns it, so it can be edited
+        self._send = send
+        self._guild_id = guild_id
+        self._edit_interval = settings.STREAM_EDIT_INTERVAL if edit_interval is None else edit_interval
+        self._splitter = MessageSplitter(limit)
+        self._current = None
+        self._shown = ""
+        self._last_update = 0.0
+        self._parts = []
+
+    async def _show(self, content):
+        if not content.strip() or content == self._shown:
+            return
+        with metrics.timer("send", self._guild_id):
+            if self._current is None:
+                self._current = await self._send(content)
+            else:
+                await self._current.edit(content=content)
+        self._shown = content
+        self._last_update = time.monotonic()
+
+    async def _complete(self, content):
+        await self._show(content)
+        self._current, self._shown = None, ""
+
+    async def feed(self, delta):
+        self._parts.append(delta)
+        for part in self._splitter.feed(delta):
+            await self._complete(part)
+        if time.monotonic() - self._last_update >= self._edit_interval:
+            await self._show(self._splitter.pending())
+
+    async def finish(self):
+        """Show whatever is left and return the full generated text."""
+        for part in self._splitter.flush():
+            await self._complete(part)
+        return "".join(self._parts)
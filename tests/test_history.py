@@ -0,0 +1,126 @@
+from datetime import datetime, timedelta, timezone
+
+import history
+from history import SYSTEM_PREFIX, MessageHistory, format_message_str
+from models import Message
+
+START = datetime(2024, 5, 1, 12, tzinfo=timezone.utc)
+
+
+def add(remembered, guild_id, i, channel_id=10, text=None, author="alice", is_image=False):
+    posted_at = START + timedelta(minutes=i)
+    text = f"message {i}" if text is None else text
+    msg = Message(
+        message_str=text if is_image else format_message_str(posted_at, author, f"chan-{channel_id}", text),
+        posted_at=posted_at,
+        author=author,
+        channel_id=channel_id,
+        just_msg=text,
+        is_image=is_image,
+        message_id=5000 + i)
+    remembered.add(guild_id, msg)
+    return msg
+
+
+def test_views_read_back_the_messages_that_were_added():
+    remembered = MessageHistory(maxlen=10)
+    added = [add(remembered, 1, i) for i in range(3)]
+    # a message_str that does not follow format_message_str is kept verbatim
+    odd = Message(
+        message_str="something else", posted_at=(START - timedelta(minutes=1)).replace(tzinfo=None),
+        author="bob", channel_id=10, just_msg="odd")
+    remembered.add(1, odd)
+
+    views = remembered.between(1)
+    assert [view.to_message() for view in views] == [odd] + added
+    assert views[0].posted_at.tzinfo is None
+
+
+def test_last_and_channel_return_the_newest_messages_oldest_first():
+    remembered = MessageHistory(maxlen=3)
+    for i in (4, 0, 3, 1, 2):  # backfilled out of order
+        add(remembered, 1, i)
+    add(remembered, 1, 9, channel_id=11)
+
+    assert [view.just_msg for view in remembered.channel(1, 10)] == ["message 2", "message 3", "message 4"]
+    assert [view.just_msg for view in remembered.last(1, 10, 2)] == ["message 3", "message 4"]
+    assert remembered.nth_newest(1, 10, 5) == START
+    assert remembered.nth_newest(1, 10, 6) is None
+    assert remembered.last(1, 12, 2) == [] and remembered.last(2, 10, 2) == []
+    assert remembered.oldest(1) == {10: START, 11: START + timedelta(minutes=9)}
+
+
+def test_edit_changes_the_text_and_message_str():
+    remembered = MessageHistory(maxlen=10)
+    add(remembered, 1, 0)
+    add(remembered, 1, 1, text="img.png", is_image=True)
+
+    [edited] = remembered.edit(1, 5000, "changed")
+    assert edited.just_msg == "changed"
+    assert edited.message_str.endswith("`changed`")
+    # images and unknown messages are not edited
+    assert remembered.edit(1, 5001, "changed") == []
+    assert remembered.edit(1, 4242, "changed") == []
+
+
+def test_deleted_messages_disappear_from_every_read():
+    remembered = MessageHistory(maxlen=10)
+    for i in range(6):
+        add(remembered, 1, i)
+    add(remembered, 1, 6, text="cat.png", is_image=True)
+
+    deleted = remembered.delete(1, [5000, 5003, 5006, 4242])
+    assert [msg.just_msg for msg in deleted] == ["message 0", "message 3", "cat.png"]
+    assert [view.just_msg for view in remembered.last(1, 10, 3)] == ["message 2", "message 4", "message 5"]
+    assert [view.just_msg for view in remembered.between(1)] == ["message 1", "message 2", "message 4", "message 5"]
+    assert remembered.oldest(1) == {10: START + timedelta(minutes=1)}
+    assert remembered.image_refs(1) == set()
+    assert remembered.message_count == 4
+    # deleting again finds nothing, and edits no longer reach the message
+    assert remembered.delete(1, [5000]) == []
+    assert remembered.edit(1, 5003, "back?") == []
+
+
+def test_tombstones_are_compacted_away(monkeypatch):
+    monkeypatch.setattr(history, "COMPACT_MIN_DEAD", 4)
+    remembered = MessageHistory(maxlen=100)
+    for i in range(16):
+        add(remembered, 1, i)
+    before = remembered.nbytes
+
+    remembered.delete(1, [5000 + i for i in range(0, 16, 2)])
+    assert remembered.message_count == 8
+    assert remembered.nbytes < before
+    assert [view.message_id for view in remembered.channel(1, 10)] == [5000 + i for i in range(1, 16, 2)]
+    # ids still find their (renumbered) rows
+    [edited] = remembered.edit(1, 5015, "last")
+    assert remembered.last(1, 10, 1)[0].just_msg == "last" == edited.just_msg
+
+
+def test_prune_drops_a_channels_old_messages_and_returns_image_refs():
+    remembered = MessageHistory(maxlen=10)
+    for i in range(4):
+        add(remembered, 1, i)
+    add(remembered, 1, 4, text="old.png", is_image=True)
+    add(remembered, 1, 5, channel_id=11)
+    add(remembered, 1, 20)
+
+    count, refs = remembered.prune(1, 10, START + timedelta(minutes=10))
+    assert (count, refs) == (5, ["old.png"])
+    assert [view.just_msg for view in remembered.between(1)] == ["message 5", "message 20"]
+    assert remembered.prune(1, 12, START + timedelta(days=1)) == (0, [])
+
+
+def test_user_count_follows_deletes_and_prunes():
+    remembered = MessageHistory(maxlen=10)
+    for i in range(5):
+        add(remembered, 1, i)
+    add(remembered, 1, 5, text=f"{SYSTEM_PREFIX} indexing done")
+    assert remembered.user_count(1) == 5
+
+    remembered.delete(1, [5000, 5005])
+    assert remembered.user_count(1) == 4
+    remembered.prune(1, 10, START + timedelta(minutes=3))
+    assert remembered.user_count(1) == 2
+    remembered.forget(1)
+    assert remembered.user_count(1) == 0 and remembered.guilds() == []
@@ -0,0 +1,116 @@
+from llama_index.core.schema import NodeWithScore, TextNode
+import pytest
+
+from keyword_index import KeywordIndex, reciprocal_rank_fusion
+
+
+def node(node_id, text, guild_id=1, channel_id=10, posted_ts=1_000, **metadata):
+    return TextNode(
+        id_=node_id, text=text,
+        metadata=dict(metadata, guild_id=guild_id, channel_id=channel_id, posted_ts=posted_ts))
+
+
+def ids(hits):
+    return [hit.node.node_id for hit in hits]
+
+
+def test_search_ranks_exact_tokens_within_a_guild(tmp_path):
+    index = KeywordIndex(str(tmp_path / "keywords.db"))
+    index.add([
+        node("a", "the deploy failed with ERR_CONN_RESET again"),
+        node("b", "lunch plans for friday"),
+        node("c", "ERR_CONN_RESET ERR_CONN_RESET on the staging deploy"),
+        node("d", "ERR_CONN_RESET in another server", guild_id=2),
+    ])
+
+    hits = index.search(1, "what is ERR_CONN_RESET?", top_k=5)
+    assert ids(hits) == ["c", "a"]
+    assert hits[0].score > hits[1].score
+    assert hits[0].node.metadata["channel_id"] == 10
+    # "_" keeps the code one token, and stop words alone match nothing
+    assert index.search(1, "ERR", top_k=5) == []
+    assert index.search(1, "what is the", top_k=5) == []
+    assert ids(index.search(2, "err_conn_reset", top_k=5)) == ["d"]
+    index.close()
+
+
+def test_search_can_be_limited_to_channels(tmp_path):
+    index = KeywordIndex(str(tmp_path / "keywords.db"))
+    index.add([node("a", "release notes", channel_id=10), node("b", "release party", channel_id=11)])
+
+    assert ids(index.search(1, "release", top_k=5, channel_ids=[11])) == ["b"]
+    assert sorted(ids(index.search(1, "release", top_k=5, channel_ids=[10, 11]))) == ["a", "b"]
+    index.close()
+
+
+def test_adding_a_node_again_replaces_its_row(tmp_path):
+    path = str(tmp_path / "keywords.db")
+    index = KeywordIndex(path)
+    index.add([node("w", "window about kubernetes")])
+    index.add([node("w", "window about terraform")])
+
+    assert index.search(1, "kubernetes", top_k=5) == []
+    assert ids(index.search(1, "terraform", top_k=5)) == ["w"]
+    index.close()
+    # and the replacement is what a reopened index has
+    index = KeywordIndex(path)
+    assert ids(index.search(1, "window", top_k=5)) == ["w"]
+    index.close()
+
+
+def test_delete_only_touches_the_given_guild(tmp_path):
+    index = KeywordIndex(str(tmp_path / "keywords.db"))
+    index.add([node("a", "grafana alert"), node("b", "grafana dashboard"), node("x", "grafana", guild_id=2)])
+
+    index.delete(1, ["a", "x", "missing"])
+    assert ids(index.search(1, "grafana", top_k=5)) == ["b"]
+    assert ids(index.search(2, "grafana", top_k=5)) == ["x"]
+    index.close()
+
+
+def test_prune_keeps_summaries_and_newer_rows(tmp_path):
+    index = KeywordIndex(str(tmp_path / "keywords.db"))
+    index.add([
+        node("old", "backup job", posted_ts=100),
+        node("new", "backup job", posted_ts=900),
+        node("other", "backup job", channel_id=11, posted_ts=100),
+        node("summary", "backup job summary", posted_ts=100, summary_level="day"),
+    ])
+
+    index.prune(1, 10, before=500)
+    assert sorted(ids(index.search(1, "backup", top_k=10))) == ["new", "other", "summary"]
+    # a pruned id can be indexed again
+    index.add([node("old", "backup job", posted_ts=100)])
+    assert "old" in ids(index.search(1, "backup", top_k=10))
+    index.close()
+
+
+def test_forget_and_switch(tmp_path):
+    index = KeywordIndex(str(tmp_path / "v1.db"))
+    index.add([node("a", "postgres vacuum"), node("b", "postgres vacuum", guild_id=2)])
+    index.forget(1)
+    assert index.search(1, "postgres", top_k=5) == []
+    assert ids(index.search(2, "postgres", top_k=5)) == ["b"]
+
+    rebuilt = KeywordIndex(str(tmp_path / "v2.db"))
+    rebuilt.add([node("c", "postgres upgrade")])
+    rebuilt.close()
+    index.switch(str(tmp_path / "v2.db"))
+    assert index.path == str(tmp_path / "v2.db")
+    assert ids(index.search(1, "postgres", top_k=5)) == ["c"]
+    index.close()
+
+
+def test_reciprocal_rank_fusion_prefers_nodes_both_rankings_agree_on():
+    def ranking(*texts):
+        return [NodeWithScore(node=TextNode(id_=f"{text}-{i}", text=text), score=1.0) for i, text in enumerate(texts)]
+
+    dense = ranking("a", "b", "c")
+    sparse = ranking("c", "d", "b")
+    fused = reciprocal_rank_fusion([dense, sparse], top_k=3)
+
+    assert [hit.node.get_content() for hit in fused] == ["c", "b", "a"]
+    assert fused[0].score == pytest.approx(1 / 63 + 1 / 61)
+    # the same text under another id (a reindexed point) counts as one node
+    assert len(reciprocal_rank_fusion([dense, ranking("a")], top_k=10)) == 3
+    assert reciprocal_rank_fusion([[], []], top_k=3) == []
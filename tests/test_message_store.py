@@ -0,0 +1,134 @@
+import os
+import shutil
+from datetime import datetime, timedelta, timezone
+
+from message_store import JOURNAL_NAME, SEALED_NAME, SNAPSHOT_NAME, MessageStore
+from models import Message
+
+START = datetime(2024, 5, 1, tzinfo=timezone.utc)
+
+
+def message(i, channel_id=10, text=None):
+    text = f"message {i}" if text is None else text
+    return Message(
+        message_str=f"[{i}] {text}",
+        posted_at=START + timedelta(minutes=i),
+        author=f"user{i % 3}",
+        channel_id=channel_id,
+        just_msg=text,
+        message_id=1000 + i)
+
+
+def texts(store, guild_id=None):
+    return [(guild, msg.just_msg) for guild, msg in store.iter_messages(guild_id)]
+
+
+def test_appends_are_replayed_in_order_after_reopening(tmp_path):
+    store = MessageStore(tmp_path, compact_every=10_000, fsync=False)
+    store.append(1, message(0))
+    store.extend(1, [message(1), message(2)])
+    store.append(2, message(3, channel_id=20))
+    store.close()
+
+    store = MessageStore(tmp_path, compact_every=10_000, fsync=False)
+    assert texts(store) == [(1, "message 0"), (1, "message 1"), (1, "message 2"), (2, "message 3")]
+    assert texts(store, guild_id=2) == [(2, "message 3")]
+    loaded = store.load()
+    assert [msg.message_id for msg in loaded[1]] == [1000, 1001, 1002]
+    assert loaded[2][0].posted_at == START + timedelta(minutes=3)
+    store.close()
+
+
+def test_replay_applies_edits_deletes_prunes_and_forgets(tmp_path):
+    store = MessageStore(tmp_path, compact_every=10_000, fsync=False)
+    store.extend(1, [message(i) for i in range(6)])
+    store.append(2, message(6, channel_id=20))
+    store.edit(1, 10, 1004, "edited", "[4] edited")
+    store.delete(1, 10, [1001])
+    store.prune(1, 10, (START + timedelta(minutes=2)).timestamp())
+    store.forget(2)
+    # a message added again after a delete is back
+    store.append(1, message(1))
+    store.close()
+
+    store = MessageStore(tmp_path, compact_every=10_000, fsync=False)
+    assert texts(store) == [(1, "message 2"), (1, "message 3"), (1, "edited"), (1, "message 5"), (1, "message 1")]
+    store.close()
+
+
+def test_compaction_keeps_what_replay_returns(tmp_path):
+    store = MessageStore(tmp_path, compact_every=10_000, fsync=False)
+    store.extend(1, [message(i) for i in range(5)])
+    store.delete(1, 10, [1000])
+    store.edit(1, 10, 1002, "edited", "[2] edited")
+    before = texts(store)
+
+    store.compact(wait=True)
+    assert not (tmp_path / SEALED_NAME).exists()
+    assert texts(store) == before
+    # the snapshot holds only the surviving messages, with the edit folded in
+    lines = (tmp_path / SNAPSHOT_NAME).read_text().splitlines()
+    assert len(lines) == 1 + 4
+
+    store.append(1, message(5))
+    store.close()
+    store = MessageStore(tmp_path, compact_every=10_000, fsync=False)
+    assert texts(store) == before + [(1, "message 5")]
+    store.close()
+
+
+def test_crash_after_sealing_before_merging(tmp_path):
+    store = MessageStore(tmp_path, compact_every=10_000, fsync=False)
+    store.extend(1, [message(i) for i in range(3)])
+    store.compact(wait=True)
+    store.extend(1, [message(i) for i in range(3, 6)])
+    store.close()
+    # what compact() does before the merge thread gets to run
+    os.replace(tmp_path / JOURNAL_NAME, tmp_path / SEALED_NAME)
+
+    store = MessageStore(tmp_path, compact_every=10_000, fsync=False)
+    store.append(1, message(6))
+    expected = [(1, f"message {i}") for i in range(7)]
+    assert texts(store) == expected
+
+    # the left-over sealed journal is merged first, the live one stays
+    store.compact(wait=True)
+    assert not (tmp_path / SEALED_NAME).exists()
+    assert (tmp_path / JOURNAL_NAME).stat().st_size > 0
+    assert texts(store) == expected
+    store.close()
+
+
+def test_crash_after_merging_before_removing_the_sealed_journal(tmp_path):
+    store = MessageStore(tmp_path, compact_every=10_000, fsync=False)
+    store.extend(1, [message(i) for i in range(4)])
+    store.close()
+    shutil.copy(tmp_path / JOURNAL_NAME, tmp_path / "sealed.copy")
+
+    store = MessageStore(tmp_path, compact_every=10_000, fsync=False)
+    store.compact(wait=True)
+    store.close()
+    # the snapshot already holds these records; their seqs keep them from
+    # being replayed twice
+    os.replace(tmp_path / "sealed.copy", tmp_path / SEALED_NAME)
+
+    store = MessageStore(tmp_path, compact_every=10_000, fsync=False)
+    assert texts(store) == [(1, f"message {i}") for i in range(4)]
+    store.append(1, message(4))
+    store.compact(wait=True)
+    store.compact(wait=True)
+    assert texts(store) == [(1, f"message {i}") for i in range(5)]
+    store.close()
+
+
+def test_torn_tail_is_dropped_on_open(tmp_path):
+    store = MessageStore(tmp_path, compact_every=10_000, fsync=False)
+    store.extend(1, [message(0), message(1)])
+    store.close()
+    with open(tmp_path / JOURNAL_NAME, "a", encoding="utf-8") as file:
+        file.write('{"op":"add","guild_id":1,"mess')
+
+    store = MessageStore(tmp_path, compact_every=10_000, fsync=False)
+    store.append(1, message(2))
+    assert texts(store) == [(1, "message 0"), (1, "message 1"), (1, "message 2")]
+    store.close()
@@ -0,0 +1,142 @@
+import asyncio
+
+import pytest
+
+import scheduler
+from scheduler import BACKGROUND, BULK, INTERACTIVE, Coalescer, Scheduler, TokenBucket
+
+
+class Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_token_bucket_allows_a_burst_then_refills_at_its_rate(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(scheduler.time, "monotonic", clock)
+    bucket = TokenBucket(rate=2, burst=3)
+
+    for _ in range(3):
+        assert bucket.delay() == 0
+        bucket.take()
+    assert bucket.delay() == pytest.approx(0.5)
+
+    clock.now += 0.25
+    assert bucket.delay() == pytest.approx(0.25)
+    clock.now += 10
+    bucket.delay()
+    # refilled up to the burst, never beyond it
+    assert bucket.tokens == 3
+
+
+def test_token_bucket_with_rate_zero_is_unlimited():
+    bucket = TokenBucket(rate=0, burst=1)
+    for _ in range(100):
+        bucket.take()
+    assert bucket.delay() == 0
+
+
+def test_coalescer_runs_concurrent_requests_for_a_key_once():
+    calls = []
+
+    async def answer(text):
+        calls.append(text)
+        await asyncio.sleep(0.01)
+        return text.upper()
+
+    async def main():
+        coalescer = Coalescer()
+        results = await asyncio.gather(
+            coalescer.run(("rag", 1, "q"), lambda: answer("q")),
+            coalescer.run(("rag", 1, "q"), lambda: answer("q")),
+            coalescer.run(("rag", 1, "other"), lambda: answer("other")))
+        # once it is done, the same key runs again
+        again = await coalescer.run(("rag", 1, "q"), lambda: answer("q"))
+        return coalescer.coalesced, results, again
+
+    coalesced, results, again = asyncio.run(main())
+    assert results == ["Q", "Q", "OTHER"] and again == "Q"
+    assert calls == ["q", "other", "q"]
+    assert coalesced == 1
+
+
+def test_coalescer_shares_errors_and_survives_a_cancelled_caller():
+    async def fails():
+        await asyncio.sleep(0.01)
+        raise ValueError("no answer")
+
+    async def slow():
+        await asyncio.sleep(0.02)
+        return "done"
+
+    async def main():
+        coalescer = Coalescer()
+        first = asyncio.ensure_future(coalescer.run(("rag", 1, "q"), fails))
+        second = asyncio.ensure_future(coalescer.run(("rag", 1, "q"), fails))
+        errors = await asyncio.gather(first, second, return_exceptions=True)
+
+        leaving = asyncio.ensure_future(coalescer.run(("rag", 1, "slow"), slow))
+        staying = asyncio.ensure_future(coalescer.run(("rag", 1, "slow"), slow))
+        await asyncio.sleep(0)
+        leaving.cancel()
+        return errors, await staying
+
+    errors, result = asyncio.run(main())
+    assert [type(err) for err in errors] == [ValueError, ValueError]
+    assert result == "done"
+
+
+def test_coalescer_replays_a_stream_to_late_subscribers():
+    started = []
+
+    async def deltas():
+        started.append(True)
+        for delta in ("a", "b", "c"):
+            await asyncio.sleep(0.005)
+            yield delta
+
+    async def collect(stream):
+        return "".join([delta async for delta in stream])
+
+    async def main():
+        coalescer = Coalescer()
+        first = coalescer.stream(("chat", 1, "q"), deltas)
+        early = asyncio.ensure_future(collect(first))
+        await asyncio.sleep(0.008)
+        # joins after the first delta went out, and still gets all of them
+        late = coalescer.stream(("chat", 1, "q"), deltas)
+        return await asyncio.gather(early, collect(late))
+
+    assert asyncio.run(main()) == ["abc", "abc"]
+    assert started == [True]
+
+
+def test_scheduler_serves_priorities_in_order_and_guilds_in_turn():
+    order = []
+
+    async def call(limits, priority, guild_id, name):
+        async with limits.slot("llm", priority, guild_id):
+            order.append(name)
+            await asyncio.sleep(0)
+
+    async def main():
+        limits = Scheduler({"llm": (0, 1, 1)})
+        # holds the only slot while the rest queue up
+        async with limits.slot("llm", INTERACTIVE, 0):
+            calls = [
+                asyncio.ensure_future(call(limits, BULK, 1, "bulk")),
+                asyncio.ensure_future(call(limits, BACKGROUND, 1, "g1 a")),
+                asyncio.ensure_future(call(limits, BACKGROUND, 1, "g1 b")),
+                asyncio.ensure_future(call(limits, BACKGROUND, 2, "g2")),
+                asyncio.ensure_future(call(limits, INTERACTIVE, 3, "interactive")),
+            ]
+            await asyncio.sleep(0)
+            assert limits.waiting("llm") == 5
+        await asyncio.gather(*calls)
+        assert limits.in_flight("llm") == 0
+
+    asyncio.run(main())
+    assert order == ["interactive", "g1 a", "g2", "g1 b", "bulk"]
@@ -0,0 +1,90 @@
+import asyncio
+
+from streaming import DiscordStreamer, MessageSplitter, split_message
+
+
+def test_short_text_is_one_message():
+    assert split_message("hello there", limit=2000) == ["hello there"]
+    assert split_message("   \n", limit=2000) == []
+
+
+def test_long_text_is_cut_at_line_ends_within_the_limit():
+    lines = [f"line {i} of the answer" for i in range(200)]
+    parts = split_message("\n".join(lines), limit=300)
+
+    assert len(parts) > 1
+    assert all(len(part) <= 300 for part in parts)
+    # cut between lines, so no line is broken across messages
+    assert "".join(parts).split("\n") == lines
+
+
+def test_code_blocks_are_closed_and_reopened_across_cuts():
+    code = "\n".join(f"print({i})" for i in range(120))
+    parts = split_message(f"Here you go:\n```python\n{code}\n```\nThat prints the numbers.", limit=200)
+
+    assert len(parts) > 2
+    for part in parts:
+        assert len(part) <= 200
+        assert part.count("```") % 2 == 0
+    assert all(part.startswith("```python\n") for part in parts[1:-1])
+    assert parts[-1].endswith("That prints the numbers.")
+    printed = [line for part in parts for line in part.split("\n") if line.startswith("print(")]
+    assert printed == code.split("\n")
+
+
+def test_feeding_in_pieces_matches_splitting_at_once():
+    text = "# Title\n" + "".join(f"{i}. point number {i} explained at some length\n" for i in range(1, 80))
+    splitter = MessageSplitter(limit=400)
+    parts = []
+    for i in range(0, len(text), 7):
+        parts += splitter.feed(text[i:i + 7])
+    parts += splitter.flush()
+    assert parts == split_message(text, limit=400)
+
+
+def test_pending_closes_an_open_code_block():
+    splitter = MessageSplitter(limit=2000)
+    assert splitter.feed("Try this:\n```sh\nmake test") == []
+    assert splitter.pending() == "Try this:\n```sh\nmake test\n```"
+    splitter.feed("\n```\ndone")
+    assert splitter.pending() == "Try this:\n```sh\nmake test\n```\ndone"
+
+
+def test_pending_inside_a_cut_code_block_is_empty_until_it_has_text():
+    splitter = MessageSplitter(limit=60)
+    parts = splitter.feed("```py\n" + "x = 1\n" * 8 + "\n\n\n")
+    assert len(parts) == 1 and parts[0].endswith("\n```")
+    # the cut left the block open with only blank lines after it
+    assert splitter.pending() == ""
+
+    splitter.feed("y = 2")
+    assert splitter.pending() == "```py\n\n\ny = 2\n```"
+
+
+class FakeMessage:
+    def __init__(self, content):
+        self.contents = [content]
+
+    async def edit(self, content):
+        self.contents.append(content)
+
+
+def test_streamer_posts_then_edits_and_starts_a_new_message_past_the_limit():
+    posted = []
+
+    async def send(content):
+        posted.append(FakeMessage(content))
+        return posted[-1]
+
+    async def main():
+        streamer = DiscordStreamer(send, edit_interval=0, limit=100)
+        for delta in ["Hello", " world", "\n" + "more text " * 15]:
+            await streamer.feed(delta)
+        return await streamer.finish()
+
+    text = asyncio.run(main())
+    assert text == "Hello world\n" + "more text " * 15
+    assert len(posted) == 2
+    assert posted[0].contents[:2] == ["Hello", "Hello world"]
+    assert all(len(message.contents[-1]) <= 100 for message in posted)
+    assert "".join(message.contents[-1] for message in posted) == text
@@ -0,0 +1,72 @@
+"""Detection of time-scoped questions ("what did we discuss yesterday").
+
+``parse_time_scope`` turns the time expression of a query into an epoch
+range, so such questions can be answered from a range filter on
+``posted_ts`` instead of a vector search. Days start at midnight UTC, the
+time Discord stamps messages in.
+"""
+import re
+from datetime import datetime, timedelta, timezone
+
+
+_WORD_NUMBERS = {
+    "a": 1, "an": 1, "one": 1, "two": 2, "three": 3, "four": 4, "five": 5,
+    "six": 6, "seven": 7, "eight": 8, "nine": 9, "ten": 10, "couple of": 2, "few": 3,
+}
+_UNITS = {
+    "minute": timedelta(minutes=1),
+    "hour": timedelta(hours=1),
+    "day": timedelta(days=1),
+    "week": timedelta(weeks=1),
+    "month": timedelta(days=30),
+}
+
+# "last 3 days", "past two hours", "in the last hour"
+_ROLLING = re.compile(
+    r"\b(?:last|past)\s+(?:(\d+|" + "|".join(_WORD_NUMBERS) + r")\s+)?"
+    r"(minute|hour|day|week|month)s?\b", re.IGNORECASE)
+# "3 days ago" means the whole third day back, not everything since then
+_AGO = re.compile(r"\b(\d+|" + "|".join(_WORD_NUMBERS) + r")\s+(day|week)s?\s+ago\b", re.IGNORECASE)
+_NAMED = re.compile(r"\b(today|yesterday|tonight|this morning|(?:this|last) (?:week|month))\b", re.IGNORECASE)
+
+
+def _count(word):
+    if word is None:
+        return 1
+    return int(word) if word.isdigit() else _WORD_NUMBERS[word.lower()]
+
+
+def parse_time_scope(query, now=None):
+    """``(start, end)`` epoch seconds the query asks about, or ``None``."""
+    now = now or datetime.now(timezone.utc)
+    midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+
+    match = _NAMED.search(query)
+    if match:
+        name = match.group(1).lower()
+        if name in ("today", "tonight", "this morning"):
+            start, end = midnight, now
+        elif name == "yesterday":
+            start, end = midnight - timedelta(days=1), midnight
+        elif name == "this week":
+            start, end = midnight - timedelta(days=midnight.weekday()), now
+        elif name == "last week":
+            end = midnight - timedelta(days=midnight.weekday())
+            start = end - timedelta(weeks=1)
+        elif name == "this month":
+            start, end = midnight.replace(day=1), now
+        else:  # last month
+            end = midnight.replace(day=1)
+            start = (end - timedelta(days=1)).replace(day=1)
+        return start.timestamp(), end.timestamp()
+
+    match = _ROLLING.search(query)
+    if match:
+        span = _UNITS[match.group(2).lower()] * _count(match.group(1))
+        return (now - span).timestamp(), now.timestamp()
+
+    match = _AGO.search(query)
+    if match:
+        start = midnight - _UNITS[match.group(2).lower()] * _count(match.group(1))
+        return start.timestamp(), (start + _UNITS[match.group(2).lower()]).timestamp()
+    return None
@@ -0,0 +1,153 @@
+"""Grouping of consecutive channel messages into conversation windows.
+
+Instead of one vector per (usually very short) message, consecutive messages
+of a channel are collected into a window that is embedded as a single node.
+A window is closed by a long pause, by too many author turns or by its token
+budget; the last few messages of a window that was cut short are carried
+into the next one so the two overlap.
+"""
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+
+import settings
+from context_builder import count_tokens
+
+
+@dataclass
+class WindowMessage:
+    author: str
+    posted_at: datetime
+    line: str  # the message as it appears in the window text
+    tokens: int
+    message_id: int | None = None
+
+
+def _turns(messages):
+    return sum(a.author != b.author for a, b in zip(messages, messages[1:]))
+
+
+@dataclass
+class Window:
+    guild_id: int
+    channel_id: int
+    messages: list[WindowMessage] = field(default_factory=list)
+    tokens: int = 0
+    turns: int = 0
+    updated: float = 0.0  # monotonic time of the last message
+
+    @property
+    def text(self):
+        return "\n".join(msg.line for msg in self.messages)
+
+    def add(self, msg):
+        if self.messages and self.messages[-1].author != msg.author:
+            self.turns += 1
+        self.messages.append(msg)
+        self.tokens += msg.tokens
+        self.updated = time.monotonic()
+
+    def citations(self):
+        """Author, time, id and character span of every message in ``text``."""
+        spans = []
+        offset = 0
+        for msg in self.messages:
+            spans.append({
+                "author": msg.author,
+                "posted_at": str(msg.posted_at),
+                "message_id": msg.message_id,
+                "start": offset,
+                "end": offset + len(msg.line),
+            })
+            offset += len(msg.line) + 1
+        return spans
+
+    def rewrite(self, lines):
+        """Replace the line of every message in ``lines`` (message id -> new
+        line), dropping the messages whose new line is ``None``."""
+        messages = []
+        for msg in self.messages:
+            if msg.message_id in lines:
+                if lines[msg.message_id] is None:
+                    continue
+                line = lines[msg.message_id]
+                msg = WindowMessage(msg.author, msg.posted_at, line, count_tokens(line), msg.message_id)
+            messages.append(msg)
+        self.messages = messages
+        self.tokens = sum(msg.tokens for msg in messages)
+        self.turns = _turns(messages)
+
+
+class WindowBuilder:
+    def __init__(self, max_tokens=None, max_turns=None, max_gap=None, overlap=None):
+        self.max_tokens = max_tokens or settings.WINDOW_MAX_TOKENS
+        self.max_turns = max_turns or settings.WINDOW_MAX_TURNS
+        self.max_gap = settings.WINDOW_MAX_GAP if max_gap is None else max_gap
+        self.overlap = settings.WINDOW_OVERLAP if overlap is None else overlap
+        self._open: dict[tuple[int, int], Window] = {}
+
+    @property
+    def open_count(self):
+        return len(self._open)
+
+    def add(self, guild_id, channel_id, when, author, line, message_id=None):
+        """Add a message and return the windows it closed."""
+        key = (guild_id, channel_id)
+        msg = WindowMessage(author, when, line, count_tokens(line), message_id)
+        window = self._open.get(key)
+        closed = []
+        if window is not None and window.messages:
+            last = window.messages[-1]
+            turn = last.author != author
+            if (when - last.posted_at).total_seconds() > self.max_gap:
+                closed.append(window)
+                window = None
+            elif window.tokens + msg.tokens > self.max_tokens or \
+                    window.turns + turn > self.max_turns:
+                closed.append(window)
+                window = self._carry(window)
+        if window is None:
+            window = Window(guild_id, channel_id)
+        window.add(msg)
+        self._open[key] = window
+        return closed
+
+    def _carry(self, window):
+        """A new window starting with the tail of ``window``."""
+        carried = Window(window.guild_id, window.channel_id)
+        if self.overlap:
+            for msg in window.messages[-self.overlap:]:
+                carried.add(msg)
+        # the overlap must leave room for new messages
+        while carried.messages and carried.tokens > self.max_tokens // 2:
+            dropped = carried.messages.pop(0)
+            carried.tokens -= dropped.tokens
+        if carried.messages:
+            carried.turns = _turns(carried.messages)
+        return carried
+
+    def rewrite(self, guild_id, channel_id, lines):
+        """Apply edits and deletions (see ``Window.rewrite``) to a channel's
+        open window."""
+        key = (guild_id, channel_id)
+        window = self._open.get(key)
+        if window is None:
+            return
+        window.rewrite(lines)
+        if not window.messages:
+            del self._open[key]
+
+    def drain(self, max_idle=None):
+        """Close and return the open windows idle for at least ``max_idle`` seconds
+        (all of them if ``None``)."""
+        now = time.monotonic()
+        closed = []
+        for key, window in list(self._open.items()):
+            if max_idle is None or now - window.updated >= max_idle:
+                del self._open[key]
+                closed.append(window)
+        return closed
+
+    def forget(self, guild_id):
+        for key in [key for key in self._open if key[0] == guild_id]:
+            del self._open[key]